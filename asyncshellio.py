@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""
+asyncio flavour of ShellIO
+
+AsyncShellIO drives the child with asyncio.create_subprocess_exec()
+and stream readers on the caller's event loop instead of an I/O
+thread, so one loop can keep 100+ crash sessions busy with no threads
+of its own.  The framing is ShellIO's: every command is followed by
+the input end mark and the output end mark closes its result.
+
+    session = AsyncShellIO()
+    await session.start_command(["crash", "vmlinux", "vmcore"], None,
+                                "!echo 'crash> '\\n", "crash> ", True)
+    result = await session.execute("sys")
+    async for line in session.stream("log"):
+        ...
+    session.close()
+    await session.wait()
+"""
+
+import sys
+import asyncio
+from asyncio.subprocess import PIPE
+
+from shellio import ShellIO, PendingCommand
+
+
+def use_pidfd_watcher():
+    """
+    Before 3.12 the default child watcher runs one thread per child;
+    with pidfds the loop itself notices children exiting.
+    """
+    if sys.version_info >= (3, 12) or sys.platform != 'linux':
+        return
+    if not hasattr(asyncio, 'PidfdChildWatcher'):
+        return
+    policy = asyncio.get_event_loop_policy()
+    watcher = policy.get_child_watcher()
+    if not isinstance(watcher, asyncio.PidfdChildWatcher):
+        watcher = asyncio.PidfdChildWatcher()
+        policy.set_child_watcher(watcher)
+    if not watcher.is_active():
+        # Attaching drops the children already watched, so only a new
+        # watcher or one left over from a finished loop is attached
+        watcher.attach_loop(asyncio.get_running_loop())
+
+
+class LineStream:
+    """
+    Buffer for a streamed result.  ShellIO appends output blocks to it
+    and the consumer iterates over lines with 'async for'.
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, max_lines = 10000):
+        self.max_lines = max_lines
+        self.lines = []
+        self.partial = b''
+        self.max_width = 0
+        self.finished = False
+        self.ready = asyncio.Event()
+        self.room = asyncio.Event()
+        self.room.set()
+
+    def append(self, data):
+        part_list = (self.partial + data).split(b'\n')
+        self.partial = part_list.pop()
+        for part in part_list:
+            line = part.decode(self.encoding, 'replace')
+            if len(line) > self.max_width:
+                self.max_width = len(line)
+            self.lines.append(line)
+        self.ready.set()
+        if len(self.lines) >= self.max_lines and not self.finished:
+            self.room.clear()
+
+    def finish(self, future = None):
+        if len(self.partial) > 0:
+            line = self.partial.decode(self.encoding, 'replace')
+            if len(line) > self.max_width:
+                self.max_width = len(line)
+            self.lines.append(line)
+            self.partial = b''
+        self.finished = True
+        self.ready.set()
+        self.room.set()
+
+    def read(self):
+        return ''
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while len(self.lines) == 0:
+            if self.finished:
+                raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+        line = self.lines.pop(0)
+        if len(self.lines) < self.max_lines:
+            self.room.set()
+        return line
+
+
+class AsyncShellIO(ShellIO):
+    """
+    ShellIO for asyncio code.  execute() and run_batch() are
+    coroutines, execute_batch() returns asyncio Futures.  Cancelling
+    the Future of a running command interrupts it in the child, as
+    ShellIO.cancel() does.  start_command() takes ShellIO's arguments;
+    prompt is ignored, as there is no interactive port.
+    """
+    out_port = None
+    in_port = None
+
+    def __init__(self):
+        ShellIO.__init__(self)
+        self.loop = None
+        self.changed = None
+        self.reader_tasks = []
+        self.watch_task = None
+        self.done_task = None
+
+    async def start_command(self, command, prompt,
+                            input_end_mark_str, output_end_mark_str,
+                            input_start_first = False):
+        self.jobdone = False
+        self.closing = False
+        self.input_end_mark = self.to_bytes(input_end_mark_str)
+        self.output_end_mark = self.to_bytes(output_end_mark_str)
+        del self.pending_input[:]
+        self.pending_commands.clear()
+        for channel in self.channel_ahead:
+            self.channel_ahead[channel] = 0
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+
+        use_pidfd_watcher()
+        self.command_pipe = await asyncio.create_subprocess_exec(
+                *command, stdin = PIPE, stdout = PIPE, stderr = PIPE)
+        self.ready.clear()
+        if (input_start_first == True and self.input_end_mark != None):
+            # The banner printed while loading is framed like a command
+            self.submit(b'', PendingCommand())
+        else:
+            self.ready.set()
+
+        self.reader_tasks = [
+                self.loop.create_task(self.read_loop(
+                        self.command_pipe.stdout, self.CHANNEL_STDOUT)),
+                self.loop.create_task(self.read_loop(
+                        self.command_pipe.stderr, self.CHANNEL_STDERR))]
+        self.watch_task = self.loop.create_task(self.watch_deadlines())
+        self.done_task = self.loop.create_task(self.wait_child())
+        if input_start_first == False:
+            self.start_warmup()
+
+    def wakeup(self):
+        # Runs on the loop with self.lock held; the transport buffers
+        # the write, so this never blocks
+        stdin = self.command_pipe.stdin
+        if len(self.pending_input) > 0 and not stdin.is_closing():
+            try:
+                stdin.write(bytes(self.pending_input))
+            except (IOError, OSError):
+                pass
+        del self.pending_input[:]
+        if self.closing and not stdin.is_closing():
+            stdin.close()
+        if self.changed != None:
+            self.changed.set()
+
+    def new_future(self):
+        future = self.loop.create_future()
+        future.add_done_callback(self.future_done)
+        return future
+
+    def future_done(self, future):
+        if future.cancelled():
+            self.cancel(future)
+
+    def finish_command(self):
+        ShellIO.finish_command(self)
+        # The next command's deadline starts now
+        self.changed.set()
+
+    async def read_loop(self, stream, channel):
+        buf = bytearray()
+        while True:
+            data = await stream.read(self.read_size)
+            if len(data) == 0:
+                break
+            self.handle_output(channel, buf, data)
+            pending = self.channel_command(channel)
+            if (pending != None and pending.result != None and
+                    isinstance(pending.result.spool, LineStream)):
+                # A streaming consumer that falls behind holds the
+                # child back instead of growing the buffer
+                await pending.result.spool.room.wait()
+        self.handle_eof(channel, buf)
+
+    async def watch_deadlines(self):
+        while True:
+            self.changed.clear()
+            delay = self.check_deadline()
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_child(self):
+        await asyncio.gather(*self.reader_tasks)
+        await self.command_pipe.wait()
+        self.watch_task.cancel()
+        with self.lock:
+            self.jobdone = True
+            self.ready.set()
+        self.abort_commands()
+
+    async def execute(self, command, spooled = False, timeout = None):
+        future = self.execute_batch([command], spooled, timeout)[0]
+        await self.drain()
+        return await future
+
+    async def run_batch(self, command_list, timeout = None):
+        future_list = self.execute_batch(command_list, False, timeout)
+        await self.drain()
+        return list(await asyncio.gather(*future_list))
+
+    async def stream(self, command, timeout = None, max_lines = 10000):
+        """
+        Yields the lines of command as they arrive.  Leaving the loop
+        early cancels the command.
+        """
+        line_stream = LineStream(max_lines)
+        future = self.execute_batch([command], line_stream, timeout)[0]
+        future.add_done_callback(line_stream.finish)
+        await self.drain()
+        try:
+            async for line in line_stream:
+                yield line
+        finally:
+            if not future.done():
+                future.cancel()
+            # Nothing reads the rest, so it must not hold the child back
+            line_stream.finish()
+
+    async def drain(self):
+        try:
+            await self.command_pipe.stdin.drain()
+        except (IOError, OSError):
+            pass
+
+    async def wait(self, timeout = None):
+        try:
+            await asyncio.wait_for(asyncio.shield(self.done_task), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.jobdone
+
+
+def unit_test(count = 100):
+    import threading
+    import time
+
+    async def session_job(index):
+        session = AsyncShellIO()
+        await session.start_command(["bash"], None,
+                                    "echo '======================='\n",
+                                    "=======================")
+        result = await session.execute('echo session %d' % index)
+        line_count = 0
+        async for line in session.stream('seq 1 1000'):
+            line_count = line_count + 1
+        session.close()
+        await session.wait()
+        return (result.stdout, line_count)
+
+    async def main():
+        start = time.monotonic()
+        result_list = await asyncio.gather(*[session_job(i)
+                                             for i in range(count)])
+        sys.stdout.write('%d sessions in %.2fs, %d threads\n' %
+                         (len(result_list), time.monotonic() - start,
+                          threading.active_count()))
+        sys.stdout.write('%s%d lines streamed\n' % result_list[-1])
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    unit_test()
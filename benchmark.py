@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+"""
+Headless benchmark suite
+
+Drives ShellIO against fakecrash.py and PyWindow against the
+in-memory fakecurses screen, so it needs neither a vmcore nor a
+terminal, and reports:
+
+    shellio   throughput in MB/s, kept in memory and spooled to disk
+    latency   round trip of one small command at a time, percentiles
+    batch     the same commands pipelined with execute_batch()
+    idle      CPU used by an idle session
+    render    per-frame cost of text_viewer, pulldown_menu and fill_box
+    replay    with --transcript FILE, opening and replaying a recorded
+              session, and the same commands piped through fakecrash
+    startup   time to the first frame and to a usable session while
+              fakecrash pretends to load a dump, with colors set up on
+              demand and with every pair set up by init_winlib(True);
+              --init-pair-us gives each init_pair() call a cost
+
+Results are saved as JSON so runs on different commits can be put side
+by side:
+
+    benchmark.py --output before.json
+    benchmark.py --output after.json --compare before.json
+
+With --metrics FILE the runs are instrumented and the metrics.Metrics
+snapshot is written to FILE; compare against a run without it to see
+what the instrumentation costs.
+"""
+
+import os, sys, time
+import json
+import argparse
+import platform
+import resource
+import subprocess
+
+import fakecurses
+import winlib
+from metrics import Metrics
+from transcript import ReplayShellIO
+from shellio import ShellIO
+from sessiond import CRASH_INPUT_END_MARK, CRASH_OUTPUT_END_MARK
+from sessiond import CRASH_ERROR_END_MARK
+
+FAKECRASH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fakecrash.py')
+
+
+def percentile(sorted_list, fraction):
+    if len(sorted_list) == 0:
+        return 0.0
+    index = min(len(sorted_list) - 1, int(len(sorted_list) * fraction))
+    return sorted_list[index]
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def start_session(extra_args = None, metrics = None):
+    shell = ShellIO()
+    shell.set_input(None)
+    shell.set_output(None)
+    shell.set_metrics(metrics)
+    shell.set_error_end_mark(CRASH_ERROR_END_MARK)
+    shell.start_command([sys.executable, FAKECRASH] + (extra_args or []),
+                        None, CRASH_INPUT_END_MARK, CRASH_OUTPUT_END_MARK,
+                        True)
+    return shell
+
+
+def bench_shellio(size_mb, command_count, idle_seconds, metrics = None):
+    report = {}
+    shell = start_session(metrics = metrics)
+    shell.execute('bt').result()
+
+    size = size_mb * 1024 * 1024
+    for (name, spooled) in (('memory', False), ('spooled', True)):
+        start = time.perf_counter()
+        result = shell.execute('flood %d' % size, spooled).result()
+        elapsed = time.perf_counter() - start
+        report['throughput_%s_mb_s' % name] = \
+                result.stdout_bytes / elapsed / 1e6
+        if result.spool != None:
+            result.spool.close()
+        del result
+
+    timing = []
+    for i in range(0, command_count):
+        start = time.perf_counter()
+        shell.execute('noop %d' % i).result()
+        timing.append(time.perf_counter() - start)
+    timing.sort()
+    for (name, fraction) in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        report['latency_%s_ms' % name] = percentile(timing, fraction) * 1000
+    report['latency_max_ms'] = timing[-1] * 1000
+
+    start = time.perf_counter()
+    shell.run_batch(['noop %d' % i for i in range(command_count)])
+    report['batch_per_command_ms'] = \
+            (time.perf_counter() - start) / command_count * 1000
+
+    # Only this process is measured; the fake crash sleeps in read()
+    cpu_start = cpu_time()
+    time.sleep(idle_seconds)
+    report['idle_cpu_percent'] = \
+            (cpu_time() - cpu_start) / idle_seconds * 100
+
+    shell.close()
+    shell.wait()
+    return report
+
+
+def time_frames(key_list, draw):
+    """
+    Feeds key_list to draw() and returns (ms per frame, frames, cells
+    per frame), a frame being one curses.doupdate() or, for code that
+    never calls it, one key read.
+    """
+    fakecurses.flushinp()
+    fakecurses.push_keys(key_list)
+    fakecurses.reset_stats()
+    start = time.perf_counter()
+    draw()
+    elapsed = time.perf_counter() - start
+    frames = fakecurses.stats['doupdate'] or fakecurses.stats['getch']
+    frames = max(frames, 1)
+    return (elapsed / frames * 1000, frames,
+            fakecurses.stats['cells'] // frames)
+
+
+def bench_render(width, height, line_count, frames, metrics = None):
+    winlib.curses = fakecurses
+    fakecurses.set_size(width, height)
+    mywin = winlib.PyWindow()
+    mywin.set_metrics(metrics)
+    mywin.init_winlib()
+    screen = mywin.stdscr
+    report = {'screen': '%dx%d' % (width, height)}
+
+    line_list = ['%08d ffff8800deadbeef task_struct.comm "kworker/%d"' %
+                 (i, i % 64) + ' x' * (i % 40) for i in range(line_count)]
+    case_list = [
+        ('text_viewer_page',
+         [fakecurses.KEY_NPAGE, None] * frames + [27],
+         lambda: mywin.text_viewer(screen, 0, 0, width, height - 1,
+                                   line_list, mywin.color_pair(5))),
+        ('text_viewer_line',
+         [fakecurses.KEY_DOWN, None] * frames + [27],
+         lambda: mywin.text_viewer(screen, 0, 0, width, height - 1,
+                                   line_list, mywin.color_pair(5))),
+        ('text_viewer_search',
+         [ord('/')] + [ord(c) for c in 'kworker/7"'] + [10, None] +
+         [ord('n'), None] * frames + [27],
+         lambda: mywin.text_viewer(screen, 0, 0, width, height - 1,
+                                   line_list, mywin.color_pair(5))),
+        ('pulldown_menu',
+         [fakecurses.KEY_DOWN, fakecurses.KEY_DOWN, fakecurses.KEY_RIGHT]
+         * frames + [27, 27],
+         lambda: mywin.pulldown_menu(screen, 0, 0, width,
+                                     ['File', 'Task', 'Memory', 'Help'],
+                                     [['Open', 'Save', 'Quit'],
+                                      ['ps', 'bt', 'files', 'foreach bt'],
+                                      ['kmem -i', 'kmem -s', 'vm'],
+                                      ['About']])),
+        ('fill_box', [],
+         lambda: [mywin.fill_box(screen, 0, 0, width - 1, height - 1,
+                                 mywin.color_pair(5))
+                  for i in range(frames)]),
+    ]
+    for (name, key_list, draw) in case_list:
+        (frame_ms, frame_count, cells) = time_frames(key_list, draw)
+        if name == 'fill_box':
+            frame_ms = frame_ms / frames
+            frame_count = frames
+            cells = cells // frames
+        report['%s_ms' % name] = frame_ms
+        report['%s_frames' % name] = frame_count
+        report['%s_cells' % name] = cells
+
+    mywin.exit_winlib()
+    return report
+
+
+def bench_replay(path, width, height):
+    """
+    A recorded session is the same input on every run: replays it
+    without a child, shows its biggest output, then pipes every
+    command through fakecrash answering from the transcript.
+    """
+    report = {}
+    start = time.perf_counter()
+    shell = ReplayShellIO(path)
+    shell.start_command(None, None, None, None)
+    report['open_ms'] = (time.perf_counter() - start) * 1000
+    command_list = shell.transcript.commands()
+    if len(command_list) == 0:
+        return report
+
+    start = time.perf_counter()
+    result_list = shell.run_batch(command_list)
+    elapsed = time.perf_counter() - start
+    report['replay_per_command_ms'] = elapsed / len(command_list) * 1000
+
+    biggest = max(result_list, key = lambda result: result.stdout_bytes)
+    winlib.curses = fakecurses
+    fakecurses.set_size(width, height)
+    mywin = winlib.PyWindow()
+    mywin.init_winlib()
+    start = time.perf_counter()
+    (frame_ms, frames, cells) = time_frames(
+            [27], lambda: mywin.text_viewer(mywin.stdscr, 0, 0, width,
+                                            height - 1, biggest.lines(),
+                                            mywin.color_pair(5)))
+    report['first_view_ms'] = (time.perf_counter() - start) * 1000
+    mywin.exit_winlib()
+
+    shell = start_session(['--transcript', path])
+    shell.execute('bt').result()
+    start = time.perf_counter()
+    total = sum(result.stdout_bytes
+                for result in shell.run_batch(command_list))
+    elapsed = time.perf_counter() - start
+    report['pipe_per_command_ms'] = elapsed / len(command_list) * 1000
+    report['throughput_pipe_mb_s'] = total / elapsed / 1e6
+    shell.close()
+    shell.wait()
+    return report
+
+
+def draw_frame(mywin, width, height):
+    screen = mywin.stdscr
+    mywin.status_line(screen, 0, 0, width, '  File  Task  Memory  Help',
+                      mywin.color_pair(5))
+    mywin.fill_box(screen, 0, 1, width, height - 2, mywin.color_pair(5))
+    screen.noutrefresh()
+    fakecurses.doupdate()
+
+
+def bench_startup(load_time, width, height, init_pair_us = 0.0):
+    """
+    Both runs draw the same way, before the dump has loaded; they only
+    differ in how the color pairs are set up.
+    """
+    report = {}
+    winlib.curses = fakecurses
+    fakecurses.set_size(width, height)
+    fakecurses.set_init_pair_cost(init_pair_us / 1e6)
+    for name in ('lazy', 'eager'):
+        fakecurses.flushinp()
+        fakecurses.reset_stats()
+        shell = start_session(['--load-time', str(load_time)])
+        mywin = winlib.PyWindow()
+        start = time.perf_counter()
+        mywin.init_winlib(name == 'eager')
+        draw_frame(mywin, width, height)
+        mywin.wait_loading(mywin.stdscr, 0, height - 1, width, shell,
+                           'loading vmcore', mywin.color_pair(3))
+        ready = time.perf_counter()
+        report['%s_first_frame_ms' % name] = \
+                (fakecurses.stats['first_update'] - start) * 1000
+        report['%s_ready_ms' % name] = (ready - start) * 1000
+        report['%s_init_pairs' % name] = fakecurses.stats['init_pair']
+        mywin.exit_winlib()
+        shell.close()
+        shell.wait()
+    fakecurses.set_init_pair_cost(0.0)
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd = os.path.dirname(os.path.abspath(__file__)),
+                stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, old_result):
+    """
+    Returns report lines for every number in both runs.  Everything is
+    lower-is-better except throughputs.
+    """
+    line_list = []
+    for section in ('shellio', 'render', 'replay', 'startup'):
+        old_section = old_result.get(section, {})
+        for (name, value) in sorted(result.get(section, {}).items()):
+            old_value = old_section.get(name)
+            if not isinstance(value, (int, float)) or \
+                    not isinstance(old_value, (int, float)) or old_value == 0:
+                continue
+            if name.endswith('_frames'):
+                continue
+            change = (value - old_value) / old_value * 100
+            if abs(change) < 0.05:
+                verdict = 'same'
+            elif (change > 0) == name.startswith('throughput'):
+                verdict = 'better'
+            else:
+                verdict = 'worse'
+            line_list.append('%-32s %12.3f %12.3f %+8.1f%% %s' %
+                             (name, old_value, value, change, verdict))
+    return line_list
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'crashat benchmarks')
+    parser.add_argument('--output', help = 'save results as JSON')
+    parser.add_argument('--compare', help = 'JSON from an earlier run')
+    parser.add_argument('--quick', action = 'store_true',
+                        help = 'smaller runs for a fast check')
+    parser.add_argument('--size-mb', type = int, default = 200)
+    parser.add_argument('--commands', type = int, default = 1000)
+    parser.add_argument('--idle', type = float, default = 2.0)
+    parser.add_argument('--frames', type = int, default = 200)
+    parser.add_argument('--screen', default = '200x60')
+    parser.add_argument('--load-time', type = float, default = 2.0,
+                        help = 'seconds fakecrash takes to load for the '
+                               'startup run')
+    parser.add_argument('--init-pair-us', type = float, default = 0.0,
+                        help = 'microseconds each init_pair() costs in the '
+                               'startup run')
+    parser.add_argument('--transcript',
+                        help = 'also benchmark replaying this transcript')
+    parser.add_argument('--metrics',
+                        help = 'instrument the runs and save the metrics')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.size_mb = 20
+        args.commands = 200
+        args.idle = 0.5
+        args.frames = 50
+        args.load_time = 0.5
+
+    (width, height) = [int(n) for n in args.screen.split('x')]
+    metrics = None
+    if args.metrics:
+        metrics = Metrics()
+    result = {'commit': git_commit(), 'time': time.time(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'instrumented': metrics != None,
+              'shellio': bench_shellio(args.size_mb, args.commands,
+                                       args.idle, metrics),
+              'render': bench_render(width, height, 100000, args.frames,
+                                     metrics),
+              'startup': bench_startup(args.load_time, width, height,
+                                       args.init_pair_us)}
+    if metrics != None:
+        metrics.dump(args.metrics)
+    if args.transcript:
+        result['replay'] = bench_replay(args.transcript, width, height)
+
+    for section in ('shellio', 'render', 'replay', 'startup'):
+        if section not in result:
+            continue
+        for (name, value) in sorted(result[section].items()):
+            if isinstance(value, float):
+                value = '%.3f' % value
+            sys.stdout.write('%-8s %-32s %s\n' % (section, name, value))
+
+    if args.compare:
+        with open(args.compare) as f:
+            old_result = json.load(f)
+        sys.stdout.write('\ncompared with %s (%s)\n' %
+                         (args.compare, old_result.get('commit')))
+        for line in compare(result, old_result):
+            sys.stdout.write(line + '\n')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent = 2, sort_keys = True)
+            f.write('\n')
+
+
+if __name__ == "__main__":
+    main()
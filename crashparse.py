@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+
+"""
+Column oriented tables parsed from crash command output
+
+'ps', 'kmem -s', 'bt', 'log' and 'files' print one record per line.
+Each is parsed once into a ColumnTable that keeps numbers in array
+columns and repeated strings (command names, states, slab names,
+functions) interned.  Sorting, filtering and grouping then only build
+arrays of row numbers, and a TableView shows the rows through those
+numbers without formatting any text again, e.g.
+
+    table = parse_result(shell.execute('ps').result())
+    view = table.view(table.sort_index('rss', reverse = True))
+"""
+
+import re, sys, time
+import operator
+from array import array
+from itertools import compress, repeat
+
+from resultcache import command_name
+
+TASK_HEADER = re.compile(
+        r'PID:\s*(\d+)\s+TASK:\s*([0-9a-f]+)\s+CPU:\s*(\S+)\s+'
+        r'COMMAND:\s*"(.*)"')
+BT_FRAME = re.compile(
+        r'\s*#(\d+)\s+\[([0-9a-f]+)\]\s+(\S+)\s+at\s+([0-9a-f]+)'
+        r'(?:\s+\[(\S+)\])?')
+LOG_LINE = re.compile(r'(?:<(\d+)>)?\[\s*(\d+\.\d+)\]')
+
+QUERY_OPS = {'=': operator.eq, '==': operator.eq, '!=': operator.ne,
+             '<': operator.lt, '<=': operator.le, '>': operator.gt,
+             '>=': operator.ge}
+
+SIZE_UNITS = {'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+
+
+def hex_int(text):
+    return int(text, 16)
+
+
+def size_int(text):
+    """
+    '32k' style sizes from 'kmem -s'
+    """
+    unit = SIZE_UNITS.get(text[-1:].lower())
+    if unit == None:
+        return int(text)
+    return int(text[:-1]) * unit
+
+
+def cpu_int(text):
+    # '-' for tasks that are not on a CPU in some crash versions
+    if text == '-':
+        return -1
+    return int(text)
+
+
+def task_info(line):
+    match = TASK_HEADER.search(line)
+    if match == None:
+        return None
+    return (int(match.group(1)), int(match.group(2), 16),
+            cpu_int(match.group(3)), sys.intern(match.group(4)))
+
+
+class ColumnTable:
+    """
+    Rows parsed from the lines in source.  A typecode makes a column
+    an array of that type; None keeps a list of strings.  line_index
+    maps every row back to the source line it came from.
+    """
+    def __init__(self, name, column_list, source):
+        self.name = name
+        self.names = [column for (column, typecode) in column_list]
+        self.typecodes = dict(column_list)
+        self.column_list = []
+        self.columns = {}
+        for (column, typecode) in column_list:
+            if typecode == None:
+                data = []
+            else:
+                data = array(typecode)
+            self.column_list.append(data)
+            self.columns[column] = data
+        self.line_index = array('L')
+        self.source = source
+        self.header = ''
+        self.max_width = 0
+
+    def append(self, line_no, values):
+        for (data, value) in zip(self.column_list, values):
+            data.append(value)
+        self.line_index.append(line_no)
+
+    def extend(self, line_list, column_values):
+        """
+        Adds whole columns at once; column_values holds one sequence
+        per column.
+        """
+        for (data, values) in zip(self.column_list, column_values):
+            data.extend(values)
+        self.line_index.extend(line_list)
+
+    def __len__(self):
+        return len(self.line_index)
+
+    def row(self, index):
+        return tuple(data[index] for data in self.column_list)
+
+    def all_rows(self):
+        return array('L', range(len(self)))
+
+    def sort_index(self, column, reverse = False, index = None):
+        """
+        Returns row numbers ordered by column.  The sort is stable, so
+        sorting an already sorted index by another column orders ties.
+        """
+        if index == None:
+            index = range(len(self))
+        return array('L', sorted(index, key = self.columns[column].__getitem__,
+                                 reverse = reverse))
+
+    def filter_index(self, column, test, index = None):
+        """
+        Returns the row numbers whose column passes test, a function or
+        a value to compare with.  String tests run once per distinct
+        value, not once per row.
+        """
+        data = self.columns[column]
+        if not callable(test):
+            test = test.__eq__
+        if self.typecodes[column] == None:
+            matched = set(value for value in set(data) if test(value))
+            keep = map(matched.__contains__, data)
+        else:
+            keep = map(test, data)
+        if index == None:
+            return array('L', compress(range(len(self)), keep))
+        keep = list(keep)
+        return array('L', [i for i in index if keep[i]])
+
+    def match_index(self, column, pattern, index = None):
+        regex = re.compile(pattern)
+        return self.filter_index(column,
+                                 lambda value: regex.search(str(value)),
+                                 index)
+
+    def group_index(self, column, index = None):
+        """
+        Returns {value: row numbers} for column.
+        """
+        data = self.columns[column]
+        if index == None:
+            index = range(len(self))
+        group_dict = {}
+        for i in index:
+            value = data[i]
+            row_list = group_dict.get(value)
+            if row_list == None:
+                row_list = group_dict[value] = array('L')
+            row_list.append(i)
+        return group_dict
+
+    def sum_by(self, column, key_column, index = None):
+        data = self.columns[column]
+        return dict((key, sum(data[i] for i in row_list))
+                    for (key, row_list)
+                    in self.group_index(key_column, index).items())
+
+    def query_index(self, query, index = None):
+        """
+        Filters with a query typed by the user: 'rss > 1000',
+        'state = UN', 'task = ffff8800deadbeef' or 'comm kworker'
+        (a regex).  Raises ValueError for a query that makes no sense.
+        """
+        word_list = query.split(None, 2)
+        if len(word_list) < 2 or word_list[0] not in self.columns:
+            raise ValueError('usage: COLUMN [OP] VALUE, COLUMN one of %s' %
+                             ' '.join(self.names))
+        column = word_list[0]
+        if len(word_list) == 2 or word_list[1] not in QUERY_OPS:
+            return self.match_index(column, query.split(None, 1)[1], index)
+        op = QUERY_OPS[word_list[1]]
+        typecode = self.typecodes[column]
+        value = word_list[2]
+        if typecode == 'Q':
+            value = int(value, 16)
+        elif typecode == 'd':
+            value = float(value)
+        elif typecode != None:
+            value = int(value, 0)
+        return self.filter_index(column, lambda data: op(data, value), index)
+
+    def view(self, index = None):
+        if index == None:
+            index = self.all_rows()
+        return TableView(self, index)
+
+
+class TableView:
+    """
+    Read-only string list over the rows in index, with the header line
+    first, for text_viewer.  Lines come straight from the source.
+    """
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self.max_width = table.max_width
+
+    def __len__(self):
+        return len(self.index) + 1
+
+    def line(self, i):
+        if i == 0:
+            return self.table.header
+        return self.table.source[self.table.line_index[self.index[i - 1]]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.line(n) for n in range(*i.indices(len(self)))]
+        if i < 0:
+            i = i + len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('view line out of range')
+        return self.line(i)
+
+
+def parse_columns(name, lines, spec, first_header, mark_active = False):
+    """
+    Builds a table from the lines following a header whose first word
+    is first_header.  spec maps header words to (column, typecode,
+    converter), so the columns follow the header of whichever crash
+    version printed it.  The last column takes the rest of the line,
+    and lines that do not convert are skipped, so warnings mixed into
+    the output do no harm.  With mark_active, an 'active' column
+    records the '>' that crash puts in front of running tasks.
+    """
+    extra_list = []
+    if mark_active:
+        extra_list = [('active', 'b')]
+    text_list = lines[0:len(lines)]
+    table = None
+    for (header_no, line) in enumerate(text_list):
+        word_list = line.split()
+        if (len(word_list) > 0 and word_list[0] == first_header and
+                all(word in spec for word in word_list)):
+            table = ColumnTable(name, [spec[word][:2] for word in word_list]
+                                + extra_list, lines)
+            layout = [spec[word][2] for word in word_list]
+            table.header = line
+            break
+    if len(text_list) > 0:
+        table_width = max(map(len, text_list))
+    else:
+        table_width = 0
+    if table == None:
+        table = ColumnTable(name, [column[:2] for column in spec.values()]
+                            + extra_list, lines)
+        table.max_width = table_width
+        return table
+    table.max_width = table_width
+
+    # Every step below runs over whole lists in C rather than line by
+    # line in Python
+    body = text_list[header_no + 1:]
+    del text_list
+    active_list = list(compress(range(len(body)),
+                                map(str.startswith, body, repeat('>'))))
+    for i in active_list:
+        body[i] = ' ' + body[i][1:]
+    count = len(layout)
+    row_list = [line.split(None, count - 1) for line in body]
+    good_list = list(compress(range(len(row_list)),
+                              map(count.__eq__, map(len, row_list))))
+    if len(good_list) < len(row_list):
+        row_list = [row_list[i] for i in good_list]
+    line_list = [header_no + 1 + i for i in good_list]
+    if len(row_list) == 0:
+        return table
+
+    try:
+        column_values = [list(map(convert, texts)) for (convert, texts)
+                         in zip(layout, zip(*row_list))]
+    except ValueError:
+        # Some line only looked like a row; sort them out one by one
+        (line_list, column_values) = convert_rows(layout, line_list,
+                                                  row_list)
+    if mark_active:
+        active_set = set(header_no + 1 + i for i in active_list)
+        column_values.append([line_no in active_set
+                              for line_no in line_list])
+    table.extend(line_list, column_values)
+    return table
+
+
+def convert_rows(layout, line_list, row_list):
+    good_lines = []
+    good_rows = []
+    for (line_no, parts) in zip(line_list, row_list):
+        try:
+            good_rows.append([convert(text) for (convert, text)
+                              in zip(layout, parts)])
+        except ValueError:
+            continue
+        good_lines.append(line_no)
+    return (good_lines, list(zip(*good_rows)) or [[]] * len(layout))
+
+
+PS_SPEC = {'PID': ('pid', 'q', int), 'PPID': ('ppid', 'q', int),
+           'CPU': ('cpu', 'q', cpu_int), 'TASK': ('task', 'Q', hex_int),
+           'ST': ('state', None, sys.intern), '%MEM': ('mem', 'd', float),
+           'VSZ': ('vsz', 'q', int), 'RSS': ('rss', 'q', int),
+           'COMM': ('comm', None, sys.intern)}
+
+
+def parse_ps(lines):
+    return parse_columns('ps', lines, PS_SPEC, 'PID', True)
+
+
+SLAB_SPEC = {'CACHE': ('cache', 'Q', hex_int),
+             'NAME': ('name', None, sys.intern),
+             'OBJSIZE': ('objsize', 'q', int),
+             'ALLOCATED': ('allocated', 'q', int),
+             'TOTAL': ('total', 'q', int), 'SLABS': ('slabs', 'q', int),
+             'SSIZE': ('ssize', 'q', size_int)}
+
+
+def parse_kmem_slabs(lines):
+    """
+    'kmem -s'.  Older crash prints NAME second, newer crash last.
+    """
+    return parse_columns('kmem -s', lines, SLAB_SPEC, 'CACHE')
+
+
+BT_COLUMNS = [('pid', 'q'), ('task', 'Q'), ('cpu', 'q'), ('command', None),
+              ('level', 'q'), ('sp', 'Q'), ('function', None),
+              ('ip', 'Q'), ('module', None)]
+
+
+def parse_bt(lines):
+    """
+    One row per stack frame of 'bt', 'bt -a' or 'foreach bt', with
+    the task it belongs to.
+    """
+    table = ColumnTable('bt', BT_COLUMNS, lines)
+    task = (0, 0, -1, '')
+    for (line_no, line) in enumerate(lines):
+        if len(line) > table.max_width:
+            table.max_width = len(line)
+        if line.startswith('PID:'):
+            task = task_info(line) or task
+            continue
+        match = BT_FRAME.match(line)
+        if match == None:
+            continue
+        (level, sp, function, ip, module) = match.groups()
+        table.append(line_no, task + (int(level), int(sp, 16),
+                                      sys.intern(function), int(ip, 16),
+                                      sys.intern(module or '')))
+    table.header = 'PID/TASK/CPU/COMMAND  #LEVEL [SP] FUNCTION at IP [MODULE]'
+    return table
+
+
+LOG_COLUMNS = [('level', 'b'), ('time', 'd'), ('text', None)]
+
+
+def parse_log(lines):
+    """
+    'log' and 'log -m'.  Lines without a timestamp continue the
+    message before them and share its time.
+    """
+    table = ColumnTable('log', LOG_COLUMNS, lines)
+    level = -1
+    when = 0.0
+    for (line_no, line) in enumerate(lines):
+        if len(line) > table.max_width:
+            table.max_width = len(line)
+        match = LOG_LINE.match(line)
+        if match != None:
+            level = int(match.group(1) or -1)
+            when = float(match.group(2))
+            text = line[match.end():].lstrip()
+        else:
+            text = line
+        table.append(line_no, (level, when, text))
+    table.header = '[TIME] MESSAGE'
+    return table
+
+
+FILES_COLUMNS = [('pid', 'q'), ('command', None), ('fd', 'q'),
+                 ('file', 'Q'), ('dentry', 'Q'), ('inode', 'Q'),
+                 ('type', None), ('path', None)]
+
+
+def parse_files(lines):
+    """
+    One row per open file of 'files' or 'foreach files'.
+    """
+    table = ColumnTable('files', FILES_COLUMNS, lines)
+    task = (0, '')
+    for (line_no, line) in enumerate(lines):
+        if len(line) > table.max_width:
+            table.max_width = len(line)
+        if line.startswith('PID:'):
+            info = task_info(line)
+            if info != None:
+                task = (info[0], info[3])
+            continue
+        parts = line.split(None, 5)
+        if len(parts) < 5:
+            continue
+        if parts[0] == 'FD':
+            table.header = line
+            continue
+        try:
+            values = (int(parts[0]), hex_int(parts[1]), hex_int(parts[2]),
+                      hex_int(parts[3]))
+        except ValueError:
+            continue
+        path = ''
+        if len(parts) == 6:
+            path = parts[5]
+        table.append(line_no, task + values + (sys.intern(parts[4]), path))
+    return table
+
+
+def parser_for(command):
+    """
+    Returns the parser for command, or None when its output has no
+    table form.
+    """
+    name = command_name(command)
+    words = command.split()
+    if name == 'foreach':
+        # 'foreach bt', 'foreach RU files', ...
+        for word in words[1:]:
+            if word in ('bt', 'files'):
+                name = word
+                break
+    if name == 'ps' and len(words) == 1:
+        return parse_ps
+    if name == 'kmem' and '-s' in words:
+        return parse_kmem_slabs
+    if name == 'bt':
+        return parse_bt
+    if name == 'log':
+        return parse_log
+    if name == 'files':
+        return parse_files
+    return None
+
+
+def parse_result(result):
+    """
+    Parses a ShellIO CommandResult, or returns None when the command
+    has no parser.
+    """
+    parser = parser_for(result.command)
+    if parser == None:
+        return None
+    return parser(result.lines())
+
+
+def unit_test():
+    ps_lines = [
+        '   PID    PPID  CPU       TASK        ST  %MEM     VSZ    RSS  COMM',
+        '>     0      0   0  ffffffff81a8d020  RU   0.0       0      0  [swapper]',
+        '      1      0   1  ffff88013e7db500  IN   0.0   19356   1544  init',
+        '    812      1   0  ffff880139a3c040  IN   0.1  112388   5320  sshd',
+        '    901    812   1  ffff880139a3d560  IN   0.2  140120   9612  sshd',
+    ]
+    table = parse_ps(ps_lines)
+    view = table.view(table.sort_index('rss', reverse = True))
+    for line in view[:]:
+        sys.stdout.write(line + '\n')
+    sys.stdout.write('%s\n' % table.sum_by('rss', 'comm'))
+    sys.stdout.write('%s\n' % list(table.query_index('rss > 5000')))
+
+    slab_lines = [
+        'CACHE             OBJSIZE  ALLOCATED     TOTAL  SLABS  SSIZE  NAME',
+        'ffff8b2b3fc07a00      192      22932     23814   1134     4k  dentry',
+        'ffff8b2b3fc07800     8192         43        48     12    32k  kmalloc-8192',
+    ]
+    table = parse_kmem_slabs(slab_lines)
+    sys.stdout.write('%s\n' % [table.row(i) for i in
+                               table.match_index('name', 'kmalloc')])
+
+    bt_lines = [
+        'PID: 1234   TASK: ffff88013e7db500  CPU: 1   COMMAND: "bash"',
+        ' #0 [ffff880139a3fd98] __schedule at ffffffff8160a1b4',
+        ' #1 [ffff880139a3fe00] schedule at ffffffff8160a709 [ext4]',
+    ]
+    table = parse_bt(bt_lines)
+    sys.stdout.write('%s\n' % table.group_index('function'))
+
+
+def benchmark(rows = 100000):
+    """
+    Parses a made up 'ps' of 'rows' tasks and times the view changes
+    the TUI makes.  Run as 'crashparse.py bench'.
+    """
+    line_list = ['   PID    PPID  CPU       TASK        ST  %MEM     VSZ'
+                 '    RSS  COMM']
+    for pid in range(rows):
+        line_list.append('  %6d  %6d  %3d  %016x  %s  %4.1f  %7d  %6d  %s' %
+                         (pid, pid // 7, pid % 64, 0xffff880000000000 + pid * 0x1540,
+                          ('IN', 'RU', 'UN')[pid % 3], (pid % 997) / 10.0,
+                          (pid * 7919) % 500000, (pid * 104729) % 90000,
+                          ('kworker/%d' % (pid % 64), 'bash', 'java')[pid % 3]))
+
+    start = time.perf_counter()
+    table = parse_ps(line_list)
+    sys.stdout.write('%-24s %8.1f ms\n' % ('parse %d rows' % len(table),
+                                          (time.perf_counter() - start) * 1000))
+    case_list = [
+        ('sort rss', lambda: table.sort_index('rss', True)),
+        ('sort comm', lambda: table.sort_index('comm')),
+        ('filter state UN', lambda: table.filter_index('state', 'UN')),
+        ('filter comm ^kworker', lambda: table.match_index('comm', '^kworker')),
+        ('filter rss > 45000', lambda: table.filter_index(
+                'rss', lambda rss: rss > 45000)),
+        ('group comm, take java', lambda: table.group_index('comm')['java']),
+    ]
+    for (name, make_index) in case_list:
+        start = time.perf_counter()
+        view = table.view(make_index())
+        view[0:80]
+        sys.stdout.write('%-24s %8.1f ms\n' %
+                         (name, (time.perf_counter() - start) * 1000))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unit_test()
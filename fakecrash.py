@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+Scripted stand-in for crash, for benchmarks and tests without a vmcore
+
+Reads commands from stdin like crash does on a pipe and understands
+the '!echo' end marks ShellIO sends after every command.  SIGINT stops
+the running command and goes back to reading input, as in crash.
+
+    flood BYTES [WIDTH]   BYTES of output in WIDTH column lines
+    lines COUNT [WIDTH]   COUNT lines
+    sleep SECONDS         nothing for a while
+    spin                  a line every 10ms until interrupted
+    error TEXT            TEXT on stderr
+    ps [COUNT]            a made up process list
+    log [COUNT]           made up kernel messages
+    bt                    a made up backtrace
+    q, quit, exit         leave
+    !echo TEXT            TEXT, as the shell would print it
+
+Anything else is answered with one line.  With --transcript, commands
+recorded in a transcript.py transcript are answered with the recorded
+output first, so a real session can be played back as benchmark input.
+
+    fakecrash.py [--load-time SECONDS] [--latency SECONDS] [--prompt]
+                 [--transcript FILE]
+"""
+
+import os, sys, time
+import shlex
+import argparse
+import subprocess
+
+BANNER = """
+crash 8.0.0 (fakecrash)
+This program has absolutely no warranty.
+
+      KERNEL: vmlinux
+    DUMPFILE: vmcore
+        CPUS: 64
+     RELEASE: 5.14.0-fake
+"""
+
+
+def write(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    sys.stdout.buffer.write(data)
+
+
+def make_lines(count, width, prefix = 'ffff8800deadbeef'):
+    line = (prefix + ' ' + 'x' * width)[:width]
+    return (line + '\n') * count
+
+
+def flood(size, width = 80):
+    width = max(width, 2)
+    block = make_lines(max(1, 65536 // width), width - 1).encode('utf-8')
+    left = size
+    while left > 0:
+        write(block[:left])
+        left -= len(block)
+
+
+def fake_ps(count):
+    line_list = ['   PID    PPID  CPU       TASK        ST  %MEM     VSZ'
+                 '    RSS  COMM']
+    for pid in range(count):
+        line_list.append(
+                '  %6d  %6d  %3d  %016x  %s  %4.1f  %7d  %6d  %s' %
+                (pid, pid // 7, pid % 64, 0xffff880000000000 + pid * 0x1540,
+                 ('IN', 'RU', 'UN')[pid % 3], (pid % 997) / 10.0,
+                 (pid * 7919) % 500000, (pid * 104729) % 90000,
+                 ('kworker/%d' % (pid % 64), 'bash', 'java')[pid % 3]))
+    return '\n'.join(line_list) + '\n'
+
+
+def fake_log(count):
+    return ''.join('[%12.6f] fake: message %d from the kernel ring buffer\n'
+                   % (i * 0.001, i) for i in range(count))
+
+
+def fake_bt():
+    return ('PID: 1234   TASK: ffff88013e7db500  CPU: 1   COMMAND: "bash"\n'
+            ' #0 [ffff880139a3fd98] __schedule at ffffffff8160a1b4\n'
+            ' #1 [ffff880139a3fe00] schedule at ffffffff8160a709\n'
+            ' #2 [ffff880139a3fe10] do_wait at ffffffff8107a2c3\n')
+
+
+class TranscriptPlayer:
+    def __init__(self, path):
+        from transcript import Transcript
+        self.transcript = Transcript(path)
+        self.occurrences = {}
+
+    def play(self, line):
+        key = ' '.join(line.split())
+        occurrence = self.occurrences.get(key, 0)
+        index = self.transcript.find(line, occurrence)
+        if index == None:
+            return False
+        self.occurrences[key] = occurrence + 1
+        result = self.transcript.result(index)
+        if result.spool != None:
+            for chunk in result.spool.chunk_list:
+                write(self.transcript.read_chunk(chunk))
+        else:
+            write(result.stdout)
+        if len(result.stderr) > 0:
+            sys.stdout.flush()
+            sys.stderr.write(result.stderr)
+            sys.stderr.flush()
+        return True
+
+
+def run_command(line, player = None):
+    words = line.split()
+    if len(words) == 0:
+        return True
+    name = words[0]
+    arg = words[1:]
+    if player != None and not line.startswith('!') and player.play(line):
+        pass
+    elif line.startswith('!'):
+        command = line[1:].strip()
+        if command.startswith('echo ') and command.endswith(' >&2'):
+            sys.stdout.flush()
+            sys.stderr.write(' '.join(shlex.split(command[5:-4])) + '\n')
+            sys.stderr.flush()
+        elif command.startswith('echo '):
+            write(' '.join(shlex.split(command[5:])) + '\n')
+        else:
+            sys.stdout.flush()
+            subprocess.call(command, shell = True)
+    elif name == 'flood':
+        flood(int(arg[0]), int(arg[1]) if len(arg) > 1 else 80)
+    elif name == 'lines':
+        write(make_lines(int(arg[0]), int(arg[1]) if len(arg) > 1 else 80))
+    elif name == 'sleep':
+        time.sleep(float(arg[0]))
+    elif name == 'spin':
+        count = 0
+        while True:
+            write('spin %d\n' % count)
+            sys.stdout.flush()
+            count = count + 1
+            time.sleep(0.01)
+    elif name == 'error':
+        sys.stderr.write(' '.join(arg) + '\n')
+        sys.stderr.flush()
+    elif name == 'ps':
+        write(fake_ps(int(arg[0]) if len(arg) > 0 else 500))
+    elif name == 'log':
+        write(fake_log(int(arg[0]) if len(arg) > 0 else 1000))
+    elif name == 'bt':
+        write(fake_bt())
+    elif name in ('q', 'quit', 'exit'):
+        return False
+    else:
+        write('fakecrash: %s\n' % line)
+    return True
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'crash stand-in')
+    parser.add_argument('--load-time', type = float, default = 0.0,
+                        help = 'seconds to pretend to load the dump')
+    parser.add_argument('--latency', type = float, default = 0.0,
+                        help = 'seconds added to every command')
+    parser.add_argument('--prompt', action = 'store_true',
+                        help = 'print a prompt before reading each command')
+    parser.add_argument('--transcript', metavar = 'FILE',
+                        help = 'answer recorded commands from a transcript')
+    args = parser.parse_args(argv)
+
+    player = None
+    if args.transcript:
+        player = TranscriptPlayer(args.transcript)
+    time.sleep(args.load_time)
+    write(BANNER)
+    while True:
+        try:
+            if args.prompt:
+                write('crash> ')
+            sys.stdout.flush()
+            line = sys.stdin.readline()
+            if len(line) == 0:
+                break
+            if args.latency > 0 and not line.startswith('!'):
+                time.sleep(args.latency)
+            if not run_command(line.strip(), player):
+                break
+        except KeyboardInterrupt:
+            write('\n')
+        except (ValueError, IndexError) as e:
+            sys.stderr.write('fakecrash: %s\n' % e)
+        except BrokenPipeError:
+            break
+    try:
+        sys.stdout.flush()
+    except BrokenPipeError:
+        pass
+
+
+def unit_test():
+    from shellio import ShellIO
+    from sessiond import CRASH_INPUT_END_MARK, CRASH_OUTPUT_END_MARK
+    from sessiond import CRASH_ERROR_END_MARK
+
+    myshell = ShellIO()
+    myshell.set_input(None)
+    myshell.set_output(None)
+    myshell.set_error_end_mark(CRASH_ERROR_END_MARK)
+    myshell.start_command([sys.executable, os.path.abspath(__file__)], None,
+                          CRASH_INPUT_END_MARK, CRASH_OUTPUT_END_MARK, True)
+    for result in myshell.run_batch(['bt', 'error no such task',
+                                     'flood 100000', 'ps 3']):
+        sys.stdout.write('%r\n' % result)
+    result = myshell.execute('spin', timeout = 0.2).result()
+    sys.stdout.write('%r\n' % result)
+    myshell.close()
+    myshell.wait()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        unit_test()
+    else:
+        main()
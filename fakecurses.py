@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""
+In-memory stand-in for the parts of curses that winlib uses
+
+Lets PyWindow run without a terminal, for benchmarks and tests:
+
+    import winlib, fakecurses
+    winlib.curses = fakecurses
+    fakecurses.set_size(200, 60)
+    fakecurses.push_keys([fakecurses.KEY_NPAGE] * 100 + [27])
+
+Windows keep their cells as row strings and attributes as row lists,
+so drawing costs roughly what building the real curses screen costs,
+minus the terminal.  getch() takes keys pushed with push_keys(); a
+None among them reads as "nothing typed yet" to a non-blocking
+getch(), which ends the batch winlib.PyWindow.read_keys() collects,
+so keys can be fed one frame at a time.  When no keys are left a
+blocking read returns ESC so every loop ends, and a read with a
+timeout waits it out first.  The counters in stats tell how much
+drawing a run did; first_update is the perf_counter() time of the
+first doupdate() since reset_stats().
+"""
+
+import sys, time
+
+A_NORMAL = 0
+A_BOLD = 0x200000
+A_REVERSE = 0x40000
+A_BLINK = 0x80000
+A_COLOR = 0xff00
+COLORS = 256
+COLOR_PAIRS = 256
+
+KEY_DOWN = 258
+KEY_UP = 259
+KEY_LEFT = 260
+KEY_RIGHT = 261
+KEY_HOME = 262
+KEY_BACKSPACE = 263
+KEY_NPAGE = 338
+KEY_PPAGE = 339
+KEY_ENTER = 343
+KEY_END = 360
+
+
+class error(Exception):
+    pass
+
+
+LINES = 25
+COLS = 80
+stdscr = None
+keys = []
+stats = {'doupdate': 0, 'refresh': 0, 'cells': 0, 'getch': 0,
+         'init_pair': 0, 'first_update': 0}
+# Seconds of CPU every init_pair() call burns, to model a terminal
+init_pair_cost = 0.0
+
+
+def set_size(cols, lines):
+    global COLS, LINES
+    COLS = cols
+    LINES = lines
+
+
+def push_keys(key_list):
+    keys.extend(key_list)
+
+
+def set_init_pair_cost(seconds):
+    global init_pair_cost
+    init_pair_cost = seconds
+
+
+def reset_stats():
+    for name in stats:
+        stats[name] = 0
+
+
+def color_pair(number):
+    return (number << 8) & A_COLOR
+
+
+def pair_number(attr):
+    return (attr & A_COLOR) >> 8
+
+
+class FakeWindow:
+    def __init__(self, nlines, ncols, begin_y = 0, begin_x = 0):
+        self.nlines = nlines
+        self.ncols = ncols
+        self.begin_y = begin_y
+        self.begin_x = begin_x
+        self.rows = [' ' * ncols for i in range(nlines)]
+        self.attrs = [[0] * ncols for i in range(nlines)]
+        self.delay = -1
+        self.can_scroll = False
+
+    def getmaxyx(self):
+        return (self.nlines, self.ncols)
+
+    def getbegyx(self):
+        return (self.begin_y, self.begin_x)
+
+    def put(self, y, x, text, attr):
+        if y < 0 or y >= self.nlines or x < 0 or x >= self.ncols:
+            raise error('addwstr() returned ERR')
+        cut = text[:self.ncols - x]
+        row = self.rows[y]
+        self.rows[y] = row[:x] + cut + row[x + len(cut):]
+        self.attrs[y][x:x + len(cut)] = [attr] * len(cut)
+        stats['cells'] += len(cut)
+        # Like curses, filling the last cell of the window fails
+        # because the cursor cannot move past it
+        if (len(cut) < len(text) or
+                (y == self.nlines - 1 and x + len(cut) == self.ncols)):
+            raise error('addwstr() returned ERR')
+
+    def addstr(self, y, x, text, attr = 0):
+        self.put(y, x, text, attr)
+
+    def addch(self, y, x, ch, attr = 0):
+        if isinstance(ch, int):
+            attr = attr | (ch & ~0xff)
+            ch = chr(ch & 0xff)
+        self.put(y, x, ch, attr)
+
+    def insch(self, y, x, ch, attr = 0):
+        if isinstance(ch, int):
+            attr = attr | (ch & ~0xff)
+            ch = chr(ch & 0xff)
+        row = self.rows[y]
+        self.rows[y] = (row[:x] + ch + row[x:])[:self.ncols]
+        self.attrs[y][x:x] = [attr]
+        del self.attrs[y][self.ncols:]
+
+    def delch(self, y, x):
+        row = self.rows[y]
+        self.rows[y] = row[:x] + row[x + 1:] + ' '
+        del self.attrs[y][x]
+        self.attrs[y].append(0)
+
+    def hline(self, y, x, ch, n):
+        attr = ch & ~0xff
+        n = min(n, self.ncols - x)
+        row = self.rows[y]
+        self.rows[y] = row[:x] + chr(ch & 0xff) * n + row[x + n:]
+        self.attrs[y][x:x + n] = [attr] * n
+        stats['cells'] += n
+
+    def vline(self, y, x, ch, n):
+        attr = ch & ~0xff
+        for y1 in range(y, min(y + n, self.nlines)):
+            row = self.rows[y1]
+            self.rows[y1] = row[:x] + chr(ch & 0xff) + row[x + 1:]
+            self.attrs[y1][x] = attr
+        stats['cells'] += n
+
+    def chgat(self, y, x, n, attr):
+        n = min(n, self.ncols - x)
+        self.attrs[y][x:x + n] = [attr] * n
+        stats['cells'] += n
+
+    def overwrite(self, dest, sminrow = 0, smincol = 0, dminrow = 0,
+                  dmincol = 0, dmaxrow = None, dmaxcol = None):
+        if dmaxrow == None:
+            dmaxrow = min(self.nlines, dest.nlines) - 1
+            dmaxcol = min(self.ncols, dest.ncols) - 1
+        width = dmaxcol - dmincol + 1
+        for i in range(0, dmaxrow - dminrow + 1):
+            src = self.rows[sminrow + i][smincol:smincol + width]
+            row = dest.rows[dminrow + i]
+            dest.rows[dminrow + i] = (row[:dmincol] + src +
+                                      row[dmincol + len(src):])
+            dest.attrs[dminrow + i][dmincol:dmincol + len(src)] = \
+                    self.attrs[sminrow + i][smincol:smincol + len(src)]
+            stats['cells'] += len(src)
+
+    def scrollok(self, flag):
+        self.can_scroll = bool(flag)
+
+    def idlok(self, flag):
+        pass
+
+    def scroll(self, lines = 1):
+        if not self.can_scroll:
+            raise error('scroll() returned ERR')
+        blank = ' ' * self.ncols
+        if lines > 0:
+            self.rows = self.rows[lines:] + [blank] * lines
+            self.attrs = self.attrs[lines:] + [[0] * self.ncols
+                                               for i in range(lines)]
+        elif lines < 0:
+            self.rows = [blank] * -lines + self.rows[:lines]
+            self.attrs = [[0] * self.ncols
+                          for i in range(-lines)] + self.attrs[:lines]
+
+    def keypad(self, flag):
+        pass
+
+    def nodelay(self, flag):
+        self.delay = 0 if flag else -1
+
+    def timeout(self, delay):
+        self.delay = delay
+
+    def getch(self):
+        stats['getch'] += 1
+        while len(keys) > 0:
+            ch = keys.pop(0)
+            if ch != None:
+                return ch
+            if self.delay >= 0:
+                return -1
+        if self.delay > 0:
+            time.sleep(self.delay / 1000.0)
+        if self.delay >= 0:
+            return -1
+        return 27
+
+    def noutrefresh(self):
+        pass
+
+    def touchwin(self):
+        pass
+
+    def refresh(self):
+        stats['refresh'] += 1
+
+    def erase(self):
+        self.rows = [' ' * self.ncols for i in range(self.nlines)]
+        self.attrs = [[0] * self.ncols for i in range(self.nlines)]
+
+    clear = erase
+
+    def text(self):
+        return '\n'.join(self.rows)
+
+
+def initscr():
+    global stdscr
+    stdscr = FakeWindow(LINES, COLS)
+    return stdscr
+
+
+def newwin(nlines, ncols, begin_y = 0, begin_x = 0):
+    return FakeWindow(nlines, ncols, begin_y, begin_x)
+
+
+def doupdate():
+    if stats['doupdate'] == 0:
+        stats['first_update'] = time.perf_counter()
+    stats['doupdate'] += 1
+
+
+def ungetch(ch):
+    keys.insert(0, ch)
+
+
+def flushinp():
+    del keys[:]
+
+
+def curs_set(visibility):
+    return 1
+
+
+def noecho():
+    pass
+
+
+def echo():
+    pass
+
+
+def cbreak():
+    pass
+
+
+def nocbreak():
+    pass
+
+
+def start_color():
+    pass
+
+
+def use_default_colors():
+    pass
+
+
+def init_pair(pair_number, fg, bg):
+    stats['init_pair'] += 1
+    if init_pair_cost > 0:
+        end = time.perf_counter() + init_pair_cost
+        while time.perf_counter() < end:
+            pass
+
+
+def endwin():
+    pass
+
+
+def unit_test():
+    import winlib
+    winlib.curses = sys.modules[__name__]
+    set_size(60, 20)
+    mywin = winlib.PyWindow()
+    mywin.init_winlib()
+    screen = mywin.stdscr
+    push_keys([KEY_NPAGE, None, KEY_NPAGE, None, 27])
+    mywin.text_viewer(screen, 2, 2, 40, 12,
+                      ['line %d' % i for i in range(100)],
+                      mywin.color_pair(5))
+    mywin.fill_box(screen, 5, 5, 20, 6, mywin.color_pair(3))
+    mywin.exit_winlib()
+    sys.stdout.write(screen.text() + '\n')
+    sys.stdout.write('%s\n' % stats)
+
+
+if __name__ == "__main__":
+    unit_test()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""
+Low overhead counters and histograms for ShellIO and PyWindow
+
+Instrumentation is off unless a Metrics object is handed over with
+set_metrics(); the hot paths then only test an attribute for None.
+
+    metrics = Metrics()
+    shell.set_metrics(metrics)
+    window.set_metrics(metrics)
+    ...
+    metrics.dump('/tmp/crashat-metrics.json')
+
+or, for a running TUI, metrics.serve('/tmp/crashat-metrics.sock') and
+
+    metrics.py /tmp/crashat-metrics.sock
+
+Setting CRASHAT_METRICS to a file name makes from_env() return a
+Metrics object that is dumped there when the program exits.
+"""
+
+import os, sys, time
+import json
+import socket
+import atexit
+from collections import deque
+from threading import Lock, Thread
+
+# Every power of two is split in 1 << SUB_BUCKET_BITS linear buckets,
+# so a bucket is at most 1/16 of its values wide
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_BITS = 48
+BUCKET_COUNT = (MAX_BITS - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+
+
+def bucket_index(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return min((shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS,
+               BUCKET_COUNT - 1)
+
+
+def bucket_range(index):
+    """
+    Returns the [lower, upper) integer values counted in a bucket.
+    """
+    if index < SUB_BUCKETS:
+        return (index, index + 1)
+    shift = index // SUB_BUCKETS - 1
+    base = index % SUB_BUCKETS + SUB_BUCKETS
+    return (base << shift, (base + 1) << shift)
+
+
+class Histogram:
+    """
+    Counts values in log-linear buckets of microseconds, so adding a
+    value is a few integer operations and the memory is fixed.
+    Values are given in milliseconds, or in plain units for sizes.
+    """
+    def __init__(self, scale = 1000.0):
+        self.scale = scale
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bucket_index(max(0, int(value * self.scale)))] += 1
+        self.count += 1
+        self.total += value
+        if self.min == None or value < self.min:
+            self.min = value
+        if self.max == None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        Value below which the given fraction of values falls,
+        interpolated within its bucket
+        """
+        if self.count == 0:
+            return 0.0
+        wanted = self.count * fraction
+        seen = 0
+        for (i, count) in enumerate(self.buckets):
+            if count > 0 and seen + count >= wanted:
+                (lower, upper) = bucket_range(i)
+                value = lower + (upper - lower) * (wanted - seen) / count
+                return min(max(value / self.scale, self.min), self.max)
+            seen += count
+        return self.max
+
+    def snapshot(self):
+        data = {'count': self.count, 'sum': self.total,
+                'min': self.min, 'max': self.max}
+        if self.count > 0:
+            data['mean'] = self.total / self.count
+            for (name, fraction) in (('p50', 0.5), ('p90', 0.9),
+                                     ('p99', 0.99)):
+                data[name] = self.percentile(fraction)
+        return data
+
+
+class Metrics:
+    # Samples kept per series for values over time
+    series_length = 1000
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.series = {}
+        self.lock = Lock()
+        self.start_time = time.monotonic()
+        self.server_socket = None
+
+    def incr(self, name, count = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def observe(self, name, value, scale = 1000.0):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram == None:
+                histogram = self.histograms[name] = Histogram(scale)
+            histogram.add(value)
+
+    def sample(self, name, value):
+        """
+        Records value with the time, e.g. a queue depth, keeping the
+        last series_length samples.
+        """
+        with self.lock:
+            samples = self.series.get(name)
+            if samples == None:
+                samples = self.series[name] = deque(
+                        maxlen = self.series_length)
+            samples.append((time.monotonic() - self.start_time, value))
+
+    def snapshot(self):
+        with self.lock:
+            return {'uptime': time.monotonic() - self.start_time,
+                    'counters': dict(self.counters),
+                    'histograms': dict((name, histogram.snapshot())
+                                       for (name, histogram)
+                                       in self.histograms.items()),
+                    'series': dict((name, list(samples))
+                                   for (name, samples)
+                                   in self.series.items())}
+
+    def dump(self, path):
+        data = json.dumps(self.snapshot(), indent = 2, sort_keys = True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(data + '\n')
+        os.rename(tmp_path, path)
+
+    def serve(self, socket_path):
+        """
+        Answers every connection on a Unix socket with one JSON
+        snapshot, from a daemon thread.
+        """
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.server_socket = socket.socket(socket.AF_UNIX,
+                                           socket.SOCK_STREAM)
+        self.server_socket.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        self.server_socket.listen(4)
+
+        def accept_loop():
+            while True:
+                try:
+                    (conn, addr) = self.server_socket.accept()
+                except (IOError, OSError):
+                    break
+                try:
+                    conn.sendall(json.dumps(self.snapshot()).encode('utf-8')
+                                 + b'\n')
+                except (IOError, OSError):
+                    pass
+                conn.close()
+
+        thread_accept = Thread(target = accept_loop)
+        thread_accept.daemon = True
+        thread_accept.start()
+
+    def stop(self):
+        if self.server_socket != None:
+            self.server_socket.close()
+            self.server_socket = None
+
+
+def from_env(name = 'CRASHAT_METRICS'):
+    """
+    Returns a Metrics object dumped at exit to the file named by the
+    environment variable, or None when it is not set.
+    """
+    path = os.environ.get(name)
+    if not path:
+        return None
+    metrics = Metrics()
+    atexit.register(metrics.dump, path)
+    return metrics
+
+
+def fetch(socket_path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    data = b''
+    while True:
+        chunk = conn.recv(65536)
+        if len(chunk) == 0:
+            break
+        data += chunk
+    conn.close()
+    return json.loads(data)
+
+
+def report(data):
+    """
+    Turns a snapshot into readable lines.
+    """
+    line_list = ['uptime %.1fs' % data['uptime']]
+    for (name, value) in sorted(data['counters'].items()):
+        line_list.append('%-36s %12d' % (name, value))
+    for (name, histogram) in sorted(data['histograms'].items()):
+        if histogram['count'] == 0:
+            continue
+        line_list.append('%-36s n=%-8d mean=%-10.3f p50=%-10.3f '
+                         'p99=%-10.3f max=%.3f' %
+                         (name, histogram['count'], histogram['mean'],
+                          histogram['p50'], histogram['p99'],
+                          histogram['max']))
+    for (name, samples) in sorted(data['series'].items()):
+        if len(samples) > 0:
+            line_list.append('%-36s last=%s max=%s' %
+                             (name, samples[-1][1],
+                              max(value for (when, value) in samples)))
+    return line_list
+
+
+def unit_test():
+    metrics = Metrics()
+    for i in range(0, 1000):
+        metrics.observe('example.latency_ms', i / 100.0)
+        metrics.incr('example.calls')
+        metrics.sample('example.depth', i % 7)
+    socket_path = '/tmp/metrics-%d.sock' % os.getpid()
+    metrics.serve(socket_path)
+    for line in report(fetch(socket_path)):
+        sys.stdout.write(line + '\n')
+    metrics.stop()
+    os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        for line in report(fetch(sys.argv[1])):
+            sys.stdout.write(line + '\n')
+    else:
+        unit_test()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+On-disk cache of command results for a vmcore
+
+A dump never changes, so the output of most crash commands against it
+never changes either.  Results are stored zlib compressed under a key
+made from the dump identity, the crash context changes seen so far
+('set', 'mod', ...) and the normalized command string.  The directory
+is shared safely between processes and is trimmed to max_bytes by
+evicting the least recently used entries.
+"""
+
+import os, sys
+import json
+import zlib
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+import shellio
+
+# Commands whose output depends on something other than the dump
+DENY_COMMANDS = set(['!', 'q', 'quit', 'exit', 'set', 'mod', 'extend',
+                     'alias', 'sh', 'shell', 'gdb'])
+# Commands that change what later commands print
+CONTEXT_COMMANDS = set(['set', 'mod', 'extend', 'alias'])
+
+SAMPLE_SIZE = 65536
+
+
+def dump_identity(path_list):
+    """
+    Identifies vmcore/vmlinux files by size and sampled content rather
+    than by name, so copies of the same dump share cache entries.
+    """
+    digest = hashlib.sha1()
+    for path in path_list:
+        size = os.path.getsize(path)
+        digest.update(('%d\0' % size).encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(f.read(SAMPLE_SIZE))
+            if size > SAMPLE_SIZE * 2:
+                f.seek(-SAMPLE_SIZE, os.SEEK_END)
+            digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def normalize_command(command):
+    return ' '.join(command.split())
+
+
+def has_redirection(command):
+    """
+    True when command pipes or redirects through the shell outside
+    quotes, e.g. 'bt > /tmp/x' or 'log | grep oops'.  Its side effects
+    would be skipped if it were served from the cache.
+    """
+    quote = None
+    for char in command:
+        if quote != None:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char in '|<>':
+            return True
+    return False
+
+
+def command_name(command):
+    command = command.lstrip()
+    if command.startswith('!'):
+        return '!'
+    words = command.split(None, 1)
+    if len(words) == 0:
+        return ''
+    return words[0]
+
+
+class ResultCache:
+    def __init__(self, cache_dir, identity, max_bytes = 256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.identity = identity
+        self.max_bytes = max_bytes
+        self.deny_commands = set(DENY_COMMANDS)
+        self.context = ''
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.load_index()
+
+    def load_index(self):
+        entry_list = []
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        for subdir in os.listdir(self.cache_dir):
+            subpath = os.path.join(self.cache_dir, subdir)
+            if not os.path.isdir(subpath):
+                continue
+            for name in os.listdir(subpath):
+                if name.endswith('.tmp'):
+                    continue
+                st = os.stat(os.path.join(subpath, name))
+                entry_list.append((st.st_mtime, name, st.st_size))
+        entry_list.sort()
+        for (mtime, key, size) in entry_list:
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def make_key(self, command):
+        """
+        Returns the cache key for command, or None when it must not be
+        cached, as for commands that pipe or redirect output.  Context
+        changing commands are folded into the keys of
+        every command that follows them.
+        """
+        name = command_name(command)
+        command = normalize_command(command)
+        if name in CONTEXT_COMMANDS:
+            self.context = self.context + command + '\n'
+        if (name in self.deny_commands or len(name) == 0 or
+                has_redirection(command)):
+            return None
+        data = '\0'.join([self.identity, self.context, command])
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if key == None:
+            return None
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            result = shellio.CommandResult.from_dict(
+                    json.loads(zlib.decompress(data).decode('utf-8')))
+        except (IOError, OSError, ValueError, zlib.error):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(path, None)
+        except (IOError, OSError):
+            pass
+        with self.lock:
+            self.hits += 1
+            if key not in self.entries:
+                self.entries[key] = len(data)
+                self.total_bytes += len(data)
+            self.entries.move_to_end(key)
+        result.cached = True
+        return result
+
+    def put(self, key, result):
+        if key == None:
+            return
+        data = zlib.compress(json.dumps(result.to_dict()).encode('utf-8'))
+        path = self.entry_path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            return
+
+        with self.lock:
+            self.stores += 1
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]
+            self.entries[key] = len(data)
+            self.entries.move_to_end(key)
+            self.total_bytes += len(data)
+            self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            (key, size) = self.entries.popitem(last = False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(self.entry_path(key))
+            except (IOError, OSError):
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'stores': self.stores, 'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'bytes': self.total_bytes}
+
+
+def unit_test():
+    import tempfile
+    from shellio import ShellIO
+
+    cache = ResultCache(tempfile.mkdtemp(), 'bash-stand-in')
+    myshell = ShellIO()
+    myshell.set_input(None)
+    myshell.set_output(None)
+    myshell.set_cache(cache)
+    myshell.start_command(["bash"], None,
+                          "echo '======================='\n",
+                          "=======================")
+    for i in range(0, 2):
+        for result in myshell.run_batch(["date +%N", "echo cached"]):
+            sys.stdout.write('%s %s' % (result.cached, result.stdout))
+    sys.stdout.write('%s\n' % cache.stats())
+    myshell.close()
+    myshell.wait()
+
+
+if __name__ == "__main__":
+    unit_test()
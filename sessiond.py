@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+"""
+Long-lived crash session served over a local Unix socket
+
+The server owns one ShellIO child (normally crash with a vmcore already
+loaded), so clients can attach, run commands and detach without paying
+the load time again.  Requests are newline separated JSON objects:
+
+    {"op": "execute", "commands": ["sys", "bt -a"], "timeout": 60}
+    {"op": "cancel"}
+    {"op": "detach"}
+    {"op": "shutdown"}
+
+and every execute request is answered with one JSON line holding the
+list of results.  Commands from all clients are queued on the single
+ShellIO pending-command queue, so they reach the child one after the
+other in arrival order.  A cancel request, usually sent on a second
+connection, interrupts whatever command is running at the time.
+
+    sessiond.py --serve --warmup /tmp/crash.sock crash vmlinux vmcore
+    sessiond.py /tmp/crash.sock bt -a
+
+--record FILE keeps a transcript of every result, and --replay FILE
+serves a recorded session again without crash or the vmcore:
+
+    sessiond.py --serve --replay session.ctr /tmp/crash.sock
+
+With CRASHAT_METRICS set to a file name, the session's ShellIO metrics
+are written there when the server exits.
+"""
+
+import os, sys
+import json
+import socket
+import argparse
+from numbers import Number
+from threading import Thread
+from concurrent.futures import Future
+
+import metrics
+from shellio import ShellIO, CommandResult
+from transcript import TranscriptWriter, ReplayShellIO
+
+CRASH_INPUT_END_MARK = "!echo 'crash> '\n"
+CRASH_OUTPUT_END_MARK = "crash> "
+# Frames stderr too, so errors stay with the command that printed them
+CRASH_ERROR_END_MARK = "!echo 'crash> ' >&2\n"
+# What every triage starts with, prefetched by --warmup
+CRASH_WARMUP = ['sys', 'log', 'bt', 'ps', 'kmem -i', 'dev']
+
+
+class SessionServer:
+    def __init__(self, socket_path, shell = None):
+        self.socket_path = socket_path
+        self.shell = shell
+        self.server_socket = None
+        self.accept_thread = None
+        self.running = False
+
+    def start_session(self, command,
+                      input_end_mark_str = CRASH_INPUT_END_MARK,
+                      output_end_mark_str = CRASH_OUTPUT_END_MARK,
+                      input_start_first = True, warmup_list = None,
+                      record_path = None, error_end_mark_str = None):
+        self.shell = ShellIO()
+        self.shell.set_input(None)
+        self.shell.set_output(None)
+        self.shell.set_metrics(metrics.from_env())
+        if error_end_mark_str != None:
+            self.shell.set_error_end_mark(error_end_mark_str)
+        if warmup_list != None:
+            self.shell.set_warmup(warmup_list)
+        if record_path != None:
+            self.shell.set_recorder(TranscriptWriter(
+                    record_path, {'command': command}))
+        self.shell.start_command(command, None,
+                                 input_end_mark_str, output_end_mark_str,
+                                 input_start_first)
+
+    def start_replay(self, transcript_path):
+        self.shell = ReplayShellIO(transcript_path)
+        self.shell.start_command(None, None, None, None)
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server_socket = socket.socket(socket.AF_UNIX,
+                                           socket.SOCK_STREAM)
+        # Created 0600 from the start, so no other user can connect in
+        # between bind() and a chmod()
+        umask = os.umask(0o177)
+        try:
+            self.server_socket.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.server_socket.listen(8)
+        self.running = True
+        self.accept_thread = Thread(target = self.accept_loop)
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                (conn, addr) = self.server_socket.accept()
+            except (IOError, OSError):
+                break
+            thread_client = Thread(target = self.serve_client,
+                                   args = (conn,))
+            thread_client.daemon = True
+            thread_client.start()
+
+    def check_request(self, request):
+        """
+        Raises ValueError for a request that is not shaped as described
+        at the top, so a bad client gets an error reply instead of
+        taking its connection thread down.
+        """
+        if not isinstance(request, dict):
+            raise ValueError('request is not an object')
+        if not isinstance(request.get('op', 'execute'), str):
+            raise ValueError('op is not a string')
+        if request.get('op', 'execute') != 'execute':
+            return
+        command_list = request.get('commands')
+        if (not isinstance(command_list, list) or
+            not all(isinstance(command, str) for command in command_list)):
+            raise ValueError('commands is not a list of strings')
+        timeout = request.get('timeout')
+        if timeout != None and (not isinstance(timeout, Number) or
+                                isinstance(timeout, bool)):
+            raise ValueError('timeout is not a number')
+
+    def handle_request(self, request):
+        self.check_request(request)
+        op = request.get('op', 'execute')
+        if op == 'execute':
+            future_list = self.shell.execute_batch(request['commands'],
+                                                   False,
+                                                   request.get('timeout'))
+            return {'results': [future.result().to_dict()
+                                for future in future_list]}
+        elif op == 'cancel':
+            return {'cancelled': self.shell.cancel()}
+        elif op == 'detach':
+            return None
+        elif op == 'shutdown':
+            self.stop()
+            return None
+        raise ValueError('unknown op %r' % op)
+
+    def serve_client(self, conn):
+        port = conn.makefile('rwb')
+        try:
+            for line in port:
+                try:
+                    reply = self.handle_request(json.loads(line))
+                except (ValueError, KeyError, IOError) as e:
+                    reply = {'error': str(e)}
+                if reply == None:
+                    break
+                port.write(json.dumps(reply).encode('utf-8') + b'\n')
+                port.flush()
+        except (IOError, OSError):
+            pass
+        port.close()
+        conn.close()
+
+    def stop(self):
+        if self.running == False:
+            return
+        self.running = False
+        self.server_socket.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self.shell != None:
+            self.shell.close()
+
+    def serve_forever(self):
+        self.start()
+        self.shell.wait()
+        if isinstance(self.shell, ReplayShellIO):
+            # Nothing to wait for; serve until a shutdown request
+            self.accept_thread.join()
+        self.stop()
+        if self.shell.recorder != None:
+            self.shell.recorder.close()
+
+
+class SessionClient:
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.conn = None
+        self.port = None
+
+    def attach(self):
+        self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.conn.connect(self.socket_path)
+        self.port = self.conn.makefile('rwb')
+        return self
+
+    def request(self, request):
+        self.port.write(json.dumps(request).encode('utf-8') + b'\n')
+        self.port.flush()
+        if request['op'] not in ('execute', 'cancel'):
+            return None
+        line = self.port.readline()
+        if len(line) == 0:
+            raise IOError('session server went away')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise IOError(reply['error'])
+        return reply
+
+    def execute_batch(self, command_list, spooled = False, timeout = None):
+        """
+        Same as ShellIO.execute_batch(), so viewers such as
+        winlib.command_viewer can run commands through the session.
+        The server answers the whole batch in one reply, so the Futures
+        come back done.  A buffer object passed as spooled gets the
+        output appended; spooled = True just returns it in the result.
+        """
+        request = {'op': 'execute', 'commands': list(command_list)}
+        if timeout != None:
+            request['timeout'] = timeout
+        reply = self.request(request)
+        future_list = []
+        for data in reply['results']:
+            result = CommandResult.from_dict(data)
+            if spooled is not False and spooled is not True:
+                spooled.append(result.stdout.encode('utf-8'))
+            future = Future()
+            future.set_result(result)
+            future_list.append(future)
+        return future_list
+
+    def execute(self, command, spooled = False, timeout = None):
+        return self.execute_batch([command], spooled, timeout)[0]
+
+    def run_batch(self, command_list, timeout = None):
+        return [future.result()
+                for future in self.execute_batch(command_list, False,
+                                                 timeout)]
+
+    def cancel(self):
+        return self.request({'op': 'cancel'})['cancelled']
+
+    def detach(self):
+        if self.conn == None:
+            return
+        try:
+            self.request({'op': 'detach'})
+        except (IOError, OSError):
+            pass
+        self.port.close()
+        self.conn.close()
+        self.conn = self.port = None
+
+    def shutdown(self):
+        self.request({'op': 'shutdown'})
+        self.detach()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'crash session server')
+    parser.add_argument('socket')
+    parser.add_argument('--serve', action = 'store_true',
+                        help = 'start the server running COMMAND')
+    parser.add_argument('--input-end-mark', default = CRASH_INPUT_END_MARK)
+    parser.add_argument('--output-end-mark', default = CRASH_OUTPUT_END_MARK)
+    parser.add_argument('--error-end-mark', default = CRASH_ERROR_END_MARK,
+                        help = "input printing the output end mark on "
+                               "stderr; '' turns stderr framing off")
+    parser.add_argument('--warmup', action = 'store_true',
+                        help = 'prefetch the usual triage commands once '
+                               'the session is up')
+    parser.add_argument('--warmup-commands', default = ','.join(CRASH_WARMUP),
+                        help = 'comma separated commands for --warmup '
+                               '(default: %(default)s)')
+    parser.add_argument('--record', metavar = 'FILE',
+                        help = 'keep a transcript of the session')
+    parser.add_argument('--replay', metavar = 'FILE',
+                        help = 'serve a recorded transcript instead of '
+                               'running COMMAND')
+    parser.add_argument('command', nargs = argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    if args.serve and args.replay:
+        server = SessionServer(args.socket)
+        server.start_replay(args.replay)
+        server.serve_forever()
+        return
+    if args.serve:
+        server = SessionServer(args.socket)
+        warmup_list = None
+        if args.warmup:
+            warmup_list = [command.strip() for command
+                           in args.warmup_commands.split(',')
+                           if command.strip()]
+        server.start_session(args.command,
+                             args.input_end_mark.replace('\\n', '\n'),
+                             args.output_end_mark, True, warmup_list,
+                             args.record,
+                             args.error_end_mark.replace('\\n', '\n') or None)
+        server.serve_forever()
+        return
+
+    client = SessionClient(args.socket).attach()
+    for result in client.run_batch([' '.join(args.command)]):
+        sys.stdout.write(result.stdout)
+        sys.stderr.write(result.stderr)
+    client.detach()
+
+
+def unit_test():
+    socket_path = '/tmp/sessiond-%d.sock' % os.getpid()
+    server = SessionServer(socket_path)
+    server.start_session(["bash"], "echo '======================='\n",
+                         "=======================", False)
+    server.start()
+
+    def client_job(index):
+        client = SessionClient(socket_path).attach()
+        result = client.execute('echo client %d' % index).result()
+        sys.stdout.write(result.stdout)
+        client.detach()
+
+    thread_list = [Thread(target = client_job, args = (i,))
+                   for i in range(4)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+
+    client = SessionClient(socket_path).attach()
+    for bad in (b'[]', b'{"commands": "echo"}', b'{"commands": [1]}',
+                b'{"commands": [], "timeout": "1"}'):
+        client.port.write(bad + b'\n')
+        client.port.flush()
+        sys.stdout.write('%s: %s' % (bad.decode(),
+                                     client.port.readline().decode()))
+    sys.stdout.write('mode %o\n' % (os.stat(socket_path).st_mode & 0o777))
+    client.detach()
+
+    SessionClient(socket_path).attach().shutdown()
+    server.shell.wait()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main()
+    else:
+        unit_test()
@@ -6,124 +6,1175 @@ IO interface for a shell PIPE
 (c)copyright 2015,2017 Sungju Kwon
 """
 
-import os, sys
+import os, sys, time
+import signal
+import selectors
+from collections import deque
+from concurrent.futures import Future
 from subprocess import Popen, PIPE
-from threading import Thread
+from threading import Thread, Lock, Event
 
-try:
-    from Queue import Queue, Empty
-except ImportError:
-    from queue import Queue, Empty # python 3.x
+import resultcache
+from spool import SpoolBuffer
 
 ON_POSIX = 'posix' in sys.builtin_module_names
 
+class CommandResult:
+    """
+    Output of one command, framed by the end-of-output mark.
+    Times are time.monotonic() values.
+
+    A spooled result keeps stdout in a SpoolBuffer (or another buffer
+    with append()) instead of memory; its stdout attribute stays None
+    and lines() returns the buffer.  Results that outgrow
+    ShellIO.spill_bytes are spooled on the fly, so use text() or
+    lines() when the output may be large.
+
+    stdout and stderr are kept apart.  events records every block as
+    (sequence, time, channel, length), with sequence numbers shared by
+    both channels of a ShellIO, and merged() puts them back together
+    in the order they were read.
+
+    A command stopped by ShellIO.cancel() or by its timeout is
+    truncated; cancel_time is how long the child took to get back to
+    the prompt after the interrupt.
+    """
+    def __init__(self, command, spool = None):
+        self.command = command
+        self.spool = spool
+        self.stdout = ''
+        self.stderr = ''
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.submit_time = time.monotonic()
+        self.start_time = None
+        self.end_time = None
+        self.cached = False
+        self.truncated = False
+        self.timed_out = False
+        self.cancel_time = None
+        self.encoding = 'utf-8'
+        self.events = []
+        self.stdout_chunks = []
+        self.stderr_chunks = []
+
+    def add_output(self, channel, line, sequence = None):
+        if sequence != None:
+            self.events.append((sequence, time.monotonic(), channel,
+                                len(line)))
+        if channel == ShellIO.CHANNEL_STDERR:
+            self.stderr_chunks.append(line)
+            self.stderr_bytes += len(line)
+        else:
+            if self.spool != None:
+                self.spool.append(line)
+            else:
+                self.stdout_chunks.append(line)
+            self.stdout_bytes += len(line)
+
+    def spill(self, spool):
+        """
+        Moves stdout collected so far into spool and keeps appending
+        there, turning this into a spooled result.
+        """
+        for chunk in self.stdout_chunks:
+            spool.append(chunk)
+        self.stdout_chunks = []
+        self.spool = spool
+
+    def finish(self, encoding):
+        self.end_time = time.monotonic()
+        self.encoding = encoding
+        if self.spool != None:
+            self.stdout = None
+        else:
+            self.stdout = b''.join(self.stdout_chunks).decode(encoding,
+                                                               'replace')
+        self.stderr = b''.join(self.stderr_chunks).decode(encoding, 'replace')
+        self.stdout_chunks = self.stderr_chunks = None
+
+    @property
+    def elapsed(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+    def lines(self):
+        if self.spool != None:
+            return self.spool
+        return self.stdout.splitlines()
+
+    def text(self):
+        if self.spool != None:
+            return self.spool.read()
+        return self.stdout
+
+    def error_lines(self):
+        return self.stderr.splitlines()
+
+    def merged(self):
+        """
+        Returns [(channel, text), ...] with stdout and stderr blocks in
+        the order they were read.  Blocks end at line ends, so every
+        piece holds whole lines.
+        """
+        if len(self.events) == 0:
+            return [(channel, text) for (channel, text) in
+                    ((ShellIO.CHANNEL_STDOUT, self.text()),
+                     (ShellIO.CHANNEL_STDERR, self.stderr))
+                    if len(text) > 0]
+        data = {ShellIO.CHANNEL_STDOUT: self.text().encode(self.encoding),
+                ShellIO.CHANNEL_STDERR: self.stderr.encode(self.encoding)}
+        pos = {ShellIO.CHANNEL_STDOUT: 0, ShellIO.CHANNEL_STDERR: 0}
+        merged_list = []
+        for (sequence, when, channel, length) in self.events:
+            start = pos[channel]
+            pos[channel] = start + length
+            text = data[channel][start:start + length].decode(
+                    self.encoding, 'replace')
+            if (len(merged_list) > 0 and merged_list[-1][0] == channel):
+                merged_list[-1] = (channel, merged_list[-1][1] + text)
+            else:
+                merged_list.append((channel, text))
+        return merged_list
+
+    def to_dict(self):
+        return {'command': self.command,
+                'stdout': self.text(), 'stderr': self.stderr,
+                'stdout_bytes': self.stdout_bytes,
+                'stderr_bytes': self.stderr_bytes,
+                'elapsed': self.elapsed,
+                'truncated': self.truncated,
+                'events': [(sequence, when - (self.start_time or when),
+                            channel, length)
+                           for (sequence, when, channel, length)
+                           in self.events]}
+
+    @classmethod
+    def from_dict(cls, data):
+        result = cls(data['command'])
+        result.stdout = data['stdout']
+        result.stderr = data['stderr']
+        result.stdout_bytes = data['stdout_bytes']
+        result.stderr_bytes = data['stderr_bytes']
+        result.stdout_chunks = result.stderr_chunks = None
+        result.start_time = result.submit_time
+        result.end_time = result.start_time + data['elapsed']
+        result.truncated = data.get('truncated', False)
+        result.events = [(sequence, result.start_time + when, channel, length)
+                         for (sequence, when, channel, length)
+                         in data.get('events', [])]
+        return result
+
+    def __repr__(self):
+        return '<CommandResult %r: %d+%d bytes, %.3fs%s>' % (
+            self.command, self.stdout_bytes, self.stderr_bytes, self.elapsed,
+            ' truncated' if self.truncated else '')
+
+
+class PendingCommand:
+    def __init__(self, result = None, future = None, cache_key = None,
+                 timeout = None):
+        self.result = result
+        self.future = future
+        self.cache_key = cache_key
+        self.timeout = timeout
+        self.spilled = False
+        self.cancel_requested = False
+        self.interrupt_time = None
+        self.signal_time = None
+        self.background = False
+        self.preempted = False
+        self.first_output_time = None
+        self.line_count = 0
+        # End marks still to come, one per framed channel
+        self.open_channels = 1
+
+
+class RecorderGroup:
+    """
+    Passes results on to several recorders in turn.
+    """
+    def __init__(self, recorder_list):
+        self.recorder_list = list(recorder_list)
+
+    def add_output(self, result, channel, block):
+        for recorder in self.recorder_list:
+            recorder.add_output(result, channel, block)
+
+    def finish(self, result):
+        for recorder in self.recorder_list:
+            recorder.finish(result)
+
+    def discard(self, result):
+        for recorder in self.recorder_list:
+            recorder.discard(result)
+
+    def record(self, result):
+        for recorder in self.recorder_list:
+            recorder.record(result)
+
+    def close(self):
+        for recorder in self.recorder_list:
+            recorder.close()
+
+
 class ShellIO:
+    """
+    Drives a child process through its stdin/stdout/stderr pipes.
+
+    All pipes are multiplexed by a single selector in one I/O thread,
+    so the thread sleeps in select() whenever neither side has data.
+
+    Every command written to the child is followed by the input end
+    mark, so the output end mark splits the output stream back into
+    per-command results.  Interactive lines are forwarded to out_port,
+    or stderr to err_port when one is set; commands submitted with
+    execute() complete a Future instead.
+
+    Every block read from either pipe takes the next sequence number,
+    so results can interleave stdout and stderr in arrival order.
+    With set_error_end_mark(), stderr is framed by its own end marks
+    and a command completes once both channels have closed it;
+    otherwise stderr goes to the command whose stdout is being read.
+
+    A running command is stopped with interrupt_signal (SIGINT, which
+    crash answers by going back to its prompt) rather than by killing
+    the child, so the session and the loaded vmcore survive.
+
+    prefetch() runs commands in the background: one at a time, only
+    while nothing else is queued, and interrupted and put back when a
+    foreground command arrives (with preempt_background set).
+    set_warmup() starts a prefetch once the first prompt is back.
+    """
+    CHANNEL_STDOUT = 1
+    CHANNEL_STDERR = 2
+    CHANNEL_INPUT = 3
+    CHANNEL_WAKEUP = 4
+
     show_prompt = False
     command_pipe = None
     jobdone = False
     out_port = sys.stdout
+    err_port = None
     in_port = sys.stdin
+    encoding = 'utf-8'
+    read_size = 65536
+    cache = None
+    # Results holding more stdout than this in memory go to disk
+    spill_bytes = 64 * 1024 * 1024
+    # A line longer than this is passed on in pieces
+    max_line_bytes = 1024 * 1024
+    interrupt_signal = signal.SIGINT
+    # The interrupt is repeated while the end mark has not come back
+    cancel_grace = 5.0
+    # A cancelled command is interrupted on its first output or this
+    # long after it started, whichever comes first, so the signal does
+    # not land before the child has picked it up
+    cancel_delay = 0.1
+    # A prefetch that has run this long when foreground work arrives is
+    # interrupted and run again later; shorter ones are let finish, as
+    # an interrupt sent just when one ends would hit the next command
+    preempt_background = True
+    preempt_after = 0.2
+    # A metrics.Metrics object; None keeps instrumentation off
+    metrics = None
+    # A transcript.TranscriptWriter recording every result
+    recorder = None
 
     def __init__(self):
         self.show_prompt = False
         self.command_pipe = None
         self.jobdone = False
+        self.io_thread = None
+        self.prompt = None
+        self.input_end_mark = None
+        self.output_end_mark = None
+        self.error_end_mark = None
+        # Per channel, how many commands past the head its output is
+        self.channel_ahead = {self.CHANNEL_STDOUT: 0, self.CHANNEL_STDERR: 0}
+        self.pending_input = bytearray()
+        self.pending_commands = deque()
+        self.lock = Lock()
+        self.wakeup_fds = None
+        self.closing = False
+        self.buffered_bytes = 0
+        self.sequence = 0
+        self.background = deque()
+        self.prefetch_futures = {}
+        self.warmup_list = None
+        # Context changing commands submitted so far
+        self.context_changes = 0
+        # Set once the child is at its first prompt, or gone
+        self.ready = Event()
+        self.stats = {'buffered_high_water': 0,
+                      'partial_high_water': 0,
+                      'input_high_water': 0,
+                      'spilled_results': 0}
+
+    def set_memory_limit(self, spill_bytes, max_line_bytes = None):
+        """
+        Bounds how much output is held in memory: results grow on disk
+        past spill_bytes, and unterminated lines are cut at
+        max_line_bytes.
+        """
+        self.spill_bytes = spill_bytes
+        if max_line_bytes != None:
+            self.max_line_bytes = max_line_bytes
+
+    def update_high_water(self, name, value):
+        if value > self.stats[name]:
+            self.stats[name] = value
 
     def set_output(self, output):
         self.out_port = output
 
+    def set_error_output(self, output):
+        """
+        Sends interactive stderr to its own port, e.g. an errors pane.
+        Without one it goes to out_port with stdout.
+        """
+        self.err_port = output
+
     def set_input(self, input):
         self.in_port = input
 
-    def enqueue_output(self, queue, out):
-        for line in iter(out.readline, b''):
-            if queue.closed:
-                break
-            queue.put(line)
-        out.close()
-        self.jobdone = True
-        self.out_port.write('enqueue_output()\n')
+    def set_error_end_mark(self, error_end_mark_str):
+        """
+        Input that makes the child print the output end mark on stderr,
+        e.g. "!echo 'crash> ' >&2\n", sent after the input end mark of
+        every command.  stderr the child writes just before its stdout
+        end mark then still goes to the command that wrote it.  Set it
+        before start_command().
+        """
+        self.error_end_mark = self.to_bytes(error_end_mark_str)
 
-    def catch_output(self, pipe, queue, prompt,
-                     output_end_mark_str):
-        while True:
-            if queue.closed == True or self.jobdone == True:
-                break
+    def set_cache(self, cache):
+        """
+        Serves execute() from a resultcache.ResultCache where possible
+        and stores fresh results in it.
+        """
+        self.cache = cache
+
+    def set_metrics(self, metrics):
+        """
+        Records per-command time to first output and to the end mark,
+        sizes and the queue depth into a metrics.Metrics object.
+        """
+        self.metrics = metrics
+
+    def set_recorder(self, recorder):
+        """
+        Passes every result, as its output is read, to a
+        transcript.TranscriptWriter.  The caller closes the recorder.
+        """
+        self.recorder = recorder
+
+    def add_recorder(self, recorder):
+        """
+        Like set_recorder(), keeping the recorders already set, e.g. a
+        transcript and an xref.XrefIndex.
+        """
+        if self.recorder == None:
+            self.recorder = recorder
+        elif isinstance(self.recorder, RecorderGroup):
+            self.recorder.recorder_list.append(recorder)
+        else:
+            self.recorder = RecorderGroup([self.recorder, recorder])
+
+    def record_command(self, pending):
+        result = pending.result
+        metrics = self.metrics
+        metrics.incr('shellio.commands')
+        if pending.background:
+            metrics.incr('shellio.background_commands')
+        if pending.interrupt_time != None:
+            metrics.incr('shellio.interrupted')
+        if result.start_time != None:
+            if pending.first_output_time != None:
+                metrics.observe('shellio.first_output_ms',
+                                (pending.first_output_time -
+                                 result.start_time) * 1000)
+            metrics.observe('shellio.end_mark_ms',
+                            (result.end_time - result.start_time) * 1000)
+            metrics.observe('shellio.queued_ms',
+                            (result.start_time - result.submit_time) * 1000)
+        metrics.observe('shellio.bytes', result.stdout_bytes +
+                        result.stderr_bytes, 1)
+        metrics.observe('shellio.lines', pending.line_count, 1)
+        metrics.incr('shellio.bytes_total', result.stdout_bytes +
+                     result.stderr_bytes)
+
+    def to_bytes(self, data):
+        if data is None or isinstance(data, bytes):
+            return data
+        return data.encode(self.encoding)
+
+    def write_output(self, data, channel = CHANNEL_STDOUT):
+        port = self.out_port
+        if channel == self.CHANNEL_STDERR and self.err_port != None:
+            port = self.err_port
+        if port is None:
+            return
+        port.write(data.decode(self.encoding, 'replace'))
+
+    def write_input(self, data):
+        self.pending_input += self.to_bytes(data)
+        self.update_high_water('input_high_water', len(self.pending_input))
+
+    def submit(self, data, pending):
+        self.submit_list([(data, pending)])
+
+    def submit_list(self, request_list):
+        """
+        Queues (data, pending) pairs back-to-back under one lock, so
+        the I/O loop writes them to the child in as few writes as the
+        pipe allows.
+        """
+        with self.lock:
+            self.queue_requests(request_list)
+
+    def queue_requests(self, request_list):
+        # Called with self.lock held
+        if (self.jobdone == True or self.closing == True):
+            raise IOError('command pipe is not running')
+        for (data, pending) in request_list:
+            if (len(self.pending_commands) == 0 and
+                    pending.result != None):
+                pending.result.start_time = time.monotonic()
+            self.pending_commands.append(pending)
+            self.write_input(data)
+            self.write_end_marks(pending)
+        if self.metrics != None:
+            self.metrics.sample('shellio.queue_depth',
+                                len(self.pending_commands))
+        # check_deadline() preempts a prefetch now in the way
+        self.wakeup()
+
+    def write_end_marks(self, pending):
+        if self.input_end_mark != None:
+            self.write_input(self.input_end_mark)
+            if self.error_end_mark != None:
+                self.write_input(self.error_end_mark)
+                pending.open_channels = 2
+
+    def wakeup(self):
+        # Called with self.lock held so the descriptor cannot be closed
+        # underneath us
+        try:
+            os.write(self.wakeup_fds[1], b'.')
+        except (IOError, OSError, TypeError):
+            pass
+
+    def close(self):
+        """
+        Closes the child's stdin once the queued input is written, so
+        the child exits after finishing the commands already submitted.
+        """
+        with self.lock:
+            self.closing = True
+            self.wakeup()
+
+    def execute(self, command, spooled = False, timeout = None):
+        """
+        Runs one command in the child and returns a Future that
+        resolves to its CommandResult once the end mark comes back.
+        With spooled set, stdout goes to a disk backed SpoolBuffer.
+        spooled can also be a buffer object with append(), such as a
+        spool.RingBuffer, which a viewer may read while the command is
+        still running.
+
+        A command still running timeout seconds after it started is
+        interrupted and its result comes back truncated.
+        """
+        return self.execute_batch([command], spooled, timeout)[0]
+
+    def execute_batch(self, command_list, spooled = False, timeout = None):
+        """
+        Pipelines all commands to the child at once, each followed by
+        the input end mark, instead of waiting for every result before
+        sending the next command.  Returns one Future per command, in
+        the same order.  timeout applies to each command on its own.
+        A command already prefetched takes over the prefetch's Future.
+        """
+        if self.command_pipe == None:
+            raise IOError('command pipe is not running')
+        if self.output_end_mark == None or self.input_end_mark == None:
+            raise ValueError('execute() needs input and output end marks')
+        # Keys are made under the lock in queue order, as they depend on
+        # the context changes sent before them.  The cache is read with
+        # the lock released, so the I/O thread never waits on it; misses
+        # whose context changed meanwhile are run but not cached.
+        future_list = []
+        lookup_list = []
+        with self.lock:
+            changes = self.context_changes
+            for command in command_list:
+                command = command.rstrip('\n')
+                key = self.command_key(command)
+                if spooled is False:
+                    (future, queued) = self.take_prefetched(command)
+                    if future != None:
+                        future_list.append(future)
+                        if queued:
+                            # Not run yet; it moves to the foreground
+                            lookup_list.append((command, future, None,
+                                                key))
+                        continue
+                future = self.new_future()
+                future_list.append(future)
+                if spooled is not False:
+                    # Spooled output can be far too big to cache
+                    key = None
+                    spool = spooled
+                    if spooled is True:
+                        spool = SpoolBuffer()
+                    lookup_list.append((command, future, spool, None))
+                else:
+                    lookup_list.append((command, future, None, key))
+            if self.context_changes != changes:
+                # The batch changes the context itself, so it is queued
+                # now, before anyone else makes keys in the new context
+                self.queue_requests(self.make_requests(lookup_list,
+                                                       timeout))
+                return future_list
+            changes = self.context_changes
+
+        request_list = []
+        for (command, future, spool, key) in lookup_list:
+            if key != None and not future.done():
+                cached = self.cache.get(key)
+                if cached != None:
+                    if self.recorder != None:
+                        self.recorder.record(cached)
+                    future.set_result(cached)
+                    continue
+            request_list.append((command, future, spool, key))
+        if len(request_list) > 0:
+            with self.lock:
+                if self.context_changes != changes:
+                    request_list = [(command, future, spool, None)
+                                    for (command, future, spool, key)
+                                    in request_list]
+                self.queue_requests(self.make_requests(request_list,
+                                                       timeout))
+        return future_list
+
+    def make_requests(self, lookup_list, timeout):
+        return [(command + '\n',
+                 PendingCommand(CommandResult(command, spool), future, key,
+                                timeout))
+                for (command, future, spool, key) in lookup_list]
+
+    def new_future(self):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        return future
+
+    def run_batch(self, command_list, timeout = None):
+        """
+        Same as execute_batch(), but waits and returns the CommandResult
+        list.  timeout interrupts each command as in execute_batch().
+        """
+        return [future.result()
+                for future in self.execute_batch(command_list, False,
+                                                 timeout)]
+
+    def pending_count(self):
+        """
+        Number of commands written or queued that have not seen their
+        end mark yet.
+        """
+        return len(self.pending_commands)
+
+    def open_input(self):
+        """
+        Returns a file descriptor the selector can wait on for
+        interactive input.  Ports without a real descriptor are fed
+        through a pipe by a helper thread.
+        """
+        if self.in_port is None:
+            return None
+        try:
+            return self.in_port.fileno()
+        except (AttributeError, ValueError, IOError):
+            pass
+
+        rfd, wfd = os.pipe()
+        def feed_input():
             try:
-                line = queue.get_nowait()
-            except Empty:
-                if (self.show_prompt == False):
-                    self.show_prompt = True
-                    self.out_port.write(prompt)
-                    self.out_port.flush()
+                for line in iter(self.in_port.readline, ''):
+                    os.write(wfd, self.to_bytes(line))
+            except (IOError, OSError, ValueError):
                 pass
-            except IOError:
-                break
+            os.close(wfd)
+
+        thread_feed = Thread(target = feed_input)
+        thread_feed.daemon = True
+        thread_feed.start()
+        return rfd
+
+    def set_warmup(self, command_list):
+        """
+        Commands to prefetch as soon as the child's first prompt is
+        back, e.g. ['sys', 'log', 'bt', 'ps', 'kmem -i', 'dev'].
+        """
+        self.warmup_list = list(command_list)
+
+    def start_warmup(self):
+        with self.lock:
+            command_list = self.warmup_list
+            self.warmup_list = None
+        if command_list:
+            self.prefetch(command_list)
+
+    def prefetch(self, command_list):
+        """
+        Queues commands to run in the background and returns their
+        Futures.  Every execute() of the same command gets the prefetch
+        until a context change ('set', 'mod', ...) drops it.
+        """
+        future_list = []
+        with self.lock:
+            for command in command_list:
+                command = command.rstrip('\n')
+                key = resultcache.normalize_command(command)
+                future = self.prefetch_futures.get(key)
+                if future == None:
+                    future = self.new_future()
+                    self.prefetch_futures[key] = future
+                    self.background.append((command, future))
+                future_list.append(future)
+        self.feed_background()
+        return future_list
+
+    def prefetched(self, command):
+        """
+        Returns the Future of a prefetched command, or None.
+        """
+        key = resultcache.normalize_command(command)
+        return self.prefetch_futures.get(key)
+
+    def take_prefetched(self, command):
+        """
+        Returns (future, queued) for a prefetched command.  The
+        prefetch is kept, so the same command is answered from it again
+        until command_key() sees a context change.  queued is True when
+        it had not been sent yet and was taken off the background queue
+        for the caller to run.  An interrupted prefetch is dropped and
+        not handed out; (None, False) has the caller run the command
+        afresh.  Called with self.lock held.
+        """
+        key = resultcache.normalize_command(command)
+        future = self.prefetch_futures.get(key)
+        if future == None:
+            return (None, False)
+        for entry in self.background:
+            if entry[1] is future:
+                self.background.remove(entry)
+                return (future, True)
+        for pending in self.pending_commands:
+            if (pending.future is future and
+                    pending.interrupt_time != None and
+                    not pending.preempted):
+                del self.prefetch_futures[key]
+                return (None, False)
+        if future.done() and (future.cancelled() or
+                              future.exception() != None or
+                              future.result().truncated):
+            del self.prefetch_futures[key]
+            return (None, False)
+        return (future, False)
+
+    def command_key(self, command):
+        """
+        Returns the cache key of command, or None, and drops the
+        prefetches not taken yet when command changes what later
+        commands print.  Called with self.lock held, in the order the
+        commands are queued: a key depends on the context changes sent
+        to the child before it.
+        """
+        if resultcache.command_name(command) in resultcache.CONTEXT_COMMANDS:
+            self.prefetch_futures.clear()
+            self.context_changes += 1
+        if self.cache == None:
+            return None
+        return self.cache.make_key(command)
+
+    def feed_background(self):
+        """
+        Sends the next prefetch command when the child has nothing
+        else to do.  The cache is read with the lock released, as in
+        execute_batch().
+        """
+        while True:
+            with self.lock:
+                if len(self.background) == 0 or not self.child_idle():
+                    return
+                (command, future) = self.background.popleft()
+                if future.done():
+                    continue
+                key = self.command_key(command)
+                changes = self.context_changes
+            if key != None:
+                result = self.cache.get(key)
+                if result != None:
+                    if self.recorder != None:
+                        self.recorder.record(result)
+                    future.set_result(result)
+                    continue
+            with self.lock:
+                if not self.child_idle():
+                    # Foreground work came in meanwhile
+                    self.background.appendleft((command, future))
+                    return
+                if self.context_changes != changes:
+                    key = None
+                pending = PendingCommand(CommandResult(command), future, key)
+                pending.background = True
+                self.queue_requests([(command + '\n', pending)])
+                return
+
+    def child_idle(self):
+        # Called with self.lock held
+        return (len(self.pending_commands) == 0 and
+                self.jobdone == False and self.closing == False and
+                self.command_pipe != None)
+
+    def cancel(self, future = None):
+        """
+        Interrupts the command behind future, or the one running now
+        when future is None.  The interrupt waits for the command's
+        first output or cancel_delay after it started, so it does not
+        reach the child before the command line has.  Its output up to
+        the end mark is kept and the Future resolves to a truncated
+        result as usual.  Returns False when there is no such command.
+        """
+        with self.lock:
+            for pending in self.pending_commands:
+                if future == None or pending.future is future:
+                    break
             else:
-                if (line.startswith(output_end_mark_str)):
-                    self.show_prompt = False
-                else:
-                    self.out_port.write(line)
+                return False
+            pending.cancel_requested = True
+            if (pending is self.pending_commands[0] and
+                    self.has_started(pending)):
+                self.interrupt(pending)
+            # Lets the I/O loop pick up the new deadline
+            self.wakeup()
+        return True
+
+    def has_started(self, pending):
+        # Called with self.lock held, for the command at the head
+        if pending.first_output_time != None or pending.result == None:
+            return True
+        start_time = pending.result.start_time
+        return (start_time == None or
+                time.monotonic() >= start_time + self.cancel_delay)
+
+    def interrupt(self, pending, timed_out = False):
+        now = time.monotonic()
+        if pending.interrupt_time == None:
+            pending.interrupt_time = now
+            if pending.result != None:
+                pending.result.truncated = True
+                pending.result.timed_out = timed_out
+        pending.signal_time = now
+        try:
+            self.command_pipe.send_signal(self.interrupt_signal)
+        except (OSError, AttributeError):
+            pass
+
+    def check_deadline(self):
+        """
+        Interrupts the running command when its timeout has passed or
+        when it is a prefetch holding up foreground work, and repeats
+        the interrupt every cancel_grace seconds until its end mark
+        shows up.  Returns how long select() may sleep.
+        """
+        with self.lock:
+            pending = self.current_command()
+            if pending == None:
+                return None
+            now = time.monotonic()
+            if pending.interrupt_time != None:
+                deadline = pending.signal_time + self.cancel_grace
+            elif (pending.background and self.preempt_background and
+                    len(self.pending_commands) > 1):
+                deadline = pending.result.start_time + self.preempt_after
+                if now >= deadline:
+                    pending.preempted = True
+                    self.interrupt(pending)
+                    return self.cancel_grace
+            elif (pending.cancel_requested and pending.result != None and
+                    pending.result.start_time != None):
+                deadline = pending.result.start_time + self.cancel_delay
+            elif (pending.timeout != None and pending.result != None and
+                    pending.result.start_time != None):
+                deadline = pending.result.start_time + pending.timeout
+            else:
+                return None
+            if now >= deadline:
+                self.interrupt(pending, pending.interrupt_time == None and
+                               not pending.cancel_requested)
+                return self.cancel_grace
+            return deadline - now
 
-        self.in_port.close()
-        self.out_port.write('catch_output()\n')
-        return
+    def current_command(self):
+        if len(self.pending_commands) == 0:
+            return None
+        return self.pending_commands[0]
 
-    def catch_input(self, pipe, queue,
-                    input_end_mark_str, start_first = False):
-        if (start_first == True and input_end_mark_str != None):
-            pipe.stdin.write(input_end_mark_str)
+    def channel_command(self, channel):
+        """
+        The command output on channel belongs to.  With stderr framed,
+        one channel may already be past the head command's end mark
+        while the other is not.
+        """
+        ahead = self.channel_ahead[channel]
+        if ahead >= len(self.pending_commands):
+            return None
+        return self.pending_commands[ahead]
 
+    def close_channel(self, channel):
+        """
+        Counts an end mark on channel and completes every command at
+        the head whose channels have all been closed.
+        """
+        pending = self.channel_command(channel)
+        if pending == None:
+            # Nothing is waiting for it, e.g. a prompt
+            self.finish_command()
+            return
+        pending.open_channels -= 1
+        self.channel_ahead[channel] += 1
         while True:
-            while (queue.empty() == False and self.jobdone == False):
-                pass
-            if (self.jobdone == True):
-                break
-            try:
-                line = self.in_port.readline()
-                pipe.stdin.write(line + "\n")
-                if (input_end_mark_str != None):
-                    pipe.stdin.write(input_end_mark_str)
-            except (KeyboardInterrupt, SystemExit):
+            head = self.current_command()
+            if head == None or head.open_channels > 0:
                 break
-            except IOError:
+            for other in self.channel_ahead:
+                if self.channel_ahead[other] > 0:
+                    self.channel_ahead[other] -= 1
+            self.finish_command()
+
+    def finish_command(self):
+        self.complete_command()
+        if len(self.background) > 0:
+            self.feed_background()
+
+    def complete_command(self):
+        with self.lock:
+            if len(self.pending_commands) == 0:
+                self.show_prompt = False
+                return
+            pending = self.pending_commands.popleft()
+            requeue = pending.preempted and not pending.cancel_requested
+            if requeue:
+                # Run again from the start once the foreground is idle
+                self.background.appendleft((pending.result.command,
+                                            pending.future))
+            if len(self.pending_commands) > 0:
+                # The child runs commands one at a time, so the next
+                # one starts when this one's end mark comes back
+                following = self.pending_commands[0]
+                if following.result != None:
+                    following.result.start_time = time.monotonic()
+            if self.metrics != None:
+                self.metrics.sample('shellio.queue_depth',
+                                    len(self.pending_commands))
+        if pending.future == None:
+            self.show_prompt = False
+            self.ready.set()
+            if self.warmup_list != None:
+                # The first prompt is back
+                self.start_warmup()
+            return
+        result = pending.result
+        if result.spool == None:
+            self.buffered_bytes -= result.stdout_bytes
+        if requeue:
+            if self.recorder != None:
+                self.recorder.discard(result)
+            return
+        if pending.spilled:
+            # Too big to keep around as a cache entry
+            pending.cache_key = None
+        if pending.interrupt_time != None:
+            result.cancel_time = time.monotonic() - pending.interrupt_time
+            pending.cache_key = None
+        result.finish(self.encoding)
+        if pending.cache_key != None and self.cache != None:
+            # Stored before the future resolves so a caller repeating
+            # the command right away already hits the cache
+            self.cache.put(pending.cache_key, pending.result)
+        if self.metrics != None:
+            self.record_command(pending)
+        if self.recorder != None:
+            self.recorder.finish(result)
+        if not pending.future.done():
+            pending.future.set_result(pending.result)
+
+    def handle_block(self, channel, block):
+        """
+        Delivers output that belongs to one command, usually many lines
+        at once, to its result or to out_port.
+        """
+        self.sequence += 1
+        pending = self.channel_command(channel)
+        if pending == None or pending.future == None:
+            self.write_output(block, channel)
+            return
+
+        result = pending.result
+        if pending.first_output_time == None:
+            pending.first_output_time = time.monotonic()
+        if pending.cancel_requested and pending.interrupt_time == None:
+            with self.lock:
+                self.interrupt(pending)
+        result.add_output(channel, block, self.sequence)
+        if self.recorder != None:
+            self.recorder.add_output(result, channel, block)
+        if self.metrics != None:
+            pending.line_count += block.count(b'\n')
+        if result.spool != None or channel == self.CHANNEL_STDERR:
+            return
+        self.buffered_bytes += len(block)
+        self.update_high_water('buffered_high_water', self.buffered_bytes)
+        if (self.spill_bytes != None and
+                result.stdout_bytes > self.spill_bytes):
+            self.buffered_bytes -= result.stdout_bytes
+            result.spill(SpoolBuffer())
+            pending.spilled = True
+            self.stats['spilled_results'] += 1
+
+    def find_end_mark(self, buf, pos):
+        """
+        Returns where the next end mark starts in buf, looking only at
+        line starts, as a line that merely ends with the mark text is
+        output.  buf[pos] is a line start.
+        """
+        mark = self.output_end_mark
+        if buf.startswith(mark, pos):
+            return pos
+        found = buf.find(b'\n' + mark, pos)
+        if found >= 0:
+            found = found + 1
+        return found
+
+    def handle_output(self, channel, buf, data):
+        """
+        buf holds the unterminated tail of earlier reads.  Everything
+        between end marks is handed on as one block; only the mark
+        positions are searched for, the lines are never split apart.
+        """
+        buf += data
+        pos = 0
+        if self.is_framed(channel):
+            while True:
+                start = self.find_end_mark(buf, pos)
+                if start < 0:
+                    break
+                end = buf.find(b'\n', start)
+                if end < 0:
+                    # The rest of the mark line has not arrived yet
+                    break
+                if start > pos:
+                    self.handle_block(channel, bytes(buf[pos:start]))
+                self.close_channel(channel)
+                pos = end + 1
+
+        last = buf.rfind(b'\n', pos)
+        if last >= 0:
+            self.handle_block(channel, bytes(buf[pos:last + 1]))
+            pos = last + 1
+        del buf[:pos]
+        if len(buf) > self.max_line_bytes:
+            self.handle_block(channel, bytes(buf))
+            del buf[:]
+        self.update_high_water('partial_high_water', len(buf))
+
+    def is_framed(self, channel):
+        if self.output_end_mark == None:
+            return False
+        return (channel == self.CHANNEL_STDOUT or
+                self.error_end_mark != None)
+
+    def handle_eof(self, channel, buf):
+        if len(buf) == 0:
+            return
+        if (self.is_framed(channel) and
+                buf.startswith(self.output_end_mark)):
+            self.close_channel(channel)
+        else:
+            self.handle_block(channel, bytes(buf))
+        del buf[:]
+
+    def handle_input(self, buf, data):
+        buf += data
+        start = 0
+        while True:
+            end = buf.find(b'\n', start)
+            if end < 0:
                 break
+            line = bytes(buf[start:end + 1])
+            with self.lock:
+                # Keeps the cache's view of the crash context current
+                self.command_key(line.decode(self.encoding, 'replace'))
+                self.queue_requests([(line, PendingCommand())])
+            start = end + 1
+        del buf[:start]
+
+    def flush_input(self, fd):
+        with self.lock:
+            try:
+                written = os.write(fd, self.pending_input)
+            except (IOError, OSError):
+                # The child went away; nothing more can be delivered
+                del self.pending_input[:]
+                return False
+            del self.pending_input[:written]
+        return True
+
+    def abort_commands(self):
+        with self.lock:
+            pending_list = list(self.pending_commands)
+            self.pending_commands.clear()
+        for pending in pending_list:
+            if pending.future != None and not pending.future.done():
+                pending.future.set_exception(
+                        IOError('command pipe closed before %r finished'
+                                % pending.result.command))
+
+    def io_loop(self):
+        pipe = self.command_pipe
+        sel = selectors.DefaultSelector()
+        # Every read lands in the same buffer
+        read_buf = bytearray(self.read_size)
+        read_view = memoryview(read_buf)
+        buffers = {}
+        for (stream, channel) in ((pipe.stdout, self.CHANNEL_STDOUT),
+                                  (pipe.stderr, self.CHANNEL_STDERR)):
+            buffers[stream.fileno()] = bytearray()
+            sel.register(stream.fileno(), selectors.EVENT_READ, channel)
+
+        in_fd = self.open_input()
+        in_buf = bytearray()
+        if in_fd != None:
+            sel.register(in_fd, selectors.EVENT_READ, self.CHANNEL_INPUT)
+        sel.register(self.wakeup_fds[0], selectors.EVENT_READ,
+                     self.CHANNEL_WAKEUP)
+
+        stdin_fd = pipe.stdin.fileno()
+        os.set_blocking(stdin_fd, False)
+        stdin_open = True
+        stdin_watched = False
+        close_stdin = False
+
+        while len(buffers) > 0:
+            if self.closing:
+                close_stdin = True
+            if stdin_open:
+                if close_stdin and len(self.pending_input) == 0:
+                    if stdin_watched:
+                        sel.unregister(stdin_fd)
+                    pipe.stdin.close()
+                    stdin_open = stdin_watched = False
+                elif len(self.pending_input) > 0 and not stdin_watched:
+                    sel.register(stdin_fd, selectors.EVENT_WRITE)
+                    stdin_watched = True
+                elif len(self.pending_input) == 0 and stdin_watched:
+                    sel.unregister(stdin_fd)
+                    stdin_watched = False
+
+            if (self.show_prompt == False and self.prompt != None):
+                self.show_prompt = True
+                self.write_output(self.to_bytes(self.prompt))
+            for port in (self.out_port, self.err_port):
+                if port != None:
+                    port.flush()
 
-        self.out_port.write('catch_input()\n')
-        queue.closed = True
-        pipe.stdin.close()
-        return
+            for (key, mask) in sel.select(self.check_deadline()):
+                fd = key.fd
+                if fd == stdin_fd:
+                    if not self.flush_input(fd):
+                        close_stdin = True
+                    continue
+
+                try:
+                    count = os.readv(fd, [read_buf])
+                except (IOError, OSError):
+                    count = 0
+                data = read_view[:count]
+                if key.data == self.CHANNEL_WAKEUP:
+                    continue
+                elif key.data == self.CHANNEL_INPUT:
+                    if len(data) == 0:
+                        sel.unregister(fd)
+                        close_stdin = True
+                    else:
+                        self.handle_input(in_buf, data)
+                elif len(data) == 0:
+                    sel.unregister(fd)
+                    self.handle_eof(key.data, buffers[fd])
+                    del buffers[fd]
+                else:
+                    self.handle_output(key.data, buffers[fd], data)
+
+        sel.close()
+        if stdin_open:
+            pipe.stdin.close()
+        pipe.stdout.close()
+        pipe.stderr.close()
+        pipe.wait()
+        with self.lock:
+            self.jobdone = True
+            self.ready.set()
+            (rfd, wfd) = self.wakeup_fds
+            self.wakeup_fds = None
+        os.close(rfd)
+        os.close(wfd)
+        self.abort_commands()
+        for port in (self.out_port, self.err_port):
+            if port != None:
+                port.flush()
 
     def start_command(self, command, prompt,
                       input_end_mark_str, output_end_mark_str,
                       input_start_first = False):
-        if (input_start_first == True):
-            self.show_prompt = True
+        self.show_prompt = input_start_first
+        self.jobdone = False
+        self.closing = False
+        self.prompt = prompt
+        self.input_end_mark = self.to_bytes(input_end_mark_str)
+        self.output_end_mark = self.to_bytes(output_end_mark_str)
+        del self.pending_input[:]
+        self.pending_commands.clear()
+        for channel in self.channel_ahead:
+            self.channel_ahead[channel] = 0
+        self.wakeup_fds = os.pipe()
+        os.set_blocking(self.wakeup_fds[1], False)
 
         self.command_pipe = Popen(command, stdin = PIPE,
                                   stdout = PIPE, stderr = PIPE,
-                                  bufsize = 1)
-        queue = Queue()
-        queue.closed = False
-        thread_stdout_queue = Thread(target = self.enqueue_output,
-                              args = (queue, self.command_pipe.stdout))
-        thread_stdout_queue.daemon = True
-        thread_stdout_queue.start()
-        thread_stderr_queue = Thread(target = self.enqueue_output,
-                              args = (queue, self.command_pipe.stderr))
-        thread_stderr_queue.daemon = True
-        thread_stderr_queue.start()
-
-        thread_input = Thread(target = self.catch_input,
-                              args = (self.command_pipe, queue,
-                                      input_end_mark_str,
-                                      input_start_first))
-        thread_input.start()
-
-        thread_output = Thread(target = self.catch_output,
-                               args = (self.command_pipe, queue,
-                                       prompt, output_end_mark_str))
-        thread_output.start()
+                                  bufsize = 0, close_fds = ON_POSIX)
+        self.ready.clear()
+        if (input_start_first == True and self.input_end_mark != None):
+            # The banner printed while loading is framed like a command
+            pending = PendingCommand()
+            self.pending_commands.append(pending)
+            self.write_end_marks(pending)
+        else:
+            self.ready.set()
+
+        self.io_thread = Thread(target = self.io_loop)
+        self.io_thread.start()
+        if input_start_first == False:
+            self.start_warmup()
+
+    def wait(self, timeout = None):
+        if self.io_thread != None:
+            self.io_thread.join(timeout)
+        return self.jobdone
 
 
 def unit_test():
@@ -138,10 +1189,50 @@ def unit_test():
                           "crash> ", True)
     """
 
+    myshell.set_error_end_mark("echo '=======================' >&2\n")
     myshell.start_command(["bash"], "$ ",
                           "echo '======================='\n",
                           "=======================")
 
 
+def benchmark(size_mb = 200):
+    """
+    Floods size_mb of output through a local bash stand-in and reports
+    the ShellIO throughput in MB/s for each way of consuming it.
+    Run as 'shellio.py bench'.
+    """
+    flood = ("yes 'ffff8800deadbeef  task_struct  crash> bt -a' | "
+             "head -c %d" % (size_mb * 1024 * 1024))
+
+    myshell = ShellIO()
+    myshell.set_input(None)
+    myshell.set_output(None)
+    myshell.start_command(["bash"], None,
+                          "echo '======================='\n",
+                          "=======================")
+    for (name, spooled) in (('result', False), ('spooled', True)):
+        start = time.perf_counter()
+        result = myshell.execute(flood, spooled).result()
+        elapsed = time.perf_counter() - start
+        sys.stdout.write('%-8s %8.1f MB/s\n' %
+                         (name, result.stdout_bytes / elapsed / 1e6))
+    myshell.close()
+    myshell.wait()
+
+    with open(os.devnull, 'w') as devnull:
+        myshell = ShellIO()
+        myshell.set_input(None)
+        myshell.set_output(devnull)
+        start = time.perf_counter()
+        myshell.start_command(["bash", "-c", flood], None, None, None)
+        myshell.wait()
+        elapsed = time.perf_counter() - start
+    sys.stdout.write('%-8s %8.1f MB/s\n' %
+                     ('out_port', size_mb * 1024 * 1024 / elapsed / 1e6))
+
+
 if __name__ == "__main__":
-    unit_test()
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unit_test()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Pool of identical ShellIO sessions for running independent commands
+on several cores at once
+
+crash itself is single threaded, so K crash processes on the same
+vmcore can work through a long list of per-task commands K times
+faster.  Commands are handed out in small chunks to whichever session
+has the least outstanding work, and results come back in submission
+order.  Pass error_end_mark_str (see ShellIO.set_error_end_mark()) so
+every result gets the stderr of its own command.
+"""
+
+import sys
+from threading import Condition
+
+from shellio import ShellIO
+
+
+class ShellIOPool:
+    chunk_size = 16
+    max_inflight = 64
+
+    def __init__(self, size, command, input_end_mark_str,
+                 output_end_mark_str, input_start_first = False,
+                 error_end_mark_str = None):
+        self.size = size
+        self.command = command
+        self.input_end_mark_str = input_end_mark_str
+        self.output_end_mark_str = output_end_mark_str
+        self.input_start_first = input_start_first
+        self.error_end_mark_str = error_end_mark_str
+        self.sessions = []
+        self.cond = Condition()
+
+    def start(self):
+        for i in range(0, self.size):
+            shell = ShellIO()
+            shell.set_input(None)
+            shell.set_output(None)
+            if self.error_end_mark_str != None:
+                shell.set_error_end_mark(self.error_end_mark_str)
+            shell.start_command(self.command, None,
+                                self.input_end_mark_str,
+                                self.output_end_mark_str,
+                                self.input_start_first)
+            self.sessions.append(shell)
+        return self
+
+    def least_loaded(self):
+        return min(self.sessions, key = lambda shell: shell.pending_count())
+
+    def notify_done(self, future):
+        with self.cond:
+            self.cond.notify_all()
+
+    def dispatch(self, command_list, timeout = None):
+        """
+        Sends command_list to the least loaded session, waiting while
+        every session already has max_inflight commands outstanding.
+        timeout interrupts each command as in ShellIO.execute_batch().
+        """
+        with self.cond:
+            while True:
+                shell = self.least_loaded()
+                if shell.pending_count() < self.max_inflight:
+                    break
+                self.cond.wait()
+        future_list = shell.execute_batch(command_list, False, timeout)
+        for future in future_list:
+            future.add_done_callback(self.notify_done)
+        return future_list
+
+    def execute(self, command, timeout = None):
+        return self.dispatch([command], timeout)[0]
+
+    def execute_batch(self, command_list, chunk_size = None,
+                      timeout = None):
+        """
+        Returns one Future per command, in order.  Chunks are dispatched
+        as sessions drain, so a session stuck on a slow command is not
+        handed more work than the others.
+        """
+        if chunk_size == None:
+            chunk_size = self.chunk_size
+        future_list = []
+        for start in range(0, len(command_list), chunk_size):
+            future_list.extend(
+                    self.dispatch(command_list[start:start + chunk_size],
+                                  timeout))
+        return future_list
+
+    def map(self, command_format, arg_list, timeout = None,
+            chunk_size = None):
+        """
+        Runs command_format % arg for every arg, e.g.
+        pool.map("bt %d", pid_list), and returns the CommandResult list
+        in the order of arg_list.  A command still running timeout
+        seconds after it started is interrupted and its result comes
+        back truncated, so one stuck command does not fail the map.
+        """
+        command_list = [command_format % (arg,) for arg in arg_list]
+        return [future.result() for future in
+                self.execute_batch(command_list, chunk_size, timeout)]
+
+    def close(self):
+        for shell in self.sessions:
+            shell.close()
+
+    def wait(self, timeout = None):
+        for shell in self.sessions:
+            shell.wait(timeout)
+
+
+def unit_test():
+    pool = ShellIOPool(4, ["bash"],
+                       "echo '======================='\n",
+                       "=======================", False,
+                       "echo '=======================' >&2\n").start()
+    for result in pool.map("x=%d; echo $x; echo error $x >&2",
+                           range(0, 10)):
+        sys.stdout.write(result.stdout + result.stderr)
+    pool.close()
+    pool.wait()
+
+
+if __name__ == "__main__":
+    unit_test()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+Disk spooled, line indexed text buffer
+
+Command output is appended to an unnamed temporary file while an
+array of line start offsets is built on the fly.  Lines are read back
+through mmap only when asked for, so a multi-GB 'log' or 'foreach bt'
+costs 8 bytes of memory per line no matter how long the lines are.
+"""
+
+import sys
+import mmap
+import tempfile
+from array import array
+from itertools import accumulate
+from threading import Lock
+
+
+class SpoolBuffer:
+    encoding = 'utf-8'
+
+    def __init__(self, spool_dir = None):
+        self.file = tempfile.TemporaryFile(dir = spool_dir)
+        # offsets[i] is where line i starts; the last entry is where
+        # the next line will start
+        self.offsets = array('Q', [0])
+        self.size = 0
+        self.flushed_size = 0
+        self.max_width = 0
+        self.map = None
+        self.map_size = 0
+        self.lock = Lock()
+
+    def append(self, data):
+        with self.lock:
+            self.file.write(data)
+            base = self.size
+            self.size = base + len(data)
+            # split() and accumulate() keep the per-line work in C
+            length_list = [len(part) + 1 for part in data.split(b'\n')]
+            length_list.pop()
+            if len(length_list) > 0:
+                widest = max(length_list) - 1
+                first_width = base - self.offsets[-1] + length_list[0] - 1
+                if first_width > widest:
+                    widest = first_width
+                if widest > self.max_width:
+                    self.max_width = widest
+                offset_iter = accumulate(length_list, initial = base)
+                next(offset_iter)
+                self.offsets.extend(offset_iter)
+            # The unterminated last line is shown too
+            if self.size - self.offsets[-1] > self.max_width:
+                self.max_width = self.size - self.offsets[-1]
+
+    def __len__(self):
+        count = len(self.offsets) - 1
+        if self.size > self.offsets[-1]:
+            count = count + 1
+        return count
+
+    def remap(self):
+        if self.flushed_size < self.size:
+            self.file.flush()
+            self.flushed_size = self.size
+        if self.map_size < self.flushed_size:
+            if self.map != None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.flushed_size,
+                                 access = mmap.ACCESS_READ)
+            self.map_size = self.flushed_size
+
+    def line_bytes(self, index):
+        start = self.offsets[index]
+        if index + 1 < len(self.offsets):
+            end = self.offsets[index + 1] - 1
+        else:
+            end = self.size
+        if end <= start:
+            return b''
+        return self.map[start:end]
+
+    def __getitem__(self, index):
+        with self.lock:
+            count = len(self)
+            if isinstance(index, slice):
+                index_list = range(*index.indices(count))
+            else:
+                if index < 0:
+                    index = index + count
+                if index < 0 or index >= count:
+                    raise IndexError('spool line out of range')
+                index_list = None
+
+            self.remap()
+            if index_list == None:
+                return self.line_bytes(index).decode(self.encoding, 'replace')
+            return [self.line_bytes(i).decode(self.encoding, 'replace')
+                    for i in index_list]
+
+    def __iter__(self):
+        count = len(self)
+        for start in range(0, count, 1024):
+            for line in self[start:min(start + 1024, count)]:
+                yield line
+
+    def read(self):
+        with self.lock:
+            self.remap()
+            if self.map == None:
+                return ''
+            return self.map[:self.size].decode(self.encoding, 'replace')
+
+    def close(self):
+        with self.lock:
+            if self.map != None:
+                self.map.close()
+                self.map = None
+            self.file.close()
+
+
+class RingBuffer:
+    """
+    Keeps the last 'capacity' lines of a running command in memory.
+    Appending is amortized O(1) and never waits on a reader; 'dropped'
+    counts lines that fell off the front and 'version' changes on every
+    append so a viewer can tell when to redraw.
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, capacity = 100000):
+        self.capacity = capacity
+        self.lines = []
+        self.head = 0
+        self.dropped = 0
+        self.partial = b''
+        self.max_width = 0
+        self.version = 0
+        self.lock = Lock()
+
+    def push(self, line):
+        if len(line) > self.max_width:
+            self.max_width = len(line)
+        if len(self.lines) < self.capacity:
+            self.lines.append(line)
+        else:
+            self.lines[self.head] = line
+            self.head = (self.head + 1) % self.capacity
+            self.dropped = self.dropped + 1
+
+    def append(self, data):
+        part_list = (self.partial + data).split(b'\n')
+        with self.lock:
+            self.partial = part_list.pop()
+            for part in part_list:
+                self.push(part.decode(self.encoding, 'replace'))
+            # The unterminated last line is shown too
+            if len(self.partial) > self.max_width:
+                self.max_width = len(self.partial)
+            self.version = self.version + 1
+
+    def __len__(self):
+        if len(self.partial) > 0:
+            return len(self.lines) + 1
+        return len(self.lines)
+
+    def line(self, index):
+        if index == len(self.lines):
+            return self.partial.decode(self.encoding, 'replace')
+        return self.lines[(self.head + index) % len(self.lines)]
+
+    def __getitem__(self, index):
+        with self.lock:
+            count = len(self)
+            if isinstance(index, slice):
+                return [self.line(i)
+                        for i in range(*index.indices(count))]
+            if index < 0:
+                index = index + count
+            if index < 0 or index >= count:
+                raise IndexError('ring line out of range')
+            return self.line(index)
+
+    def read(self):
+        return '\n'.join(self[:])
+
+
+def unit_test():
+    buf = SpoolBuffer()
+    for i in range(0, 100000):
+        buf.append(b'line %d\n' % i)
+    buf.append(b'no newline yet')
+    buf.append(b', still none')
+    sys.stdout.write('%d lines, max width %d\n' % (len(buf), buf.max_width))
+    assert buf.max_width == len(buf[-1])
+    sys.stdout.write('%s\n' % buf[50000:50003])
+    sys.stdout.write('%s\n' % buf[-1])
+    buf.close()
+
+    ring = RingBuffer(1000)
+    for i in range(0, 2500):
+        ring.append(b'line %d\n' % i)
+    sys.stdout.write('%d lines kept, %d dropped, first %s\n' %
+                     (len(ring), ring.dropped, ring[0]))
+
+
+if __name__ == "__main__":
+    unit_test()
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+
+"""
+Compressed, indexed session transcripts and replay
+
+A TranscriptWriter handed to ShellIO.set_recorder() stores every
+command result as it is framed: stdout in zlib compressed chunks of
+whole lines, then one record with the command, stderr, sizes and
+timing.  An index of all commands is written at the end, so opening a
+transcript reads the trailer and the index and nothing else.  A
+transcript cut short by a crash is indexed by scanning its records.
+
+    shell.set_recorder(TranscriptWriter('session.ctr'))
+    ...
+    shell.recorder.close()
+
+ReplayShellIO serves execute() from a transcript with no child process
+at all.  A command recorded several times is answered with its
+recordings in order, so a replayed session sees what the original one
+saw.  Large outputs come back as a TranscriptLines view that only
+inflates the chunks being looked at.
+
+    shell = ReplayShellIO('session.ctr')
+    shell.start_command(None, None, None, None)
+    result = shell.execute('ps').result()
+
+Given a port with set_input(), it also plays back an interactive
+session: every line read is answered on out_port (stderr on err_port
+when set) and followed by the prompt passed to start_command().
+
+File layout: MAGIC, then records of a 9 byte header (kind, compressed
+length, raw length) and a zlib payload, then the trailer (index record
+offset, TRAILER_MAGIC).
+"""
+
+import os, sys, time
+import json
+import zlib
+import struct
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+from queue import Queue
+from threading import Thread, Lock
+
+from shellio import ShellIO, CommandResult
+from resultcache import normalize_command, command_name, CONTEXT_COMMANDS
+
+MAGIC = b'crashat transcript 1\n'
+TRAILER_MAGIC = b'CTIX'
+RECORD_HEADER = struct.Struct('<cII')
+TRAILER = struct.Struct('<Q4s')
+
+KIND_INFO = b'H'
+KIND_DATA = b'D'
+KIND_COMMAND = b'C'
+KIND_INDEX = b'I'
+
+
+def chunk_info(data):
+    """
+    Returns (lines, widest line) of a chunk of whole lines, counting
+    an unterminated last line like spool.SpoolBuffer does.
+    """
+    part_list = data.split(b'\n')
+    if len(part_list[-1]) == 0:
+        part_list.pop()
+    if len(part_list) == 0:
+        return (0, 0)
+    return (len(part_list), max(map(len, part_list)))
+
+
+class TranscriptWriter:
+    """
+    Records results passed on by ShellIO.  All compression and file
+    writes happen in a writer thread; the I/O thread only queues the
+    blocks it has already read.
+    """
+    # Uncompressed stdout per chunk, cut at a line end
+    chunk_size = 1024 * 1024
+    level = 1
+
+    def __init__(self, path, info = None):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.index = []
+        self.open_results = {}
+        self.queue = Queue(256)
+        self.closed = False
+        data = dict(info or {})
+        data.setdefault('created', time.time())
+        self.write_record(KIND_INFO, json.dumps(data).encode('utf-8'))
+        self.writer_thread = Thread(target = self.writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    # Called from ShellIO
+
+    def add_output(self, result, channel, block):
+        # stderr is taken from the finished result
+        if channel == ShellIO.CHANNEL_STDOUT:
+            self.queue.put(('output', result, block))
+
+    def finish(self, result):
+        self.queue.put(('finish', result, None))
+
+    def discard(self, result):
+        self.queue.put(('discard', result, None))
+
+    def record(self, result):
+        """
+        Records a result that did not come through the pipe, e.g. one
+        served from the result cache.
+        """
+        self.queue.put(('record', result, None))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(('close', None, None))
+        self.writer_thread.join()
+
+    # Writer thread
+
+    def write_record(self, kind, data):
+        payload = zlib.compress(data, self.level)
+        offset = self.offset
+        self.file.write(RECORD_HEADER.pack(kind, len(payload), len(data)))
+        self.file.write(payload)
+        self.offset += RECORD_HEADER.size + len(payload)
+        return (offset, len(payload), len(data))
+
+    def write_chunk(self, chunk_list, data):
+        (offset, length, size) = self.write_record(KIND_DATA, bytes(data))
+        (lines, width) = chunk_info(data)
+        chunk_list.append([offset, length, size, lines, width])
+
+    def take_output(self, state, final = False):
+        (buf, chunk_list) = state
+        while len(buf) >= self.chunk_size:
+            cut = buf.rfind(b'\n', 0, self.chunk_size) + 1
+            if cut == 0:
+                cut = buf.find(b'\n', self.chunk_size) + 1
+                if cut == 0:
+                    break
+            self.write_chunk(chunk_list, buf[:cut])
+            del buf[:cut]
+        if final and len(buf) > 0:
+            self.write_chunk(chunk_list, buf)
+            del buf[:]
+
+    def write_command(self, result, chunk_list):
+        start = result.start_time or result.submit_time
+        meta = {'command': result.command,
+                'stderr': result.stderr,
+                'stdout_bytes': result.stdout_bytes,
+                'stderr_bytes': result.stderr_bytes,
+                'elapsed': result.elapsed,
+                'truncated': result.truncated,
+                'cached': result.cached,
+                'lines': sum(chunk[3] for chunk in chunk_list),
+                'events': [(sequence, when - start, channel, length)
+                           for (sequence, when, channel, length)
+                           in result.events],
+                'chunks': chunk_list}
+        (offset, length, size) = self.write_record(
+                KIND_COMMAND, json.dumps(meta).encode('utf-8'))
+        self.index.append(index_entry(meta, offset))
+        # Finished commands survive a session that never closes us
+        self.file.flush()
+
+    def writer_loop(self):
+        while True:
+            (op, result, data) = self.queue.get()
+            if op == 'output':
+                state = self.open_results.get(result)
+                if state == None:
+                    state = self.open_results[result] = (bytearray(), [])
+                state[0].extend(data)
+                if len(state[0]) >= self.chunk_size:
+                    self.take_output(state)
+            elif op == 'finish':
+                state = self.open_results.pop(result, None)
+                if state == None:
+                    state = (bytearray(), [])
+                self.take_output(state, True)
+                self.write_command(result, state[1])
+            elif op == 'discard':
+                self.open_results.pop(result, None)
+            elif op == 'record':
+                state = (bytearray(result.text().encode(result.encoding)),
+                         [])
+                self.take_output(state, True)
+                self.write_command(result, state[1])
+            elif op == 'close':
+                break
+        (offset, length, size) = self.write_record(
+                KIND_INDEX, json.dumps(self.index).encode('utf-8'))
+        self.file.write(TRAILER.pack(offset, TRAILER_MAGIC))
+        self.file.close()
+
+
+def index_entry(meta, offset):
+    return {'command': meta['command'], 'record': offset,
+            'stdout_bytes': meta['stdout_bytes'],
+            'stderr_bytes': meta['stderr_bytes'],
+            'lines': meta['lines'], 'elapsed': meta['elapsed']}
+
+
+class Transcript:
+    """
+    Read side of a transcript.  Records are read with pread(), so
+    results and line views may be used from several threads.
+    """
+    # Outputs up to this size are inflated into result.stdout; bigger
+    # ones are served through TranscriptLines
+    inline_bytes = 4 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        if os.pread(self.fd, len(MAGIC), 0) != MAGIC:
+            os.close(self.fd)
+            raise ValueError('%s is not a crashat transcript' % path)
+        self.info = json.loads(self.read_record(len(MAGIC))[1])
+        self.size = os.fstat(self.fd).st_size
+        self.complete = True
+        try:
+            self.index = self.load_index()
+        except (ValueError, zlib.error, struct.error):
+            self.complete = False
+            self.index = self.scan_index()
+        self.by_command = {}
+        for (i, entry) in enumerate(self.index):
+            self.by_command.setdefault(normalize_command(entry['command']),
+                                       []).append(i)
+
+    def read_record(self, offset):
+        header = os.pread(self.fd, RECORD_HEADER.size, offset)
+        (kind, length, size) = RECORD_HEADER.unpack(header)
+        payload = os.pread(self.fd, length, offset + RECORD_HEADER.size)
+        if len(payload) != length:
+            raise ValueError('record at %d is cut short' % offset)
+        return (kind, zlib.decompress(payload))
+
+    def load_index(self):
+        trailer = os.pread(self.fd, TRAILER.size, self.size - TRAILER.size)
+        (offset, magic) = TRAILER.unpack(trailer)
+        if magic != TRAILER_MAGIC:
+            raise ValueError('no index')
+        (kind, data) = self.read_record(offset)
+        if kind != KIND_INDEX:
+            raise ValueError('no index')
+        return json.loads(data)
+
+    def scan_index(self):
+        """
+        Rebuilds the index of a transcript whose writer never got to
+        close it, from the command records.
+        """
+        index = []
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= self.size:
+            header = os.pread(self.fd, RECORD_HEADER.size, offset)
+            (kind, length, size) = RECORD_HEADER.unpack(header)
+            if kind == KIND_COMMAND:
+                try:
+                    meta = json.loads(self.read_record(offset)[1])
+                except (ValueError, zlib.error):
+                    break
+                index.append(index_entry(meta, offset))
+            elif kind not in (KIND_INFO, KIND_DATA, KIND_INDEX):
+                break
+            offset += RECORD_HEADER.size + length
+        return index
+
+    def __len__(self):
+        return len(self.index)
+
+    def commands(self):
+        return [entry['command'] for entry in self.index]
+
+    def find(self, command, occurrence = 0):
+        """
+        Returns the index of the given recording of command; past the
+        last one, the last one.  None when it was never recorded.
+        """
+        index_list = self.by_command.get(normalize_command(command))
+        if index_list == None:
+            return None
+        return index_list[min(occurrence, len(index_list) - 1)]
+
+    def read_chunk(self, chunk):
+        (kind, data) = self.read_record(chunk[0])
+        return data
+
+    def result(self, index):
+        (kind, data) = self.read_record(self.index[index]['record'])
+        meta = json.loads(data)
+        # stdout is filled in below, from the chunks
+        meta['stdout'] = None
+        result = CommandResult.from_dict(meta)
+        # Not produced by a live child
+        result.cached = True
+        if meta['stdout_bytes'] > self.inline_bytes:
+            result.spool = TranscriptLines(self, meta['chunks'])
+            result.stdout = None
+        else:
+            result.stdout = b''.join(
+                    self.read_chunk(chunk)
+                    for chunk in meta['chunks']).decode(result.encoding,
+                                                        'replace')
+        return result
+
+    def close(self):
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class TranscriptLines:
+    """
+    Lines of one recorded output, read like a spool.SpoolBuffer.  Only
+    the chunks holding requested lines are inflated, and the last few
+    are kept.
+    """
+    encoding = 'utf-8'
+    cached_chunks = 4
+
+    def __init__(self, transcript, chunk_list):
+        self.transcript = transcript
+        self.chunk_list = chunk_list
+        self.starts = list(accumulate([chunk[3] for chunk in chunk_list],
+                                      initial = 0))
+        self.max_width = max([chunk[4] for chunk in chunk_list] or [0])
+        self.size = sum(chunk[2] for chunk in chunk_list)
+        self.chunks = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def chunk_lines(self, number):
+        line_list = self.chunks.get(number)
+        if line_list != None:
+            self.chunks.move_to_end(number)
+            return line_list
+        data = self.transcript.read_chunk(self.chunk_list[number])
+        line_list = data.decode(self.encoding, 'replace').split('\n')
+        if data.endswith(b'\n'):
+            line_list.pop()
+        self.chunks[number] = line_list
+        if len(self.chunks) > self.cached_chunks:
+            self.chunks.popitem(last = False)
+        return line_list
+
+    def line_range(self, start, end):
+        line_list = []
+        while start < end:
+            number = bisect_right(self.starts, start) - 1
+            chunk_start = self.starts[number]
+            chunk_end = min(end, self.starts[number + 1])
+            line_list.extend(self.chunk_lines(number)[start - chunk_start:
+                                                      chunk_end - chunk_start])
+            start = chunk_end
+        return line_list
+
+    def __getitem__(self, index):
+        with self.lock:
+            count = len(self)
+            if isinstance(index, slice):
+                (start, stop, step) = index.indices(count)
+                if step == 1:
+                    return self.line_range(start, max(start, stop))
+                return [self.line_range(i, i + 1)[0]
+                        for i in range(start, stop, step)]
+            if index < 0:
+                index = index + count
+            if index < 0 or index >= count:
+                raise IndexError('transcript line out of range')
+            return self.line_range(index, index + 1)[0]
+
+    def __iter__(self):
+        for number in range(0, len(self.chunk_list)):
+            with self.lock:
+                line_list = self.chunk_lines(number)
+            for line in line_list:
+                yield line
+
+    def read(self):
+        return b''.join(self.transcript.read_chunk(chunk)
+                        for chunk in self.chunk_list).decode(self.encoding,
+                                                             'replace')
+
+    def close(self):
+        with self.lock:
+            self.chunks.clear()
+
+
+class ReplayShellIO(ShellIO):
+    """
+    ShellIO answering every command from a transcript, with no child.
+    Commands that were never recorded get an error on stderr.
+    """
+    # Unlike ShellIO, only interactive when set_input() is given a port
+    in_port = None
+
+    def __init__(self, transcript):
+        ShellIO.__init__(self)
+        if not isinstance(transcript, Transcript):
+            transcript = Transcript(transcript)
+        self.transcript = transcript
+        self.occurrences = {}
+
+    def start_command(self, command, prompt,
+                      input_end_mark_str, output_end_mark_str,
+                      input_start_first = False):
+        self.jobdone = False
+        self.closing = False
+        self.prompt = prompt
+        self.ready.set()
+        self.start_warmup()
+        if self.in_port != None:
+            self.io_thread = Thread(target = self.serve_input)
+            self.io_thread.daemon = True
+            self.io_thread.start()
+
+    def serve_input(self):
+        """
+        Answers each line read from in_port as the child would have in
+        interactive mode, until EOF or close().
+        """
+        while True:
+            if self.prompt != None:
+                self.write_output(self.to_bytes(self.prompt))
+            for port in (self.out_port, self.err_port):
+                if port != None:
+                    port.flush()
+            try:
+                line = self.in_port.readline()
+            except (IOError, OSError, ValueError):
+                break
+            if len(line) == 0 or self.jobdone == True:
+                break
+            command = line.strip()
+            if len(command) == 0:
+                continue
+            result = self.execute(command).result()
+            self.write_output(self.to_bytes(result.text()))
+            if len(result.stderr) > 0:
+                self.write_output(self.to_bytes(result.stderr),
+                                  self.CHANNEL_STDERR)
+        self.jobdone = True
+
+    def replay(self, command):
+        key = normalize_command(command)
+        with self.lock:
+            occurrence = self.occurrences.get(key, 0)
+            self.occurrences[key] = occurrence + 1
+        index = self.transcript.find(command, occurrence)
+        if index == None:
+            result = CommandResult(command)
+            result.start_time = time.monotonic()
+            message = 'replay: %r is not in %s\n' % (command,
+                                                   self.transcript.path)
+            result.add_output(self.CHANNEL_STDERR,
+                              message.encode(self.encoding))
+            result.finish(self.encoding)
+            return result
+        return self.transcript.result(index)
+
+    def execute_batch(self, command_list, spooled = False, timeout = None):
+        if self.jobdone == True:
+            raise IOError('command pipe is not running')
+        future_list = []
+        for command in command_list:
+            command = command.rstrip('\n')
+            if command_name(command) in CONTEXT_COMMANDS:
+                # Prefetches answer until the context changes, as in
+                # ShellIO.command_key()
+                self.prefetch_futures.clear()
+            future = None
+            if spooled is False:
+                future = self.prefetch_futures.get(normalize_command(command))
+            if future == None:
+                result = self.replay(command)
+                if spooled is not False and spooled is not True:
+                    # A buffer a viewer follows, e.g. spool.RingBuffer
+                    spooled.append(result.text().encode(result.encoding))
+                    result.spool = spooled
+                    result.stdout = None
+                future = self.new_future()
+                future.set_result(result)
+            future_list.append(future)
+        return future_list
+
+    def prefetch(self, command_list):
+        future_list = []
+        for command in command_list:
+            key = normalize_command(command)
+            future = self.prefetch_futures.get(key)
+            if future == None:
+                future = self.prefetch_futures[key] = \
+                        self.execute_batch([command])[0]
+            future_list.append(future)
+        return future_list
+
+    def cancel(self, future = None):
+        return False
+
+    def close(self):
+        self.jobdone = True
+
+    def wait(self, timeout = None):
+        if self.io_thread != None:
+            self.io_thread.join(timeout)
+        return self.jobdone
+
+
+def unit_test():
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'session.ctr')
+    # Small enough for the test output to span several chunks
+    TranscriptWriter.chunk_size = 65536
+    Transcript.inline_bytes = 65536
+    myshell = ShellIO()
+    myshell.set_input(None)
+    myshell.set_output(None)
+    myshell.set_recorder(TranscriptWriter(path, {'command': 'bash'}))
+    myshell.start_command(["bash"], None,
+                          "echo '======================='\n",
+                          "=======================")
+    command_list = ['echo first', 'seq 1 200000', 'echo oops >&2',
+                    'echo first']
+    live_list = myshell.run_batch(command_list)
+    myshell.close()
+    myshell.wait()
+    myshell.recorder.close()
+    sys.stdout.write('%d bytes on disk for %d bytes of output\n' %
+                     (os.path.getsize(path),
+                      sum(result.stdout_bytes for result in live_list)))
+
+    start = time.perf_counter()
+    replay = ReplayShellIO(path)
+    replay.start_command(None, None, None, None)
+    replay_list = replay.run_batch(command_list + ['never run'])
+    elapsed = time.perf_counter() - start
+    for (live, replayed) in zip(live_list, replay_list):
+        assert live.text() == replayed.text(), live.command
+        assert live.stderr == replayed.stderr, live.command
+    big = replay_list[1].lines()
+    assert isinstance(big, TranscriptLines)
+    assert len(big) == 200000
+    assert big[99999:100002] == ['100000', '100001', '100002']
+    sys.stdout.write('replayed %d commands in %.1fms: %r\n' %
+                     (len(replay_list), elapsed * 1000, replay_list[-1]))
+    sys.stdout.write('%s' % replay_list[-1].stderr)
+
+    import io
+    replay = ReplayShellIO(path)
+    replay.set_input(io.StringIO('echo first\nnever run\n'))
+    output = io.StringIO()
+    replay.set_output(output)
+    replay.start_command(None, '$ ', None, None)
+    replay.wait()
+    assert output.getvalue() == ("$ first\n$ replay: 'never run' is not "
+                                 "in %s\n$ " % path), output.getvalue()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        transcript = Transcript(sys.argv[1])
+        sys.stdout.write('%s%s\n' % (json.dumps(transcript.info),
+                                     '' if transcript.complete
+                                     else ' (not closed)'))
+        for entry in transcript.index:
+            sys.stdout.write('%10d %8d %8.3fs  %s\n' %
+                             (entry['stdout_bytes'], entry['lines'],
+                              entry['elapsed'], entry['command']))
+    else:
+        unit_test()
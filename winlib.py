@@ -1,21 +1,198 @@
 #!/usr/bin/env python
 
 import curses
-import os
+import os, sys, time
+import re
+from bisect import bisect_left, bisect_right
+from threading import Thread, Event
+
+from spool import RingBuffer
+
+def row_text(text_msg, xpos, width):
+    if (len(text_msg) < xpos):
+        text_msg = ""
+    else:
+        text_msg = text_msg[xpos:]
+    return text_msg.ljust(width)[:width]
+
+
+def highlight_row(screen, y, x, text_msg, xpos, width, regex, color):
+    for match in regex.finditer(text_msg):
+        if match.start() >= xpos + width:
+            break
+        start = max(match.start(), xpos)
+        end = min(match.end(), xpos + width)
+        if end > start:
+            screen.chgat(y, x + start - xpos, end - start, color)
+
+
+class TextSearch:
+    """
+    Scans string_list for a regex in a worker thread.  Matching line
+    numbers are appended in order, so the index stays sorted while it
+    grows and next_match()/prev_match() are binary searches that work
+    before the scan has finished.
+    """
+    block_size = 4096
+
+    def __init__(self, string_list, pattern):
+        try:
+            self.regex = re.compile(pattern)
+        except re.error:
+            self.regex = re.compile(re.escape(pattern))
+        self.string_list = string_list
+        self.matches = []
+        self.done = False
+        self.cancelled = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target = self.scan)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def scan(self):
+        search = self.regex.search
+        count = len(self.string_list)
+        for start in range(0, count, self.block_size):
+            if self.cancelled.is_set():
+                return
+            block = self.string_list[start:min(start + self.block_size,
+                                               count)]
+            for i in range(0, len(block)):
+                if search(block[i]):
+                    self.matches.append(start + i)
+        self.done = True
+
+    def next_match(self, line, wrap = True):
+        index = bisect_right(self.matches, line)
+        if index < len(self.matches):
+            return self.matches[index]
+        if wrap and self.done and len(self.matches) > 0:
+            return self.matches[0]
+        return None
+
+    def prev_match(self, line, wrap = True):
+        index = bisect_left(self.matches, line)
+        if index > 0:
+            return self.matches[index - 1]
+        if wrap and self.done and len(self.matches) > 0:
+            return self.matches[-1]
+        return None
+
+
+class TextRenderer:
+    """
+    Draws string_list into its own window and remembers what is on
+    every row, so a redraw only writes rows whose text changed.  A
+    vertical move of less than a page scrolls the window and draws
+    just the rows that came into view.  Nothing reaches the terminal
+    until the caller runs noutrefresh() and curses.doupdate().
+    """
+    def __init__(self, win, width, height, text_color):
+        self.win = win
+        self.width = width
+        self.height = height
+        self.text_color = text_color
+        self.rows = [None] * height
+        self.xpos = self.ypos = None
+        self.highlight = None
+        self.win.idlok(1)
+        self.win.scrollok(0)
+
+    def scroll(self, delta):
+        self.win.scrollok(1)
+        self.win.scroll(delta)
+        self.win.scrollok(0)
+        if delta > 0:
+            self.rows = self.rows[delta:] + [None] * delta
+        else:
+            self.rows = [None] * -delta + self.rows[:delta]
+
+    def render(self, string_list, xpos, ypos, highlight = None):
+        if highlight is not self.highlight:
+            self.highlight = highlight
+            self.rows = [None] * self.height
+        if self.ypos != None and self.xpos == xpos:
+            delta = ypos - self.ypos
+            if delta != 0 and abs(delta) < self.height:
+                self.scroll(delta)
+
+        visible_list = string_list[ypos:ypos + self.height]
+        drawn = 0
+        for i in range(0, self.height):
+            if (i >= len(visible_list)):
+                line = ""
+            else:
+                line = visible_list[i]
+            text_msg = row_text(line, xpos, self.width)
+            if self.rows[i] == text_msg:
+                continue
+            self.rows[i] = text_msg
+            drawn = drawn + 1
+            try:
+                self.win.addstr(i, 0, text_msg, self.text_color)
+            except curses.error:
+                # Writing the bottom right cell moves the cursor off
+                # the window, but the text is drawn
+                pass
+            if highlight != None:
+                highlight_row(self.win, i, 0, line, xpos, self.width,
+                              highlight, self.text_color ^ curses.A_REVERSE)
+
+        self.xpos = xpos
+        self.ypos = ypos
+        return drawn
+
+
+class Palette:
+    """
+    Color pairs set up on first use instead of all at start.  Pair n
+    is color n - 1 on the terminal's default background, the numbering
+    init_winlib() always used, so attributes look the same as before.
+    """
+    def __init__(self):
+        self.attrs = {}
+
+    def pair(self, number):
+        attr = self.attrs.get(number)
+        if attr == None:
+            if 0 < number <= curses.COLORS:
+                curses.init_pair(number, number - 1, -1)
+            attr = self.attrs[number] = curses.color_pair(number)
+        return attr
+
 
 class PyWindow:
     KEY_LEFT_PRESSED = 0x100000
     KEY_RIGHT_PRESSED = 0x200000
     KEY_ESCAPE_PRESSED = 0x300000
     stdscr = 0
+    follow_fps = 30
+    # A metrics.Metrics object; None keeps instrumentation off
+    metrics = None
+    # An xref.XrefIndex for the 'x' key in text_viewer
+    xref = None
 
     def __init__(self):
+        self.layers = []
+        self.palette = Palette()
         try:
             os.environ['ESCDELAY']
         except KeyError:
             os.environ['ESCDELAY'] = '25'
 
-    def init_winlib(self):
+    def init_winlib(self, eager_colors = False):
+        """
+        Color pairs are set up as color_pair() asks for them, so the
+        first frame does not wait for hundreds of init_pair() calls.
+        eager_colors sets them all up at once, for code that still uses
+        curses.color_pair() directly.
+        """
         self.stdscr = curses.initscr()
         curses.noecho()
         curses.cbreak()
@@ -23,8 +200,37 @@ class PyWindow:
         self.stdscr.keypad(1)
         curses.start_color()
         curses.use_default_colors()
-        for i in range(0, curses.COLORS):
-            curses.init_pair(i + 1, i, -1)
+        self.palette = Palette()
+        if eager_colors:
+            for i in range(0, curses.COLORS):
+                self.palette.pair(i + 1)
+
+
+    def color_pair(self, number):
+        return self.palette.pair(number)
+
+
+    def set_metrics(self, metrics):
+        """
+        Counts redraws of every widget and how long each one took in a
+        metrics.Metrics object.
+        """
+        self.metrics = metrics
+
+
+    def set_xref(self, xref):
+        """
+        Lets text_viewer follow addresses and symbols on screen through
+        an attached xref.XrefIndex.
+        """
+        self.xref = xref
+
+
+    def record_draw(self, name, start):
+        # Only called when self.metrics is set
+        self.metrics.incr('winlib.%s.redraws' % name)
+        self.metrics.observe('winlib.%s.draw_ms' % name,
+                             (time.perf_counter() - start) * 1000)
 
 
     def exit_winlib(self):
@@ -49,10 +255,10 @@ class PyWindow:
         if (y + height - 1 > maxy):
             height = maxy - y - 1
 
-        for x1 in range(0, width):
-            for y1 in range(0, height):
-                screen.addch(y + y1, x + x1, ' ',
-                            color | curses.A_REVERSE)
+        # One addstr per row instead of one addch per cell
+        row = ' ' * width
+        for y1 in range(0, height):
+            screen.addstr(y + y1, x, row, color | curses.A_REVERSE)
 
 
     def draw_box(self, screen, x, y, width, height, color = 0):
@@ -74,17 +280,21 @@ class PyWindow:
         screen.addch(y, x + width - 1, '+', color)
         screen.addch(y + height - 1, x + width - 1, '+', color)
 
-        for x1 in range(1, width - 1):
-            screen.addch(y, x + x1, '-', color)
-            screen.addch(y + height - 1, x + x1, '-', color)
+        if width > 2:
+            screen.hline(y, x + 1, ord('-') | color, width - 2)
+            screen.hline(y + height - 1, x + 1, ord('-') | color, width - 2)
 
-        for y1 in range(1, height - 1):
-            screen.addch(y + y1, x, '|', color)
-            screen.addch(y + y1, x + width - 1, '|', color)
+        if height > 2:
+            screen.vline(y + 1, x, ord('|') | color, height - 2)
+            screen.vline(y + 1, x + width - 1, ord('|') | color, height - 2)
 
     def fill_box(self, screen, x, y, width, height, color = 0):
+        if self.metrics != None:
+            start = time.perf_counter()
         self.clear_box(screen, x, y, width, height, color)
         self.draw_box(screen, x, y, width, height, color | curses.A_REVERSE)
+        if self.metrics != None:
+            self.record_draw('fill_box', start)
 
 
     def hmenu(self, screen, x, y, width, menu_list,
@@ -104,6 +314,8 @@ class PyWindow:
         if (x + width > maxx):
             width = maxx - x
 
+        if self.metrics != None:
+            start = time.perf_counter()
         count = 0
         selected_color = selected_color | curses.A_REVERSE
         normal_color = normal_color | curses.A_REVERSE
@@ -115,8 +327,12 @@ class PyWindow:
         expand_key = 0
         screen.addstr(y + selected_item, x, menu_list[selected_item],
                     selected_color)
+        if self.metrics != None:
+            self.record_draw('hmenu', start)
         while True:
             c = screen.getch()
+            if self.metrics != None:
+                start = time.perf_counter()
             screen.addstr(y + selected_item, x,
                         menu_list[selected_item], normal_color)
             if (c == curses.KEY_UP):
@@ -139,6 +355,8 @@ class PyWindow:
 
             screen.addstr(y + selected_item, x,
                         menu_list[selected_item], selected_color)
+            if self.metrics != None:
+                self.record_draw('hmenu', start)
 
         screen.addstr(y + selected_item, x,
                     menu_list[selected_item], selected_color)
@@ -159,15 +377,14 @@ class PyWindow:
             width = max_width + 2
 
         if restore_background == True:
-            saved_data = self.save_window(screen, x, y,
-                                          x + width, y + len(menu_list) + 1)
+            self.push_layer(screen, x, y, width, len(menu_list) + 2)
         self.fill_box(screen, x, y, width, len(menu_list) + 2,
                 normal_color)
         selected_item = self.hmenu(screen, x + 1, y + 1, width - 2, menu_list,
                           selected_color, normal_color,
                           vertical_keys, selected_item)
         if restore_background == True:
-            self.restore_window(screen, x, y, saved_data)
+            self.pop_layer()
 
         return selected_item
 
@@ -195,11 +412,13 @@ class PyWindow:
         if (x + xpos - 2 > maxx):
             return -2
 
+        if self.metrics != None:
+            start = time.perf_counter()
         if (draw_bar == True):
             screen.addstr(y, x, " ".ljust(width)[:width], normal_color)
 
         if (center == True):
-            x = x + width / 2 - (xpos - 2) / 2
+            x = x + width // 2 - (xpos - 2) // 2
 
         count = 0
         for item in menu_list:
@@ -208,6 +427,8 @@ class PyWindow:
 
         screen.addstr(y, x + menu_pos[selected_item],
                       menu_list[selected_item], selected_color)
+        if self.metrics != None:
+            self.record_draw('vmenu', start)
         max_item = len(menu_list)
         while True:
             if (pressed_key == 0 or pressed_key == self.KEY_ESCAPE_PRESSED):
@@ -216,6 +437,8 @@ class PyWindow:
                 c = curses.KEY_LEFT
             elif pressed_key == self.KEY_RIGHT_PRESSED:
                 c = curses.KEY_RIGHT
+            if self.metrics != None:
+                start = time.perf_counter()
 
             screen.addstr(y, x + menu_pos[selected_item],
                         menu_list[selected_item], normal_color)
@@ -235,6 +458,8 @@ class PyWindow:
 
             screen.addstr(y, x + menu_pos[selected_item],
                         menu_list[selected_item], selected_color)
+            if self.metrics != None:
+                self.record_draw('vmenu', start)
 
             if (pressed_key != 0):
                 break
@@ -246,37 +471,92 @@ class PyWindow:
 
     def dialog_msg(self, screen, x, y, width, height, color,
                 title, msg, menu_list):
-        saved_data = self.save_window(screen, x, y, width, height)
+        self.push_layer(screen, x, y, width, height)
 
         self.fill_box(screen, x, y, width, height, color)
-        screen.addstr(y, x + width / 2 - len(title) / 2,
+        screen.addstr(y, x + width // 2 - len(title) // 2,
                     title, color | curses.A_REVERSE)
         msg_list = msg.split('\n')
         count = 1
         for msg_str in msg_list:
-            screen.addstr(y + count, x + width / 2 - len(msg_str) / 2,
+            screen.addstr(y + count, x + width // 2 - len(msg_str) // 2,
                         msg_str, color | curses.A_REVERSE)
             count = count + 1
 
         selected_item = self.vmenu(screen, x + 1, y + 3, width - 2, menu_list,
-                            curses.color_pair(10), curses.color_pair(8))
-        self.restore_window(screen, x, y, saved_data)
+                            self.color_pair(10), self.color_pair(8))
+        self.pop_layer()
 
         return selected_item
 
 
-    def save_window(self, screen, x, y, width, height):
-        saved_data = []
-        for ypos in range(0, height):
-            saved_row = []
-            for xpos in range(0, width):
-                saved_row.append(screen.inch(y + ypos, x + xpos))
-            saved_data.append(saved_row)
+    def status_line(self, screen, x, y, width, text, color = 0):
+        try:
+            screen.addstr(y, x, text.ljust(width)[:width],
+                          color | curses.A_REVERSE)
+        except curses.error:
+            # The bottom right cell cannot be written without moving
+            # the cursor off the screen, but the text is drawn
+            pass
+
+
+    def wait_loading(self, screen, x, y, width, shell,
+                     message = 'loading vmcore', color = 0):
+        """
+        Keeps a status line with a spinner and the time spent up while
+        the ShellIO child starts, e.g. crash reading a dump, so the
+        rest of the frame can be drawn before it is ready.  Returns
+        True once the child is at its prompt, False if it exited or
+        the user pressed ESC.
+        """
+        start = time.monotonic()
+        spinner = '|/-\\'
+        count = 0
+        screen.nodelay(1)
+        while True:
+            self.status_line(screen, x, y, width,
+                             ' %s %s %ds' % (message, spinner[count % 4],
+                                             time.monotonic() - start),
+                             color)
+            screen.noutrefresh()
+            curses.doupdate()
+            count = count + 1
+            # Waiting on the event notices the prompt right away
+            if shell.ready.wait(0.1):
+                break
+            if screen.getch() == 27:
+                screen.nodelay(0)
+                return False
+        screen.nodelay(0)
+        self.status_line(screen, x, y, width, '', color)
+        return shell.jobdone == False
+
 
+    def save_window(self, screen, x, y, width, height):
+        """
+        Copies the area into an offscreen window with one overwrite()
+        (copywin) call.  The returned window is what restore_window() expects.
+        """
+        (maxy, maxx) = screen.getmaxyx()
+        width = min(width, maxx - x)
+        height = min(height, maxy - y)
+        if width <= 0 or height <= 0:
+            return None
+        saved_data = curses.newwin(height, width)
+        screen.overwrite(saved_data, y, x, 0, 0, height - 1, width - 1)
         return saved_data
 
 
     def restore_window(self, screen, x, y, saved_data):
+        if saved_data == None:
+            return
+        if not isinstance(saved_data, list):
+            (height, width) = saved_data.getmaxyx()
+            saved_data.overwrite(screen, 0, 0, y, x,
+                                 y + height - 1, x + width - 1)
+            return
+
+        # Cell lists saved by older callers
         ypos = 0
         for row in saved_data:
             xpos = 0
@@ -287,37 +567,46 @@ class PyWindow:
             ypos = ypos + 1
 
 
+    def push_layer(self, screen, x, y, width, height):
+        """
+        Saves what is under a popup before it is drawn.  Layers form a
+        stack, so popups opened from popups close in the right order.
+        """
+        self.layers.append((screen, x, y,
+                            self.save_window(screen, x, y, width, height)))
+
+
+    def pop_layer(self):
+        (screen, x, y, saved_data) = self.layers.pop()
+        self.restore_window(screen, x, y, saved_data)
+
+
     def text_window(self, screen, x, y, width, height, xpos, ypos,
-                    string_list, text_color=5):
+                    string_list, text_color=5, highlight=None):
+        # Only the visible rows are fetched, which matters when
+        # string_list is a disk backed spool.SpoolBuffer
+        visible_list = string_list[ypos:ypos + height]
         for i in range(0, height):
-            text_pos = ypos + i
-            if (text_pos >= len(string_list)):
+            if (i >= len(visible_list)):
                 text_msg = ""
             else:
-                text_msg = string_list[text_pos]
-                if (len(text_msg) < xpos):
-                    text_msg = ""
-                else:
-                    text_msg = text_msg[xpos:]
+                text_msg = visible_list[i]
 
-            text_msg = text_msg.ljust(width)[:width]
-            screen.addstr(y + i, x, text_msg, text_color)
+            screen.addstr(y + i, x, row_text(text_msg, xpos, width),
+                          text_color)
+            if highlight != None:
+                highlight_row(screen, y + i, x, text_msg, xpos, width,
+                              highlight, text_color ^ curses.A_REVERSE)
 
 
-    def text_viewer(self, screen, x, y, width, height,
-                    string_list, text_color=5, show_scroll=True):
-        saved_data = self.save_window(screen, x, y, width, height)
-        self.fill_box(screen, x, y, width, height, text_color)
-        t_x = x + 1
-        t_y= y + 1
-        t_width = width - 2
-        t_height = height - 2
-        xpos = ypos = 0
+    def viewer_scale(self, string_list, width, t_width, t_height):
         max_width = width
-        for i in string_list:
-            if len(i) > max_width:
-                max_width = len(i)
-        x_percent = y_percent = 0
+        if hasattr(string_list, 'max_width'):
+            max_width = max(max_width, string_list.max_width)
+        else:
+            for i in string_list:
+                if len(i) > max_width:
+                    max_width = len(i)
 
         max_width = max_width - 1
         x_scale = float(max_width) / (t_width - 1)
@@ -326,49 +615,431 @@ class PyWindow:
             x_scale = 1.0
         if y_scale == 0.0:
             y_scale = 1.0
+        return (max_width, x_scale, y_scale)
+
+
+    def text_viewer(self, screen, x, y, width, height,
+                    string_list, text_color=5, show_scroll=True,
+                    follow=None, top_line=0, search_text=None):
+        """
+        follow is the Future of a command still writing into
+        string_list (a spool.RingBuffer or SpoolBuffer).  Until it is
+        done, new lines are picked up at most follow_fps times a second
+        and the view sticks to the tail unless scrolled away from it.
+
+        The view opens at top_line with search_text highlighted and
+        ready for n/N.  With an xref index set, 'x' lists the addresses
+        and symbols on screen (see xref_menu()).
+        """
+        self.push_layer(screen, x, y, width, height)
+        self.fill_box(screen, x, y, width, height, text_color)
+        t_x = x + 1
+        t_y= y + 1
+        t_width = width - 2
+        t_height = height - 2
+        xpos = ypos = 0
+        x_percent = y_percent = -1
+        (max_width, x_scale, y_scale) = self.viewer_scale(
+                string_list, width, t_width, t_height)
+        at_tail = True
+        dropped = getattr(string_list, 'dropped', 0)
+
+        (begin_y, begin_x) = screen.getbegyx()
+        text_win = curses.newwin(t_height, t_width,
+                                 begin_y + t_y, begin_x + t_x)
+        text_win.keypad(1)
+        renderer = TextRenderer(text_win, t_width, t_height, text_color)
+        search = None
+        # Direction of a search still waiting for its first hit
+        pending_forward = None
+        if top_line > 0:
+            ypos = min(top_line, max(0, len(string_list) - 1))
+            at_tail = False
+        if search_text:
+            search = TextSearch(string_list, re.escape(search_text)).start()
+            search_forward = True
 
         while True:
-            screen.addch(y + height - 1, x + x_percent + 1,
-                         '-', text_color)
-            screen.addch(y + y_percent + 1, x + width - 1,
-                         '|', text_color)
-            self.text_window(screen, t_x, t_y, t_width, t_height,
-                        xpos, ypos, string_list, text_color)
-            x_percent = int(xpos / x_scale)
-            y_percent = int(ypos / y_scale)
-            screen.addch(y + height - 1, x + x_percent + 1,
-                         '#', text_color)
-            screen.addch(y + y_percent + 1, x + width - 1,
-                         '#', text_color)
+            if self.metrics != None:
+                start = time.perf_counter()
+            # Checked before drawing, so the frame drawn after the
+            # command finished always holds its last lines
+            following = follow != None and not follow.done()
+            if follow != None:
+                (max_width, x_scale, y_scale) = self.viewer_scale(
+                        string_list, width, t_width, t_height)
+                new_dropped = getattr(string_list, 'dropped', 0)
+                if at_tail:
+                    ypos = max(0, len(string_list) - t_height)
+                else:
+                    # Keep showing the same lines while older ones
+                    # fall off the front of the buffer
+                    ypos = max(0, ypos - (new_dropped - dropped))
+                dropped = new_dropped
+            line_count = len(string_list)
+
+            if pending_forward != None:
+                if pending_forward:
+                    found = search.next_match(ypos)
+                else:
+                    found = search.prev_match(ypos)
+                if found != None:
+                    ypos = found
+                if found != None or search.done:
+                    pending_forward = None
+
+            highlight = None
+            if search != None:
+                highlight = search.regex
+            drawn = renderer.render(string_list, xpos, ypos, highlight)
+            # Scrollbar cells are only touched when the thumb moves
+            new_percent = int(xpos / x_scale)
+            if new_percent != x_percent:
+                if x_percent >= 0:
+                    screen.addch(y + height - 1, x + x_percent + 1,
+                                 '-', text_color)
+                x_percent = new_percent
+                screen.addch(y + height - 1, x + x_percent + 1,
+                             '#', text_color)
+            new_percent = int(ypos / y_scale)
+            if new_percent != y_percent:
+                if y_percent >= 0:
+                    screen.addch(y + y_percent + 1, x + width - 1,
+                                 '|', text_color)
+                y_percent = new_percent
+                screen.addch(y + y_percent + 1, x + width - 1,
+                             '#', text_color)
+            screen.noutrefresh()
+            text_win.noutrefresh()
+            curses.doupdate()
+            if self.metrics != None:
+                self.record_draw('text_viewer', start)
+                self.metrics.observe('winlib.text_viewer.rows_drawn',
+                                     drawn, 1)
+
+            # Wake up now and then for new output or while a search
+            # has not hit yet
+            if following:
+                text_win.timeout(1000 // self.follow_fps)
+            elif pending_forward != None:
+                text_win.timeout(50)
+            done = False
+            key_list = self.read_keys(text_win)
+            for i in range(0, len(key_list)):
+                ch = key_list[i]
+                if ch == -1:
+                    continue
+                elif ch == 27:
+                    done = True
+                    break
+                elif ch == ord(':') or ch == ord('/') or ch == ord('?'):
+                    # Keys typed ahead belong to the prompt
+                    for c in reversed(key_list[i + 1:]):
+                        curses.ungetch(c)
+                    if ch == ord(':'):
+                        ypos = self.jump_prompt(screen, x + 1,
+                                                y + height - 1, t_width,
+                                                text_color, ypos,
+                                                len(string_list))
+                    else:
+                        query = self.input_line(screen, x + 1,
+                                                y + height - 1, t_width,
+                                                chr(ch), text_color)
+                        if query:
+                            if search != None:
+                                search.cancel()
+                            search = TextSearch(string_list, query).start()
+                            search_forward = (ch == ord('/'))
+                            pending_forward = search_forward
+                    self.draw_box(screen, x, y, width, height,
+                                  text_color | curses.A_REVERSE)
+                    x_percent = y_percent = -1
+                    break
+                elif ch == ord('x') and self.xref != None:
+                    for c in reversed(key_list[i + 1:]):
+                        curses.ungetch(c)
+                    self.xref_menu(screen, x, y, width, height,
+                                   string_list[ypos:ypos + t_height],
+                                   text_color)
+                    # The popups drew over the text window
+                    self.draw_box(screen, x, y, width, height,
+                                  text_color | curses.A_REVERSE)
+                    text_win.touchwin()
+                    x_percent = y_percent = -1
+                    break
+                elif search != None and (ch == ord('n') or ch == ord('N')):
+                    if (ch == ord('n')) == search_forward:
+                        found = search.next_match(ypos)
+                    else:
+                        found = search.prev_match(ypos)
+                    if found != None:
+                        ypos = found
+                    continue
+                (xpos, ypos) = self.text_viewer_key(ch, xpos, ypos,
+                                                    len(string_list),
+                                                    max_width, t_height)
+            if done:
+                break
+            at_tail = ypos >= line_count - t_height
+
+        if search != None:
+            search.cancel()
+        del text_win
+        self.pop_layer()
+
+
+    def xref_menu(self, screen, x, y, width, height, line_list,
+                  text_color=5, selected_color=3):
+        """
+        Lets the user pick an address or symbol in line_list and then
+        either another place it was seen, opened in a text_viewer at
+        that line, or a lookup command whose result is kept for the
+        next time.  Nothing is rescanned; locations come from the index.
+        """
+        token_list = self.xref.tokens_in(line_list)
+        if len(token_list) == 0:
+            self.dialog_msg(screen, x + 2, y + 2, width - 4, 6, text_color,
+                            '< Xref >', 'No addresses or symbols on screen',
+                            ['[ OK ]'])
+            return
+        # Menus are not scrolled, so they are cut to the window
+        max_items = max(1, height - 4)
+        token_list = token_list[:max_items]
+        selected_token = self.hmenu_window(
+                screen, x + 2, y + 1, -1,
+                ['%s (%d)' % (token, self.xref.count(token))
+                 for token in token_list],
+                selected_color, text_color, False, True)
+        if selected_token >= self.KEY_ESCAPE_PRESSED:
+            return
+        token = token_list[selected_token]
+
+        location_list = self.xref.locations(token)
+        command_list = self.xref.lookup_commands(token)
+        item_list = []
+        for (result, line) in location_list[:max_items]:
+            text = self.xref.result_lines(result)[line].strip()
+            item_list.append(('%s:%d  %s' % (result.command, line + 1,
+                                              text))[:max(20, width - 8)])
+        item_list = item_list + command_list
+        selected_item = self.hmenu_window(screen, x + 4, y + 2, -1,
+                                          list(item_list), selected_color,
+                                          text_color, False, True)
+        if selected_item >= self.KEY_ESCAPE_PRESSED:
+            return
+        if selected_item < len(item_list) - len(command_list):
+            (result, line) = location_list[selected_item]
+            self.text_viewer(screen, x, y, width, height,
+                             self.xref.result_lines(result), text_color,
+                             True, None, line, token)
+            return
+        command = item_list[selected_item]
+        try:
+            result = self.xref.lookup(command).result()
+        except IOError as e:
+            self.dialog_msg(screen, x + 2, y + 2, width - 4, 6, text_color,
+                            '< Xref >', str(e), ['[ OK ]'])
+            return
+        self.text_viewer(screen, x, y, width, height,
+                         result.lines() + result.error_lines(), text_color,
+                         True, None, 0, token)
+
+
+    def read_keys(self, screen):
+        """
+        Waits for one key and then drains everything already queued,
+        so held down keys cost one redraw per batch instead of one
+        per key.
+        """
+        key_list = [screen.getch()]
+        screen.nodelay(1)
+        while True:
             ch = screen.getch()
-            if ch == curses.KEY_UP:
-                ypos = ypos - 1
-                if ypos < 0:
-                    ypos = 0
-            elif ch == curses.KEY_DOWN:
-                ypos = ypos + 1
-                if ypos >= len(string_list):
-                    ypos = len(string_list) - 1
-            elif ch == curses.KEY_LEFT:
-                xpos = xpos - 1
-                if xpos < 0:
-                    xpos = 0
-            elif ch == curses.KEY_RIGHT:
-                xpos = xpos + 1
-                if xpos >= max_width:
-                    xpos = max_width
-            elif ch == 27:
+            if ch == -1:
                 break
+            key_list.append(ch)
+        screen.nodelay(0)
+        return key_list
 
-        self.restore_window(screen, x, y, saved_data)
+
+    def text_viewer_key(self, ch, xpos, ypos, line_count, max_width,
+                        page_size):
+        last_line = max(line_count - 1, 0)
+        if ch == curses.KEY_UP:
+            ypos = ypos - 1
+        elif ch == curses.KEY_DOWN:
+            ypos = ypos + 1
+        elif ch == curses.KEY_PPAGE:
+            ypos = ypos - page_size
+        elif ch == curses.KEY_NPAGE:
+            ypos = ypos + page_size
+        elif ch == curses.KEY_HOME:
+            ypos = xpos = 0
+        elif ch == curses.KEY_END:
+            ypos = line_count - page_size
+        elif ch == curses.KEY_LEFT:
+            xpos = xpos - 1
+        elif ch == curses.KEY_RIGHT:
+            xpos = xpos + 1
+
+        ypos = max(0, min(ypos, last_line))
+        xpos = max(0, min(xpos, max_width))
+        return (xpos, ypos)
+
+
+    def input_line(self, screen, x, y, width, prompt, color = 0):
+        """
+        Reads a line of text on one screen row.  Returns None on ESC.
+        """
+        text = ''
+        while True:
+            screen.addstr(y, x, (prompt + text).ljust(width)[:width], color)
+            c = screen.getch()
+            if c == curses.KEY_ENTER or c == 10 or c == 13:
+                return text
+            elif c == 27:
+                return None
+            elif c == curses.KEY_BACKSPACE or c == 127 or c == 8:
+                text = text[:-1]
+            elif c >= 32 and c < 127:
+                text = text + chr(c)
+
+
+    def jump_prompt(self, screen, x, y, width, color, ypos, line_count):
+        """
+        ':1234' jumps to line 1234 and ':50%' to the middle of the text.
+        """
+        text = self.input_line(screen, x, y, width, ':', color)
+        try:
+            if text.endswith('%'):
+                percent = float(text[:-1])
+                ypos = int((line_count - 1) * percent / 100)
+            else:
+                ypos = int(text) - 1
+        except (AttributeError, ValueError):
+            return ypos
+        return max(0, min(ypos, line_count - 1))
+
+
+    def command_viewer(self, screen, x, y, width, height,
+                       shell, command, text_color=5, show_scroll=True,
+                       error_color=2):
+        """
+        Runs command through a started ShellIO and shows its output
+        in text_viewer, with anything it wrote to stderr in an errors
+        pane below.  execute() takes over a prefetch of the same
+        command, so a warm-up result is shown right away and one still
+        queued runs next.  Returns the CommandResult.
+        """
+        result = shell.execute(command).result()
+        error_list = result.error_lines()
+        if len(error_list) == 0:
+            self.text_viewer(screen, x, y, width, height,
+                             result.lines(), text_color, show_scroll)
+            return result
+
+        # stderr gets its own pane under the output
+        error_height = min(len(error_list) + 2, max(3, height // 3))
+        self.error_pane(screen, x, y + height - error_height, width,
+                        error_height, error_list, error_color)
+        self.text_viewer(screen, x, y, width, height - error_height,
+                         result.lines(), text_color, show_scroll)
+        self.pop_layer()
+        return result
+
+
+    def error_pane(self, screen, x, y, width, height, error_list,
+                   error_color=2):
+        """
+        Shows the last lines of error_list in a box.  The area is
+        pushed as a layer; the caller pops it when done.
+        """
+        self.push_layer(screen, x, y, width, height)
+        self.fill_box(screen, x, y, width, height, error_color)
+        title = ' errors (%d) ' % len(error_list)
+        if len(title) < width - 2:
+            screen.addstr(y, x + 1, title, error_color | curses.A_REVERSE)
+        t_height = height - 2
+        self.text_window(screen, x + 1, y + 1, width - 2, t_height, 0,
+                         max(0, len(error_list) - t_height), error_list,
+                         error_color | curses.A_REVERSE)
+
+
+    def follow_viewer(self, screen, x, y, width, height,
+                      shell, command, text_color=5, capacity=100000):
+        """
+        Starts command through a ShellIO and shows its output while it
+        runs, keeping the last 'capacity' lines.  Closing the viewer
+        before the command is done cancels it.  Returns the Future.
+        """
+        ring = RingBuffer(capacity)
+        future = shell.execute(command, spooled = ring)
+        self.text_viewer(screen, x, y, width, height, ring, text_color,
+                         True, future)
+        if not future.done():
+            shell.cancel(future)
+        return future
+
+
+    def table_viewer(self, screen, x, y, width, height, table,
+                     text_color=5, selected_color=3):
+        """
+        Shows a crashparse.ColumnTable sorted or filtered as picked
+        from a menu.  Views only reorder row numbers, so switching them
+        costs no reparsing even for 100k rows.  ESC in the viewer goes
+        back to the menu, ESC in the menu returns.
+        """
+        item_list = (['Sort by %s' % name for name in table.names] +
+                     ['Filter...', 'Clear filter', 'View'])
+        index = None
+        sort_column = None
+        reverse = False
+        selected_item = len(item_list) - 1
+        while True:
+            selected_item = self.hmenu_window(screen, x + 2, y + 1, -1,
+                                              list(item_list),
+                                              selected_color, text_color,
+                                              False, True, selected_item)
+            if selected_item >= self.KEY_ESCAPE_PRESSED:
+                break
+            if selected_item < len(table.names):
+                column = table.names[selected_item]
+                # Picking the same column again flips the order
+                reverse = (column == sort_column and not reverse)
+                sort_column = column
+            elif item_list[selected_item] == 'Filter...':
+                query = self.input_line(screen, x + 1, y + height - 1,
+                                        width - 2, 'filter: ', text_color)
+                if query:
+                    try:
+                        index = table.query_index(query, index)
+                    except (ValueError, re.error) as e:
+                        self.dialog_msg(screen, x + 2, y + 2, width - 4, 6,
+                                        text_color, '< Filter >', str(e),
+                                        ['[ OK ]'])
+                        continue
+            elif item_list[selected_item] == 'Clear filter':
+                index = None
+
+            view_index = index
+            if sort_column != None:
+                view_index = table.sort_index(sort_column, reverse, index)
+            self.text_viewer(screen, x, y, width, height,
+                             table.view(view_index), text_color)
 
 
     def pulldown_menu(self, screen, x, y, maxx, vmenu_list, hmenu_list,
                       selected_color = 3, normal_color = 5,
                       restore_window = True):
+        """
+        Menu bar of vmenu_list, each item opening the hmenu_list entry
+        under it.  Returns (menu index, item index) of the item picked
+        with Enter, or None when the menu is left with ESC.
+        """
         if restore_window == True:
-            saved_data = self.save_window(screen, x, y, maxx, 1)
+            self.push_layer(screen, x, y, maxx, 1)
 
+        selection = None
         selected_vmenu = 2
         selected_hmenu = 0
         x_pos_list = []
@@ -412,12 +1083,14 @@ class PyWindow:
                 selected_hmenu = self.KEY_RIGHT_PRESSED
                 continue
             else:
+                selection = (selected_vmenu, selected_hmenu)
                 break
 
             hmenu_selected[selected_vmenu] = selected_hmenu
 
         if restore_window == True:
-            self.restore_window(screen, x, y, saved_data)
+            self.pop_layer()
+        return selection
 
 
 def unit_test():
@@ -425,37 +1098,37 @@ def unit_test():
     mywin.init_winlib()
     (maxy, maxx) = mywin.stdscr.getmaxyx()
     """
-    mywin.clear_box(stdscr, 0, 0, 3, 3, curses.color_pair(7))
+    mywin.clear_box(stdscr, 0, 0, 3, 3, mywin.color_pair(7))
     mywin.draw_box(stdscr, 0, 0, 3, 3,
-                   curses.color_pair(7) | curses.A_REVERSE)
-    mywin.clear_box(stdscr, 13, 10, 11, 11, curses.color_pair(5))
-    mywin.draw_box(stdscr, 13, 10, 11, 11, curses.color_pair(5))
-    mywin.clear_box(stdscr, 5, 8, 15, 10, curses.color_pair(3))
+                   mywin.color_pair(7) | curses.A_REVERSE)
+    mywin.clear_box(stdscr, 13, 10, 11, 11, mywin.color_pair(5))
+    mywin.draw_box(stdscr, 13, 10, 11, 11, mywin.color_pair(5))
+    mywin.clear_box(stdscr, 5, 8, 15, 10, mywin.color_pair(3))
     mywin.draw_box(stdscr, 5, 8, 15, 10,
-             curses.color_pair(3) | curses.A_REVERSE | curses.A_BLINK)
-    mywin.clear_box(stdscr, 25, 12, 8, 5, curses.color_pair(10))
+             mywin.color_pair(3) | curses.A_REVERSE | curses.A_BLINK)
+    mywin.clear_box(stdscr, 25, 12, 8, 5, mywin.color_pair(10))
     mywin.draw_box(stdscr, 25, 12, 8, 5,
-                   curses.color_pair(10) | curses.A_REVERSE)
+                   mywin.color_pair(10) | curses.A_REVERSE)
 
-    mywin.fill_box(stdscr, 80, 5, 30, 15, curses.color_pair(15))
+    mywin.fill_box(stdscr, 80, 5, 30, 15, mywin.color_pair(15))
 
     saved_data = mywin.save_window(stdscr, 15, 10, 30, 5)
-    result = mywin.dialog_msg(stdscr, 15, 10, 30, 5, curses.color_pair(4),
+    result = mywin.dialog_msg(stdscr, 15, 10, 30, 5, mywin.color_pair(4),
                         "< Warning >", "Be careful\nwhat you are doing",
                         ["[ Yes ]", "[ No ]", "[ Cancel ]"])
     mywin.restore_window(stdscr, 15, 10, saved_data)
 
     mywin.vmenu(stdscr, 0, 0, maxx,
           ["File", "Edit", "View", "Themes", "Window", "Favorites"],
-          curses.color_pair(3), curses.color_pair(5),
+          mywin.color_pair(3), mywin.color_pair(5),
           True, False)
     saved_data = mywin.save_window(stdscr, 10, 1, 34, 8)
     mywin.hmenu_window(stdscr, 10, 1, 34,
           ["First", "Second", "Thrid", "Fourth", "Fifth", "Sixth"],
-          curses.color_pair(3), curses.color_pair(5))
+          mywin.color_pair(3), mywin.color_pair(5))
     mywin.restore_window(stdscr, 10, 1, saved_data)
 
-    mywin.fill_box(stdscr, 4, 4, 52, 7, curses.color_pair(25))
+    mywin.fill_box(stdscr, 4, 4, 52, 7, mywin.color_pair(25))
     for i in range(0, 5):
         mywin.text_window(stdscr, 5, 5, 50, 5, 0, i,
                     ["Hello",
@@ -463,7 +1136,7 @@ def unit_test():
                      "",
                      "I'm working as a support engineer",
                      "Good to see you"],
-                    curses.color_pair(25) | curses.A_REVERSE)
+                    mywin.color_pair(25) | curses.A_REVERSE)
 
         c = stdscr.getch()
 """
@@ -474,20 +1147,94 @@ def unit_test():
                 "",
                 "I'm a software engineer.",
                 "Good to see you"],
-                curses.color_pair(25) | curses.A_REVERSE)
+                mywin.color_pair(25) | curses.A_REVERSE)
 
     hmenu_list = ["File", "Edit", "View", "Help"]
     vmenu_list = [["New", "Open   ", "Save", "Close", "Quit"],
                   ["Copy", "Cut", "Paste   "],
                   ["View single", "View multiple   ", "Full Screen"],
                   ["About", "Help Online "]]
-    mywin.pulldown_menu(mywin.stdscr, 0, 0, maxx, hmenu_list, vmenu_list,
-                        curses.color_pair(3), curses.color_pair(5),
-                        True)
+    selection = mywin.pulldown_menu(mywin.stdscr, 0, 0, maxx, hmenu_list,
+                                    vmenu_list, mywin.color_pair(3),
+                                    mywin.color_pair(5), True)
+    if selection != None:
+        mywin.stdscr.addstr(maxy - 1, 0, 'picked %s' %
+                            vmenu_list[selection[0]][selection[1]].strip())
 
     c = mywin.stdscr.getch()
     mywin.exit_winlib()
 
 
+def benchmark(repeat = 20):
+    """
+    Times fill_box, hmenu_window and dialog_msg with the row based
+    drawing against the old one-addch-per-cell drawing.  Needs a
+    terminal; run as 'winlib.py bench'.
+    """
+    def cell_clear_box(screen, x, y, width, height, color = 0):
+        for x1 in range(0, width):
+            for y1 in range(0, height):
+                screen.addch(y + y1, x + x1, ' ', color | curses.A_REVERSE)
+
+    def cell_draw_box(screen, x, y, width, height, color = 0):
+        screen.addch(y, x, '+', color)
+        screen.addch(y + height - 1, x, '+', color)
+        screen.addch(y, x + width - 1, '+', color)
+        screen.addch(y + height - 1, x + width - 1, '+', color)
+        for x1 in range(1, width - 1):
+            screen.addch(y, x + x1, '-', color)
+            screen.addch(y + height - 1, x + x1, '-', color)
+        for y1 in range(1, height - 1):
+            screen.addch(y + y1, x, '|', color)
+            screen.addch(y + y1, x + width - 1, '|', color)
+
+    mywin = PyWindow()
+    mywin.init_winlib()
+    screen = mywin.stdscr
+    (maxy, maxx) = screen.getmaxyx()
+    menu_list = ["First", "Second", "Third", "Fourth", "Fifth", "Sixth"]
+    case_list = [
+        ('fill_box', lambda: mywin.fill_box(screen, 0, 0, maxx - 1, maxy - 1,
+                                            mywin.color_pair(5))),
+        ('hmenu_window', lambda: mywin.hmenu_window(screen, 10, 1, 34,
+                                                    list(menu_list), 3, 5,
+                                                    False, True)),
+        ('dialog_msg', lambda: mywin.dialog_msg(screen, 15, 5, 30, 6,
+                                                mywin.color_pair(4),
+                                                "< Warning >", "Be careful",
+                                                ["[ Yes ]", "[ No ]"])),
+    ]
+
+    report = []
+    for (name, draw) in case_list:
+        timing = []
+        for (clear_box, draw_box) in ((cell_clear_box, cell_draw_box),
+                                      (None, None)):
+            if clear_box != None:
+                mywin.clear_box = clear_box
+                mywin.draw_box = draw_box
+            else:
+                del mywin.clear_box
+                del mywin.draw_box
+            start = time.perf_counter()
+            for i in range(0, repeat):
+                # Menus and dialogs return on the queued Enter key
+                curses.ungetch(10)
+                draw()
+            timing.append((time.perf_counter() - start) / repeat)
+            curses.flushinp()
+        report.append('%-13s per-cell %8.3f ms  rows %8.3f ms  x%.1f' %
+                      (name, timing[0] * 1000, timing[1] * 1000,
+                       timing[0] / timing[1]))
+
+    mywin.exit_winlib()
+    sys.stdout.write('terminal %dx%d\n' % (maxx, maxy))
+    for line in report:
+        sys.stdout.write(line + '\n')
+
+
 if __name__ == "__main__":
-    unit_test()
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unit_test()
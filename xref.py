@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+
+"""
+Cross-reference index of addresses and symbols in command outputs
+
+An XrefIndex attached to a ShellIO gets every result as it streams in,
+like a transcript recorder, and tokenizes it in a background thread:
+
+    index = XrefIndex()
+    index.attach(shell)
+    ...
+    for (result, line) in index.locations('ffff88013e7db500'):
+        ...
+    index.close()
+
+Addresses (eight or more hex digits, with or without 0x) are keyed by
+value, so 0xffff8800deadbeef and ffff8800deadbeef are the same entry.
+Symbols are names followed by +0x offsets or ' at ' in backtraces,
+and names with an underscore in them.  A location is packed into one
+integer, (result number << 32) | line, and a token seen once holds that
+integer alone, so the index stays small next to the outputs.
+
+lookup() runs sym/struct/kmem style commands for a token once and
+keeps their Futures, and through the shell's ResultCache if it has one.
+"""
+
+import sys, time
+import re
+import weakref
+from array import array
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread, Lock
+
+from shellio import ShellIO
+
+ADDRESS_PATTERN = (r'\b0x([0-9a-f]{8,16})\b'
+                   r'|\b(?=[0-9]*[a-f])([0-9a-f]{8,16})\b')
+SYMBOL_PATTERN = (r'\b([A-Za-z_]\w*(?:\.\w+)?)(?=\+0x[0-9a-f])'
+                  r'|\b([A-Za-z_]\w*)(?= at [0-9a-f])'
+                  r'|\b(_*[A-Za-z]\w*_\w+)\b')
+TOKEN = re.compile(ADDRESS_PATTERN + '|' + SYMBOL_PATTERN)
+ADDRESS_GROUPS = (1, 2)
+SYMBOL = re.compile(SYMBOL_PATTERN.encode('ascii'))
+# Where a symbol can be; only lines holding one are matched against
+# SYMBOL, as scanning every byte with a regex is slow
+SYMBOL_HINTS = [re.compile(re.escape(hint)) for hint in
+                (b'_', b'+0x', b' at ')]
+# Hex digits become 'h' and other word characters 'w', so runs of
+# eight or more hex digits are found by a literal search
+HEX_CLASSES = bytes.maketrans(
+        b'0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_',
+        b'h' * 16 + b'w' * 47)
+HEX_RUN = re.compile(b'hhhhhhhh(?:h{0,8})(?![hw])')
+WORD_CLASSES = b'hw'
+LINE_BITS = 32
+LINE_MASK = (1 << LINE_BITS) - 1
+
+
+def token_key(text):
+    """
+    Returns the index key for a token as typed or shown: an int for an
+    address, the name for a symbol.
+    """
+    match = TOKEN.fullmatch(text)
+    if match != None and match.lastindex in ADDRESS_GROUPS:
+        return int(match.group(match.lastindex), 16)
+    return text
+
+
+def token_text(key):
+    if isinstance(key, int):
+        return '%x' % key
+    return key
+
+
+def add_location(found, key, line):
+    line_list = found.get(key)
+    if line_list == None:
+        found[key] = array('I', [line])
+    elif line_list[-1] != line:
+        line_list.append(line)
+
+
+def scan_tokens(data, first_line, found):
+    """
+    Adds every token in the bytes data to found as key -> array of
+    line numbers counting from first_line, and returns the number of
+    the line after data.  The regex engine only ever sees lines that
+    can hold a token, so plain lines cost a few C level scans.
+    """
+    classes = data.translate(HEX_CLASSES)
+    line = first_line
+    pos = 0
+    for match in HEX_RUN.finditer(classes):
+        start = match.start()
+        prefixed = False
+        if start > 0 and classes[start - 1] in WORD_CLASSES:
+            # Only a 0x prefix may touch the digits
+            if (data[start - 2:start] != b'0x' or
+                    (start > 2 and classes[start - 3] in WORD_CLASSES)):
+                continue
+            prefixed = True
+        text = data[start:match.end()]
+        if not prefixed and text.isdigit():
+            continue
+        line += data.count(b'\n', pos, start)
+        pos = start
+        add_location(found, int(text, 16), line)
+
+    line_starts = set()
+    for hint in SYMBOL_HINTS:
+        for match in hint.finditer(data):
+            line_starts.add(data.rfind(b'\n', 0, match.start()) + 1)
+    line = first_line
+    pos = 0
+    for start in sorted(line_starts):
+        end = data.find(b'\n', start)
+        if end < 0:
+            end = len(data)
+        line += data.count(b'\n', pos, start)
+        pos = start
+        for match in SYMBOL.finditer(data, start, end):
+            add_location(found, match.group(match.lastindex).decode(
+                    'ascii'), line)
+    return first_line + data.count(b'\n')
+
+
+class ResultRef:
+    """
+    What the index keeps of a result, so indexing does not keep every
+    output of the session alive: the command and the spool of a
+    spooled result, which lives on disk, or a weak reference to a
+    result held in memory.
+    """
+    __slots__ = ('command', 'spool', 'ref')
+
+    def __init__(self, result):
+        self.command = result.command
+        self.spool = result.spool
+        self.ref = None
+        if result.spool == None:
+            self.ref = weakref.ref(result)
+
+    def get(self):
+        """
+        Something with command and spool or stdout, as result_lines()
+        wants, or None once an in-memory result is gone.
+        """
+        if self.ref == None:
+            return self
+        return self.ref()
+
+
+class XrefIndex:
+    encoding = 'utf-8'
+    # Output of one result past this is not indexed, the size past
+    # which ShellIO spools a result to disk
+    max_bytes = 64 * 1024 * 1024
+    # Line lists of this many results are kept for showing locations
+    cached_results = 8
+    # Blocks waiting for the indexer; past this the I/O thread waits,
+    # like it does for transcript.TranscriptWriter
+    queue_size = 256
+
+    def __init__(self):
+        self.results = []
+        self.index = {}
+        self.open_results = {}
+        # Bytes posted per open result, kept by the I/O thread
+        self.posted_bytes = {}
+        self.lock = Lock()
+        self.queue = Queue(self.queue_size)
+        self.shell = None
+        self.lookup_futures = {}
+        self.line_cache = OrderedDict()
+        self.closed = False
+        self.indexer_thread = Thread(target = self.indexer_loop)
+        self.indexer_thread.daemon = True
+        self.indexer_thread.start()
+
+    def attach(self, shell):
+        """
+        Indexes every result of shell from now on and runs lookups
+        through it.
+        """
+        self.shell = shell
+        shell.add_recorder(self)
+        return self
+
+    # Called from ShellIO, like transcript.TranscriptWriter
+
+    def add_output(self, result, channel, block):
+        if channel == ShellIO.CHANNEL_STDERR:
+            return
+        posted = self.posted_bytes.get(result, 0)
+        if posted >= self.max_bytes:
+            # scan_block() would drop it anyway
+            return
+        self.posted_bytes[result] = posted + len(block)
+        self.post('output', result, block)
+
+    def finish(self, result):
+        self.posted_bytes.pop(result, None)
+        self.post('finish', result, None)
+
+    def discard(self, result):
+        self.posted_bytes.pop(result, None)
+        self.post('discard', result, None)
+
+    def record(self, result):
+        self.post('record', result, None)
+
+    def post(self, op, result, data):
+        # Results still coming in after close() are not indexed
+        if not self.closed:
+            self.queue.put((op, result, data))
+
+    def close(self):
+        """
+        Stops the indexer thread once it has caught up and lets go of
+        the results and lookups.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(('close', None, None))
+        self.indexer_thread.join()
+        with self.lock:
+            self.results = []
+            self.index = {}
+            self.lookup_futures = {}
+        self.open_results = {}
+        self.posted_bytes = {}
+        self.line_cache.clear()
+
+    def wait_idle(self):
+        """
+        Returns once everything queued so far is in the index.
+        """
+        self.queue.join()
+
+    # Indexer thread
+
+    def scan_block(self, state, data):
+        # state is [partial line, next line number, bytes, found]
+        if state[2] >= self.max_bytes:
+            return
+        state[2] += len(data)
+        data = state[0] + data
+        end = data.rfind(b'\n') + 1
+        state[0] = data[end:]
+        if end > 0:
+            state[1] = scan_tokens(data[:end], state[1], state[3])
+
+    def merge(self, result, found):
+        with self.lock:
+            number = len(self.results)
+            self.results.append(ResultRef(result))
+            base = number << LINE_BITS
+            index = self.index
+            for (key, line_list) in found.items():
+                entry = index.get(key)
+                if entry == None and len(line_list) == 1:
+                    index[key] = base | line_list[0]
+                    continue
+                if entry == None:
+                    entry = index[key] = array('Q')
+                elif isinstance(entry, int):
+                    entry = index[key] = array('Q', [entry])
+                entry.extend(base | line for line in line_list)
+
+    def indexer_loop(self):
+        while True:
+            (op, result, data) = self.queue.get()
+            try:
+                if op == 'output':
+                    state = self.open_results.get(result)
+                    if state == None:
+                        state = self.open_results[result] = [b'', 0, 0, {}]
+                    self.scan_block(state, data)
+                elif op == 'finish':
+                    state = self.open_results.pop(result, None)
+                    if state == None:
+                        state = [b'', 0, 0, {}]
+                    self.scan_block(state, b'\n')
+                    self.merge(result, state[3])
+                elif op == 'discard':
+                    self.open_results.pop(result, None)
+                elif op == 'record':
+                    state = [b'', 0, 0, {}]
+                    self.scan_block(state, result.text().encode(
+                            self.encoding, 'replace') + b'\n')
+                    self.merge(result, state[3])
+                elif op == 'close':
+                    break
+            finally:
+                self.queue.task_done()
+
+    # Queries
+
+    def locations(self, token):
+        """
+        Returns [(result, line), ...] for a token or index key, in the
+        order the results came in.  A spooled result comes back as its
+        ResultRef; in-memory results nobody holds any more are left out.
+        """
+        if isinstance(token, str):
+            token = token_key(token)
+        with self.lock:
+            entry = self.index.get(token)
+            if entry == None:
+                return []
+            if isinstance(entry, int):
+                entry = [entry]
+            location_list = [(self.results[packed >> LINE_BITS].get(),
+                              packed & LINE_MASK) for packed in entry]
+        return [(result, line) for (result, line) in location_list
+                if result != None]
+
+    def count(self, token):
+        if isinstance(token, str):
+            token = token_key(token)
+        with self.lock:
+            entry = self.index.get(token)
+        if entry == None:
+            return 0
+        if isinstance(entry, int):
+            return 1
+        return len(entry)
+
+    def tokens_in(self, line_list):
+        """
+        Returns the distinct tokens in line_list, e.g. the rows on
+        screen, as display strings ordered by the line they are first on.
+        """
+        found = {}
+        scan_tokens('\n'.join(line_list).encode(self.encoding, 'replace'),
+                    0, found)
+        return [token_text(key)
+                for key in sorted(found, key = lambda key: found[key][0])]
+
+    def result_lines(self, result):
+        """
+        Lines of a result as numbered by the index.  Splitting is done
+        once per result while it is among the last few looked at.
+        """
+        if result.spool != None:
+            return result.spool
+        lines = self.line_cache.get(id(result))
+        if lines == None or lines[0] is not result:
+            line_list = result.stdout.split('\n')
+            if len(line_list[-1]) == 0:
+                line_list.pop()
+            lines = (result, line_list)
+            self.line_cache[id(result)] = lines
+            if len(self.line_cache) > self.cached_results:
+                self.line_cache.popitem(last = False)
+        self.line_cache.move_to_end(id(result))
+        return lines[1]
+
+    def lookup_commands(self, token):
+        key = token_key(token)
+        if isinstance(key, int):
+            return ['sym %x' % key, 'kmem %x' % key, 'rd -s %x 16' % key]
+        return ['sym %s' % key, 'whatis %s' % key, 'struct %s' % key]
+
+    def lookup(self, command):
+        """
+        Returns the Future of command, running it only the first time.
+        """
+        with self.lock:
+            future = self.lookup_futures.get(command)
+            if future != None:
+                return future
+        future = self.shell.execute(command)
+        with self.lock:
+            self.lookup_futures[command] = future
+        return future
+
+    def stats(self):
+        with self.lock:
+            return {'results': len(self.results),
+                    'tokens': len(self.index),
+                    'locations': sum(1 if isinstance(entry, int)
+                                     else len(entry)
+                                     for entry in self.index.values())}
+
+
+def unit_test():
+    import os
+    from shellio import ShellIO
+    from sessiond import CRASH_INPUT_END_MARK, CRASH_OUTPUT_END_MARK
+
+    fakecrash = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'fakecrash.py')
+    myshell = ShellIO()
+    myshell.set_input(None)
+    myshell.set_output(None)
+    index = XrefIndex().attach(myshell)
+    myshell.start_command([sys.executable, fakecrash], None,
+                          CRASH_INPUT_END_MARK, CRASH_OUTPUT_END_MARK, True)
+    start = time.perf_counter()
+    result_list = myshell.run_batch(['bt', 'ps 100000', 'log 100000'])
+    index.wait_idle()
+    sys.stdout.write('indexed in %.1fms: %s\n' %
+                     ((time.perf_counter() - start) * 1000, index.stats()))
+
+    for token in ('0xffff88013e7db500', '__schedule', 'ffff880000001540'):
+        for (result, line) in index.locations(token):
+            sys.stdout.write('%-20s %-10s %6d  %s\n' %
+                             (token, result.command, line,
+                              index.result_lines(result)[line].strip()))
+    bt = myshell.execute('bt').result()
+    sys.stdout.write('%s\n' % index.tokens_in(bt.lines()))
+    sys.stdout.write('%r\n' % index.lookup(
+            index.lookup_commands('__schedule')[0]).result())
+    myshell.close()
+    myshell.wait()
+    index.close()
+    sys.stdout.write('closed: %s\n' % index.stats())
+
+
+if __name__ == "__main__":
+    unit_test()